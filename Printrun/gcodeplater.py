@@ -26,6 +26,7 @@ import types
 
 from printrun import gcview
 from printrun import gcoder
+from printrun.gcoder_cache import GCodeCache
 from printrun.objectplater import Plater
 from printrun.gl.libtatlin import actors
 
@@ -43,8 +44,11 @@ class GcodePlater(Plater):
     load_wildcard = _("GCODE files (*.gcode;*.GCODE;*.g)") + "|*.gcode;*.gco;*.g"
     save_wildcard = _("GCODE files (*.gcode;*.GCODE;*.g)") + "|*.gcode;*.gco;*.g"
 
-    def __init__(self, filenames = [], size = (800, 580), callback = None, parent = None, build_dimensions = None):
+    def __init__(self, filenames = [], size = (800, 580), callback = None, parent = None, build_dimensions = None, gcode_cache_size = 64):
         super(GcodePlater, self).__init__(filenames, size, callback, parent, build_dimensions)
+        # Size of the G-code analysis cache (MB), 0 to disable it, like the
+        # gcode_cache_size setting of pronsole
+        self.gcode_cache_size = gcode_cache_size
         viewer = gcview.GcodeViewPanel(self, build_dimensions = self.build_dimensions)
         self.set_viewer(viewer)
         self.platform = actors.Platform(self.build_dimensions)
@@ -55,8 +59,12 @@ class GcodePlater(Plater):
     objects = property(get_objects)
 
     def load_file(self, filename):
-        gcode = gcoder.GCode(open(filename, "rU"),
-                             get_home_pos(self.build_dimensions))
+        home_pos = get_home_pos(self.build_dimensions)
+        if self.gcode_cache_size > 0:
+            cache = GCodeCache(max_size = self.gcode_cache_size * 1024 * 1024)
+            gcode = cache.load(filename, home_pos)
+        else:
+            gcode = gcoder.GCode(open(filename, "rU"), home_pos)
         model = actors.GcodeModel()
         model.load_data(gcode)
         obj = gcview.GCObject(model)
@@ -55,8 +55,7 @@ if __name__ == '__main__':
     p = printcore(port, baud)
     p.loud = loud
     time.sleep(2)
-    gcode = [i.strip() for i in open(filename)]
-    gcode = gcoder.GCode(gcode)
+    gcode = gcoder.GCodeStream(filename)
     p.startprint(gcode)
 
     try:
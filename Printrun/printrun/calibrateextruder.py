@@ -32,6 +32,7 @@ try:
     from printdummy import printcore
 except ImportError:
     from printcore import printcore
+from printrun.printcore_protocol import TEMPERATURES
 
 import time
 import getopt
@@ -79,18 +80,16 @@ def heatup(p, temp, s = 0):
     if s: print
     else: print "\nReady."
 
+def watchtemp(p):
+    """Keeps p.temp up to date with the extruder temperature reported by
+    the printer"""
+    p.temp = 0
+    def temperatures_received(reply):
+        if 'T' in reply.temperatures:
+            p.temp = int(reply.temperatures['T'][0])
+    p.protocol.add_handler(temperatures_received, TEMPERATURES)
+
 def gettemp(p):
-    try: p.logl
-    except: setattr(p, 'logl', 0)
-    try: p.temp
-    except: setattr(p, 'temp', 0)
-    for n in range(p.logl, len(p.log)):
-        line = p.log[n]
-        if 'T:' in line:
-            try:
-                setattr(p, 'temp', int(line.split('T:')[1].split()[0]))
-            except: print line
-    p.logl = len(p.log)
     return p.temp
 if not os.path.exists(port):
     port = 0
@@ -142,6 +141,7 @@ try:
     except:
         print 'Error.'
         raise
+    watchtemp(p)
     while not p.online:
         time.sleep(1)
         w('.')
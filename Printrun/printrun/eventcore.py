@@ -0,0 +1,535 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""printcore driven by an event loop instead of its own threads.
+
+printcore uses a read, a send and a print thread per printer. eventcore has
+the same API and callbacks but reads and writes the printer without
+blocking from a single event loop thread, so that one process can drive
+many printers. The loop is an EventLoop, or a TornadoLoop to share the
+tornado IOLoop of a server:
+
+    loop = EventLoop()
+    p = eventcore("/dev/ttyACM0", 115200, loop = loop)
+    p.onlinecb = lambda: p.startprint(gcode)
+    loop.run()
+"""
+
+import os
+import time
+import heapq
+import errno
+import fcntl
+import socket
+import select
+import logging
+import traceback
+from collections import deque
+from threading import Lock, current_thread
+
+from serial import Serial, SerialException
+
+from printrun.printcore import printcore, disable_hup, gcoder_kinematics
+from printrun.printrun_utils import install_locale, decode_utf8
+install_locale('pronterface')
+
+class Timer(object):
+    """Callback scheduled with call_later, which cancel() unschedules"""
+
+    def __init__(self, deadline, callback):
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class EventLoop(object):
+    """Minimal select() based event loop. Its methods are only to be called
+    from the thread running it, but for add_callback and stop."""
+
+    def __init__(self):
+        self._readers = {}
+        self._writers = {}
+        self._timers = []  # heap of (deadline, sequence number, Timer)
+        self._sequence = 0
+        self._callbacks = deque()
+        self._lock = Lock()
+        self._thread = None
+        self._running = False
+        # Written to by add_callback to wake the loop up from other threads
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        for fd in (self._wakeup_read, self._wakeup_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.add_reader(self._wakeup_read, self._wakeup)
+
+    def add_reader(self, fd, callback):
+        self._readers[fd] = callback
+
+    def remove_reader(self, fd):
+        self._readers.pop(fd, None)
+
+    def add_writer(self, fd, callback):
+        self._writers[fd] = callback
+
+    def remove_writer(self, fd):
+        self._writers.pop(fd, None)
+
+    def call_later(self, delay, callback):
+        timer = Timer(time.time() + delay, callback)
+        self._sequence += 1
+        heapq.heappush(self._timers, (timer.deadline, self._sequence, timer))
+        return timer
+
+    def add_callback(self, callback, *args):
+        """Runs callback(*args) from the loop thread, can be called from any
+        thread"""
+        with self._lock:
+            self._callbacks.append((callback, args))
+        if current_thread() is not self._thread:
+            try:
+                os.write(self._wakeup_write, "x")
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def _wakeup(self):
+        try:
+            os.read(self._wakeup_read, 4096)
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _run_callback(self, callback, *args):
+        try:
+            callback(*args)
+        except:
+            logging.error(_("Event loop callback failed with:") +
+                          "\n" + traceback.format_exc())
+
+    def run(self):
+        """Runs the loop until stop() is called"""
+        self._thread = current_thread()
+        self._running = True
+        while self._running:
+            with self._lock:
+                callbacks = self._callbacks
+                self._callbacks = deque()
+            for callback, args in callbacks:
+                self._run_callback(callback, *args)
+            if not self._running:
+                break
+            timers = self._timers
+            while timers and timers[0][2].cancelled:
+                heapq.heappop(timers)
+            if self._callbacks:
+                timeout = 0
+            elif timers:
+                timeout = max(0, timers[0][0] - time.time())
+            else:
+                timeout = None
+            try:
+                readable, writable, _x = select.select(self._readers.keys(),
+                                                       self._writers.keys(),
+                                                       [], timeout)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in readable:
+                callback = self._readers.get(fd)
+                if callback is not None:
+                    self._run_callback(callback)
+            for fd in writable:
+                callback = self._writers.get(fd)
+                if callback is not None:
+                    self._run_callback(callback)
+            now = time.time()
+            while timers and timers[0][0] <= now:
+                timer = heapq.heappop(timers)[2]
+                if not timer.cancelled:
+                    self._run_callback(timer.callback)
+        self._thread = None
+
+    def _stop(self):
+        self._running = False
+
+    def stop(self):
+        self.add_callback(self._stop)
+
+class TornadoLoop(object):
+    """Gives the EventLoop methods used by eventcore to a tornado IOLoop, so
+    that printers can be driven from the thread of a tornado server"""
+
+    def __init__(self, ioloop):
+        self.ioloop = ioloop
+        self._handlers = {}  # fd: [reader, writer]
+
+    def _update(self, fd, reader, writer):
+        events = 0
+        if reader is not None:
+            events |= self.ioloop.READ
+        if writer is not None:
+            events |= self.ioloop.WRITE
+        registered = fd in self._handlers
+        if not events:
+            if registered:
+                del self._handlers[fd]
+                self.ioloop.remove_handler(fd)
+            return
+        self._handlers[fd] = [reader, writer]
+        if registered:
+            self.ioloop.update_handler(fd, events)
+        else:
+            self.ioloop.add_handler(fd, self._dispatch, events)
+
+    def _dispatch(self, fd, events):
+        if events & (self.ioloop.READ | self.ioloop.ERROR):
+            reader = self._handlers.get(fd, [None, None])[0]
+            if reader is not None:
+                reader()
+        if events & self.ioloop.WRITE:
+            writer = self._handlers.get(fd, [None, None])[1]
+            if writer is not None:
+                writer()
+
+    def add_reader(self, fd, callback):
+        self._update(fd, callback, self._handlers.get(fd, [None, None])[1])
+
+    def remove_reader(self, fd):
+        self._update(fd, None, self._handlers.get(fd, [None, None])[1])
+
+    def add_writer(self, fd, callback):
+        self._update(fd, self._handlers.get(fd, [None, None])[0], callback)
+
+    def remove_writer(self, fd):
+        self._update(fd, self._handlers.get(fd, [None, None])[0], None)
+
+    def call_later(self, delay, callback):
+        now = getattr(self.ioloop, "time", time.time)()
+        timer = Timer(now + delay, callback)
+        timer.handle = self.ioloop.add_timeout(timer.deadline,
+                                               lambda: self._fire(timer))
+        return timer
+
+    def _fire(self, timer):
+        if not timer.cancelled:
+            timer.callback()
+
+    def add_callback(self, callback, *args):
+        self.ioloop.add_callback(callback, *args)
+
+class Transport(object):
+    """Non blocking serial port or socket of an eventcore, used as its
+    printer attribute. What can not be written right away is kept and
+    written once the loop finds the printer writable."""
+
+    # Bytes written during a batch after which they are written out
+    batch_size = 8192
+
+    def __init__(self, core, stream):
+        self.core = core
+        self.stream = stream
+        self.tcp = isinstance(stream, socket.socket)
+        self.fd = stream.fileno()
+        if self.tcp:
+            stream.setblocking(0)
+        else:
+            fcntl.fcntl(self.fd, fcntl.F_SETFL,
+                        fcntl.fcntl(self.fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.pending = ""
+        self._batch = None  # data written during a batch, see start_batch
+        self._batched = 0
+
+    def read(self):
+        """Returns the data received, "" if there is none or None if the
+        connection failed"""
+        try:
+            if self.tcp:
+                data = self.stream.recv(4096)
+            else:
+                data = os.read(self.fd, 4096)
+            if not data:
+                raise OSError(-1, "Read EOF from printer")
+            return data
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return ""
+            self.core.logError(_(u"Can't read from printer (disconnected?) (Socket error {0}): {1}").format(e.errno, decode_utf8(e.strerror)))
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return ""
+            self.core.logError(_(u"Can't read from printer (disconnected?) (OS Error {0}): {1}").format(e.errno, e.strerror))
+        return None
+
+    def _write(self, data):
+        """Writes what can be written of data without blocking, returning
+        its length. Errors are raised as printcore._write expects them."""
+        try:
+            if self.tcp:
+                return self.stream.send(data)
+            return os.write(self.fd, data)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            raise
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return 0
+            raise SerialException(str(e))
+
+    def write(self, data):
+        if self._batch is not None:
+            self._batch.append(data)
+            self._batched += len(data)
+            if self._batched < self.batch_size:
+                return
+            data = "".join(self._batch)
+            self._batch = []
+            self._batched = 0
+        if not self.pending:
+            data = data[self._write(data):]
+            if data:
+                self.core.loop.add_writer(self.fd, self._write_pending)
+        self.pending += data
+
+    def _write_pending(self):
+        try:
+            self.pending = self.pending[self._write(self.pending):]
+        except (socket.error, SerialException) as e:
+            self.core.logError(_(u"Can't write to printer (disconnected?): {0}").format(decode_utf8(str(e))))
+            self.pending = ""
+        if not self.pending:
+            self.core.loop.remove_writer(self.fd)
+            self.core._pump()
+
+    def flush(self):
+        pass
+
+    def start_batch(self):
+        """Holds the data written until end_batch (or until batch_size bytes
+        are held), to write it at once"""
+        self._batch = []
+        self._batched = 0
+
+    def end_batch(self):
+        data = "".join(self._batch)
+        self._batch = None
+        if data and self.stream is not None:
+            try:
+                self.write(data)
+            except (socket.error, SerialException) as e:
+                self.core.logError(_(u"Can't write to printer (disconnected?): {0}").format(decode_utf8(str(e))))
+
+    def isOpen(self):
+        return self.stream is not None
+
+    def close(self):
+        self.core.loop.remove_reader(self.fd)
+        self.core.loop.remove_writer(self.fd)
+        try:
+            self.stream.close()
+        except (socket.error, OSError):
+            pass
+        self.stream = None
+
+class eventcore(printcore):
+    """printcore running on an event loop (see the module documentation).
+    Its methods are to be called from the loop thread, but for send and
+    send_now, and the callbacks are run from the loop thread too. Lines
+    are sent one at a time, waiting for an "ok" after each as the
+    rx_buffer_size of printcore is not supported. Only POSIX serial ports
+    and TCP sockets can be used."""
+
+    # Time to wait for an answer to M105 before sending it again while
+    # connecting, like printcore's 15 empty reads of 0.25s
+    online_retry = 3.75
+
+    def __init__(self, port = None, baud = None, loop = None):
+        self.loop = loop if loop is not None else EventLoop()
+        self._received_data = ""
+        self._online_timer = None
+        self._print_running = False
+        self.printer_tcp = None
+        printcore.__init__(self, port, baud)
+
+    def connect(self, port = None, baud = None):
+        """Set port and baudrate if given, then connect to printer
+        """
+        if self.printer:
+            self.disconnect()
+        if port is not None:
+            self.port = port
+        if baud is not None:
+            self.baud = baud
+        if self.port is not None and gcoder_kinematics is not None:
+            self.kinematic_profile = gcoder_kinematics.load_profile(self.port)
+        if self.port is None or self.baud is None:
+            return
+        address = self._tcp_address(self.port)
+        self.writefailures = 0
+        if address is not None:
+            try:
+                self.printer_tcp = socket.create_connection(address, 1.0)
+            except socket.error as e:
+                self.logError(_("Could not connect to %s:%s:") % address +
+                              "\n" + _("Socket error %s:") % e.errno +
+                              "\n" + e.strerror)
+                self.printer_tcp = None
+                return
+            self.printer = Transport(self, self.printer_tcp)
+        else:
+            disable_hup(self.port)
+            self.printer_tcp = None
+            try:
+                serial = Serial(port = self.port, baudrate = self.baud,
+                                timeout = 0)
+            except SerialException as e:
+                self.logError(_("Could not connect to %s at baudrate %s:") % (self.port, self.baud) +
+                              "\n" + _("Serial error: %s") % e)
+                return
+            except IOError as e:
+                self.logError(_("Could not connect to %s at baudrate %s:") % (self.port, self.baud) +
+                              "\n" + _("IO error: %s") % e)
+                return
+            self.printer = Transport(self, serial)
+        self._received_data = ""
+        self.clear = True
+        self.loop.add_reader(self.printer.fd, self._read)
+        self._ask_online()
+
+    def disconnect(self):
+        """Disconnects from printer and pauses the print
+        """
+        if self._online_timer is not None:
+            self._online_timer.cancel()
+            self._online_timer = None
+        if self.printer:
+            self.printer.close()
+        self.printer = None
+        self.online = False
+        self.printing = False
+        if self._print_running:
+            self._print_running = False
+            self._end_print()
+
+    def reset(self):
+        """Reset the printer
+        """
+        if self.printer and not self.printer_tcp:
+            self.printer.stream.setDTR(1)
+            self.loop.call_later(0.2, self._end_reset)
+
+    def _end_reset(self):
+        if self.printer and not self.printer_tcp:
+            self.printer.stream.setDTR(0)
+
+    def _counting(self):
+        return False
+
+    def _ask_online(self):
+        """Sends M105 until the printer answers, see _listen_until_online"""
+        self._online_timer = None
+        if self.online or not self.printer:
+            return
+        if self.writefailures >= 4:
+            print _("Aborting connection attempt after 4 failed writes.")
+            return
+        self._send("M105")
+        self._online_timer = self.loop.call_later(self.online_retry,
+                                                  self._ask_online)
+
+    def _read(self):
+        data = self.printer.read()
+        if data is None:
+            self.disconnect()
+            return
+        lines = (self._received_data + data).split("\n")
+        self._received_data = lines.pop()
+        for line in lines:
+            if not self.printer:
+                return
+            reply = self._received(line + "\n")
+            if self.online:
+                self._handle_reply(reply)
+            elif self._check_online(reply):
+                if self._online_timer is not None:
+                    self._online_timer.cancel()
+                    self._online_timer = None
+                self._reset_inflight()
+                if self.query_kinematics and gcoder_kinematics is not None:
+                    self._query_kinematics()
+        self._pump()
+
+    def _pump(self):
+        """Sends lines until the printer has to acknowledge one, doing the
+        work of the print and send threads of printcore. Over TCP, the lines
+        sent by a call are written at once."""
+        printer = self.printer
+        batching = printer is not None and printer.tcp
+        if batching:
+            printer.start_batch()
+        try:
+            self._pump_lines()
+        finally:
+            if batching:
+                printer.end_batch()
+        if self._print_running and not self.printing:
+            self._print_running = False
+            self._end_print()
+
+    def _pump_lines(self):
+        while self.printer and self.online:
+            if self.priqueue.urgent():
+                # Emergency commands do not wait for the printer
+                self._write_urgent()
+            elif self.printing:
+                if not self.clear or self.printer.pending:
+                    break
+                self._sendnext()
+            elif not self.priqueue.empty():
+                self._send(self.priqueue.get_nowait())
+                self.priqueue.task_done()
+            else:
+                break
+
+    def _start_print(self, resuming):
+        self._encoded.clear()
+        self._print_running = True
+        if self.startcb:
+            #callback for printing started
+            started = time.time()
+            try: self.startcb(resuming)
+            except:
+                self.logError(_("Print start callback failed with:") +
+                              "\n" + traceback.format_exc())
+            self.metrics.callback("startcb", started)
+        self.loop.add_callback(self._pump)
+
+    def pause(self):
+        """Pauses the print, saving the current position.
+        """
+        if printcore.pause(self) is False:
+            return False
+        self.loop.add_callback(self._pump)
+
+    def send(self, command, wait = 0):
+        printcore.send(self, command, wait)
+        self.loop.add_callback(self._pump)
+
+    def send_now(self, command, wait = 0, priority = None):
+        printcore.send_now(self, command, wait, priority)
+        self.loop.add_callback(self._pump)
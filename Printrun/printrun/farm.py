@@ -0,0 +1,334 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Print farm: many printers driven from a single process.
+
+A Farm owns an eventcore connection per printer, all of them running on
+one event loop thread, and a queue of jobs. A job is a G-code file parsed
+once, which can then be queued any number of times, on any printer: the
+printers share its GCode object. Each print goes through a JobPrint view of
+it, so that the commands sent to a printer while it prints (which printcore
+appends to the G-code being printed) are only appended to that print and
+not to the job. Whenever a printer is online and idle, the first queued job
+it may print is started on it.
+
+    farm = Farm()
+    farm.add_printer("left", "/dev/ttyACM0", 115200)
+    farm.add_printer("right", "/dev/ttyACM1", 115200)
+    farm.queue(farm.load("part.gcode"), copies = 4)
+    farm.run()
+
+Besides load, which parses files in the calling thread, the methods of
+Farm can be called from any thread: they are run from the loop thread.
+"""
+
+import time
+import logging
+from collections import deque
+from threading import Lock
+
+from printrun import gcoder
+from printrun.eventcore import eventcore, EventLoop
+from printrun.gcoder_cache import GCodeCache
+from printrun.printcore_protocol import TEMPERATURES
+from printrun.printrun_utils import install_locale
+install_locale('pronterface')
+
+class Job(object):
+    """G-code file parsed once, to be printed on one or more printers"""
+
+    def __init__(self, name, gcode):
+        self.name = name
+        self.gcode = gcode
+        self.printed = 0  # number of prints of the job completed
+
+    def __repr__(self):
+        return "<Job %s>" % self.name
+
+class JobPrint(object):
+    """G-code printed by one printer: the lines of the GCode of a job,
+    shared with the other printers, followed by the commands appended to
+    this print only"""
+
+    def __init__(self, gcode):
+        self.gcode = gcode
+        self.filename = gcode.filename
+        self.appended = []  # (layer, gline) of the commands appended
+        self._analyzer = gcoder.GCode()  # parses the commands appended
+
+    def __len__(self):
+        return len(self.gcode) + len(self.appended)
+
+    def layer_line(self, i):
+        length = len(self.gcode)
+        if i < length:
+            return self.gcode.layer_line(i)
+        i -= length
+        if i < len(self.appended):
+            return self.appended[i]
+        return None
+
+    def checkpoint(self, i):
+        if i < len(self.gcode):
+            return self.gcode.checkpoint(i)
+        return None
+
+    def append(self, command, store = True):
+        gline = self._analyzer.append(command, store = False)
+        if gline is not None and store:
+            last = self.layer_line(len(self) - 1)
+            self.appended.append((last[0] if last is not None else 0, gline))
+        return gline
+
+class FarmPrinter(object):
+    """Printer of a Farm, with its connection (core), current job and
+    telemetry"""
+
+    def __init__(self, farm, name, port, baud):
+        self.farm = farm
+        self.name = name
+        self.job = None
+        self.started = None  # start time of the current job
+        # Set once a print ended, until the bed is cleared (see
+        # Farm.pause_between_prints and Farm.release)
+        self.held = False
+        self.failed_job = None  # job interrupted by a disconnection
+        self.temps = {}  # sensor name ("T", "T1", "B"...): (temp, target)
+        self.lines_sent = 0
+        self._samples = deque(maxlen = 10)  # (time, lines_sent)
+        core = eventcore(loop = farm.loop)
+        # Only a short history of the exchanges is kept per printer
+        core.log = deque(maxlen = farm.history)
+        core.sent = deque(maxlen = farm.history)
+        core.onlinecb = self._online
+        core.protocol.add_handler(self._temperatures_received, TEMPERATURES)
+        core.printsendcb = self._sent
+        core.endcb = self._ended
+        self.core = core
+        core.connect(port, baud)
+
+    def _get_state(self):
+        if not self.core.online:
+            return "offline"
+        if self.core.printing:
+            return "printing"
+        if self.core.paused:
+            return "paused"
+        if self.held:
+            return "held"
+        return "idle"
+    state = property(_get_state)
+
+    def _get_progress(self):
+        if self.job is None or not len(self.job.gcode):
+            return None
+        return float(self.core.queueindex) / len(self.job.gcode)
+    progress = property(_get_progress)
+
+    def _get_lines_per_second(self):
+        if len(self._samples) < 2:
+            return 0.
+        (start, start_lines), (end, end_lines) = self._samples[0], self._samples[-1]
+        return (end_lines - start_lines) / (end - start)
+    lines_per_second = property(_get_lines_per_second)
+
+    def start(self, job):
+        self.job = job
+        self.started = time.time()
+        self.core.startprint(JobPrint(job.gcode))
+
+    def _online(self):
+        self.farm.loop.add_callback(self.farm._schedule)
+
+    def _temperatures_received(self, reply):
+        self.temps.update(reply.temperatures)
+
+    def _sent(self, gline):
+        self.lines_sent += 1
+
+    def _ended(self):
+        if self.core.paused:
+            return
+        job = self.job
+        self.job = None
+        if not self.core.online:
+            logging.error(_("Printer %s got disconnected while printing %s") % (self.name, job.name))
+            self.failed_job = job
+            self.held = True
+            return
+        job.printed += 1
+        logging.info(_("Printer %s finished printing %s in %s") % (self.name, job.name, time.time() - self.started))
+        self.held = self.farm.pause_between_prints
+        self.farm.loop.add_callback(self.farm._schedule)
+
+    def _sample(self, now):
+        self._samples.append((now, self.lines_sent))
+
+    def telemetry(self):
+        return {"state": self.state,
+                "job": self.job.name if self.job is not None else None,
+                "progress": self.progress,
+                "lines_per_second": self.lines_per_second,
+                "temps": dict(self.temps)}
+
+class Farm(object):
+    """Printers sharing a queue of jobs, driven from one event loop"""
+
+    # Do not start a new job on a printer before its bed was cleared, i.e.
+    # before release() was called for it
+    pause_between_prints = True
+    # Interval between two temperature requests (M105) to the printers, and
+    # between two samples of the lines sent to compute the lines/s
+    temp_interval = 5
+    sample_interval = 1
+    # Number of lines kept in the log and sent history of each printer
+    history = 200
+
+    def __init__(self, loop = None, home_pos = None, cache_size = 0,
+                 processes = None):
+        """cache_size is the size of the gcoder_cache to use in MB, in which
+        case jobs are memory mapped; they are fully parsed otherwise"""
+        self.loop = loop if loop is not None else EventLoop()
+        self.home_pos = home_pos
+        self.cache_size = cache_size
+        self.processes = processes
+        self.printers = {}
+        self.jobs = {}
+        self._jobs_lock = Lock()
+        self._queue = []  # (job, names of the printers allowed or None)
+        self._last_temp_request = 0
+        self.loop.add_callback(self._sample)
+
+    def load(self, filename, name = None):
+        """Returns the job printing filename, parsing it unless it was
+        already loaded under the same name"""
+        if name is None:
+            name = filename
+        with self._jobs_lock:
+            if name in self.jobs:
+                return self.jobs[name]
+        if self.cache_size > 0:
+            cache = GCodeCache(max_size = self.cache_size * 1024 * 1024)
+            gcode = cache.load(filename, self.home_pos, self.processes)
+        else:
+            gcode = gcoder.GCode(open(filename, "rU"), self.home_pos,
+                                 self.processes)
+        with self._jobs_lock:
+            return self.jobs.setdefault(name, Job(name, gcode))
+
+    def add_printer(self, name, port, baud):
+        self.loop.add_callback(self._add_printer, name, port, baud)
+
+    def _add_printer(self, name, port, baud):
+        if name in self.printers:
+            self._remove_printer(name)
+        self.printers[name] = FarmPrinter(self, name, port, baud)
+
+    def remove_printer(self, name):
+        self.loop.add_callback(self._remove_printer, name)
+
+    def _remove_printer(self, name):
+        printer = self.printers.pop(name, None)
+        if printer is not None:
+            printer.core.disconnect()
+
+    def queue(self, job, copies = 1, printers = None):
+        """Queues copies prints of job, on any printer or on one of the
+        printers named in printers"""
+        if printers is not None:
+            printers = frozenset(printers)
+        self.loop.add_callback(self._queue_job, job, copies, printers)
+
+    def _queue_job(self, job, copies, printers):
+        self._queue.extend([(job, printers)] * copies)
+        self._schedule()
+
+    def unqueue(self, job):
+        """Removes the prints of job which did not start yet"""
+        self.loop.add_callback(self._unqueue, job)
+
+    def _unqueue(self, job):
+        self._queue = [entry for entry in self._queue if entry[0] is not job]
+
+    def release(self, name):
+        """Tells that the bed of a printer was cleared after a print, so that
+        it can start its next job"""
+        self.loop.add_callback(self._release, name)
+
+    def _release(self, name):
+        printer = self.printers.get(name)
+        if printer is not None:
+            printer.held = False
+            printer.failed_job = None
+            self._schedule()
+
+    def pause(self, name):
+        self.loop.add_callback(self._call, name, "pause")
+
+    def resume(self, name):
+        self.loop.add_callback(self._call, name, "resume")
+
+    def _call(self, name, method):
+        printer = self.printers.get(name)
+        if printer is not None:
+            getattr(printer.core, method)()
+
+    def _schedule(self):
+        """Starts the first job each idle printer may print"""
+        for printer in self.printers.values():
+            if printer.state != "idle":
+                continue
+            for i, (job, names) in enumerate(self._queue):
+                if names is None or printer.name in names:
+                    del self._queue[i]
+                    printer.start(job)
+                    break
+
+    def _sample(self):
+        now = time.time()
+        request_temps = now - self._last_temp_request >= self.temp_interval
+        if request_temps:
+            self._last_temp_request = now
+        for printer in self.printers.values():
+            printer._sample(now)
+            if request_temps and printer.core.online:
+                printer.core.send_now("M105")
+        self.loop.call_later(self.sample_interval, self._sample)
+
+    def telemetry(self):
+        """Returns the state of the farm: per printer telemetry under
+        "printers" and aggregate figures"""
+        printers = dict((name, printer.telemetry())
+                        for name, printer in self.printers.items())
+        states = [printer["state"] for printer in printers.values()]
+        return {"printers": printers,
+                "printing": states.count("printing"),
+                "idle": states.count("idle"),
+                "offline": states.count("offline"),
+                "queue_depth": len(self._queue),
+                "lines_per_second": sum(printer["lines_per_second"]
+                                        for printer in printers.values())}
+
+    def run(self):
+        """Runs the event loop of the farm until stop() is called"""
+        self.loop.run()
+
+    def stop(self):
+        self.loop.add_callback(self._stop)
+
+    def _stop(self):
+        for name in self.printers.keys():
+            self._remove_printer(name)
+        self.loop.stop()
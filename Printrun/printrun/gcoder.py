@@ -14,12 +14,18 @@
 # You should have received a copy of the GNU General Public License
 # along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import sys
 import re
 import math
 import datetime
 import logging
+import mmap
+import multiprocessing
 from array import array
+from bisect import bisect_right, insort
+from collections import deque, OrderedDict
+from threading import Lock
 
 from printrun_utils import install_locale
 install_locale('pronterface')
@@ -31,6 +37,137 @@ gcode_exp = re.compile("\([^\(\)]*\)|;.*|[/\*].*\n|([%s])([-+]?[0-9]*\.?[0-9]*)"
 m114_exp = re.compile("\([^\(\)]*\)|[/\*].*\n|([XYZ]):?([-+]?[0-9]*\.?[0-9]*)")
 specific_exp = "(?:\([^\(\)]*\))|(?:;.*)|(?:[/\*].*\n)|(%s[-+]?[0-9]*\.?[0-9]*)"
 move_gcodes = ["G0", "G1", "G2", "G3"]
+_parsed_args = frozenset(gcode_parsed_args)
+# Maps command tokens as returned by gcode_exp to (command, is_move)
+_command_cache = {}
+# Lines which may change the Z used for layer detection hold one of these:
+# a Z coordinate, G90/G91/G92 or G20/G21
+_layer_candidate_needles = ("z", "Z", "G9", "g9", "G2", "g2")
+# Flag set by _tokenize_chunk on moves, the lower bits telling which
+# gcode_parsed_args are set
+TOKEN_IS_MOVE = 1 << 7
+# Analyzer attributes describing the machine state between two lines
+_analyzer_state = ("imperial", "relative", "relative_e", "current_tool",
+                   "current_x", "current_y", "current_z", "current_f",
+                   "offset_x", "offset_y", "offset_z", "current_e", "offset_e",
+                   "total_e", "max_e")
+
+def _command_info(token):
+    """Returns (command, is_move) for the first token of a line, caching the
+    result"""
+    command = token[0].upper() + token[1]
+    command_info = (command, command in move_gcodes)
+    if len(_command_cache) < 1024:
+        _command_cache[token] = command_info
+    return command_info
+
+def _state_after(state, raws, home_pos = None):
+    """Returns the analyzer state, as a dict, reached by parsing the raw
+    lines raws from the analyzer state state"""
+    parser = GCode(None, home_pos)
+    for name, value in zip(_analyzer_state, state):
+        setattr(parser, name, value)
+    if raws:
+        parser._preprocess([Line(raw) for raw in raws],
+                           tokens = chunk_tokens(raws))
+    return dict((name, getattr(parser, name)) for name in _analyzer_state)
+
+def _tokenize_chunk(raws):
+    """Tokenizes a chunk of raw lines and parses the coordinates of G
+    commands, as done by GCode._preprocess. This runs in worker processes,
+    so the results are packed: the command of each line (None if it could
+    not be parsed), a string of flags per line (TOKEN_IS_MOVE and one bit
+    per coordinate set, in gcode_parsed_args order) and a string of 7
+    doubles per line holding the coordinates values."""
+    findall = gcode_exp.findall
+    commands = _command_cache
+    slots = dict((code, 1 << i) for i, code in enumerate(gcode_parsed_args))
+    offsets = dict((code, i) for i, code in enumerate(gcode_parsed_args))
+    width = len(gcode_parsed_args)
+    line_commands = []
+    flags = array('B')
+    values = array('d', [0.0]) * (width * len(raws))
+    for k, raw in enumerate(raws):
+        split_raw = findall(raw.lower())
+        if not split_raw:
+            line_commands.append(None)
+            flags.append(0)
+            continue
+        token = split_raw[0]
+        if token[0] == "n":
+            token = split_raw[1]
+        command, is_move = commands.get(token) or _command_info(token)
+        mask = TOKEN_IS_MOVE if is_move else 0
+        if command[:1] == "G":
+            base = width * k
+            for bit_code, bit_value in split_raw:
+                if bit_value and bit_code in slots:
+                    values[base + offsets[bit_code]] = float(bit_value)
+                    mask |= slots[bit_code]
+        line_commands.append(command)
+        flags.append(mask)
+    return line_commands, flags.tostring(), values.tostring()
+
+def raw_chunks(data, chunk_size):
+    """Yields lists of at most chunk_size stripped non blank lines"""
+    chunk = []
+    for l in data:
+        l = l.strip()
+        if not l:
+            continue
+        chunk.append(l)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def tokenized_chunks(chunks, processes = None):
+    """Yields (chunk, tokens) for each of the given chunks of raw lines,
+    tokens being meant to be passed to GCode._preprocess. If processes is
+    greater than 1, tokens are computed in a pool of that many processes,
+    with a bounded number of chunks in flight. Otherwise they come from
+    chunk_tokens."""
+    if not processes or processes <= 1:
+        for chunk in chunks:
+            yield chunk, chunk_tokens(chunk)
+        return
+    pool = multiprocessing.Pool(processes)
+    try:
+        pending = deque()
+        for chunk in chunks:
+            pending.append((chunk, pool.apply_async(_pool_tokenize_chunk, (chunk,))))
+            if len(pending) > 2 * processes:
+                chunk, result = pending.popleft()
+                yield chunk, _unpack_tokens(result.get())
+        while pending:
+            chunk, result = pending.popleft()
+            yield chunk, _unpack_tokens(result.get())
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def chunk_tokens(raws):
+    """Returns the tokens of the given raw lines computed by the compiled
+    tokenizer, or None if the gcoder_line extension isn't built, in which
+    case lines are tokenized by _preprocess itself"""
+    if compiled_tokenize_chunk is None:
+        return None
+    return _unpack_tokens(compiled_tokenize_chunk(raws))
+
+def _pool_tokenize_chunk(raws):
+    if compiled_tokenize_chunk is not None:
+        return compiled_tokenize_chunk(raws)
+    return _tokenize_chunk(raws)
+
+def _unpack_tokens(packed):
+    commands, flags, values = packed
+    flags_array = array('B')
+    flags_array.fromstring(flags)
+    values_array = array('d')
+    values_array.fromstring(values)
+    return commands, flags_array, values_array
 
 class PyLine(object):
 
@@ -50,8 +187,16 @@ class PyLine(object):
 try:
     import gcoder_line
     Line = gcoder_line.GLine
+    # Compiled version of _tokenize_chunk, missing from older builds
+    compiled_tokenize_chunk = getattr(gcoder_line, "tokenize_chunk", None)
 except ImportError:
     Line = PyLine
+    compiled_tokenize_chunk = None
+
+try:
+    import gcoder_kinematics
+except ImportError:
+    gcoder_kinematics = None
 
 def find_specific_code(line, code):
     exp = specific_exp % code
@@ -95,6 +240,31 @@ class Layer(list):
         super(Layer, self).__init__(lines)
         self.z = z
 
+class LayerHeightEstimator(object):
+    """Incremental estimate of the layer height of a file, from the Z of the
+    layers found so far: the estimate is the second gap between the sorted
+    layer Z values, so only the three lowest values need to be kept."""
+
+    __slots__ = ("lowest",)
+
+    def __init__(self):
+        self.lowest = []
+
+    def add(self, z):
+        if z is None:
+            return
+        lowest = self.lowest
+        if len(lowest) < 3 or z < lowest[-1]:
+            insort(lowest, z)
+            del lowest[3:]
+
+    def estimate(self):
+        zs = self.lowest
+        heights = [round(zs[k + 1] - zs[k], 3) for k in range(len(zs) - 1)]
+        if len(heights) >= 2: return heights[1]
+        elif heights: return heights[0]
+        else: return 0.1
+
 class GCode(object):
 
     lines = None
@@ -104,6 +274,8 @@ class GCode(object):
     line_idxs = None
     append_layer = None
     append_layer_id = None
+    # Path of the file the lines were read from, if known
+    filename = None
 
     imperial = False
     relative = False
@@ -136,6 +308,10 @@ class GCode(object):
     # current abs X from machine origin: current_x
     # current abs X in machine current coordinate system: current_x - offset_x
 
+    # Running extrusion total and its maximum, which is the filament length
+    total_e = 0
+    max_e = 0
+
     filament_length = None
     duration = None
     xmin = None
@@ -150,6 +326,12 @@ class GCode(object):
 
     est_layer_height = None
 
+    # gcoder_kinematics.KinematicProfile used to estimate durations, None
+    # for the default one
+    kinematic_profile = None
+    # gcoder_kinematics.MoveTable filled while loading
+    _moves = None
+
     # abs_x is the current absolute X in machine current coordinate system
     # (after the various G92 transformations) and can be used to store the
     # absolute position of the head at a given time
@@ -185,16 +367,27 @@ class GCode(object):
             self.home_x, self.home_y, self.home_z = home_pos
     home_pos = property(_get_home_pos, _set_home_pos)
 
-    def __init__(self, data = None, home_pos = None):
+    # Number of lines sent at once to the parsing processes
+    chunk_size = 4096
+
+    def __init__(self, data = None, home_pos = None, processes = None):
         self.home_pos = home_pos
-        if data:
+        if data and (processes > 1 or compiled_tokenize_chunk is not None):
+            self.lines = []
+            self._start_layers()
+            for raws, tokens in tokenized_chunks(raw_chunks(data, self.chunk_size),
+                                                 processes):
+                lines = [Line(raw) for raw in raws]
+                self.lines.extend(lines)
+                self._preprocess(lines, build_layers = True, tokens = tokens)
+            self._end_layers()
+        elif data:
             self.lines = [Line(l2) for l2 in
                           (l.strip() for l in data)
                           if l2]
-            self._preprocess_lines()
-            self.filament_length = self._preprocess_extrusion()
-            self._create_layers()
-            self._preprocess_layers()
+            self._start_layers()
+            self._preprocess(build_layers = True)
+            self._end_layers()
         else:
             self.lines = []
 
@@ -209,8 +402,7 @@ class GCode(object):
         if not command:
             return
         gline = Line(command)
-        self._preprocess_lines([gline])
-        self._preprocess_extrusion([gline])
+        self._preprocess([gline])
         if store:
             self.lines.append(gline)
             self.append_layer.append(gline)
@@ -218,9 +410,115 @@ class GCode(object):
             self.line_idxs.append(len(self.append_layer))
         return gline
 
-    def _preprocess_lines(self, lines = None):
-        """Checks for imperial/relativeness settings and tool changes"""
-        if not lines:
+    def append_parsed(self, gline):
+        """Updates the state like append(gline.raw, store = False) does, for
+        a gline already parsed by another GCode (typically the one being
+        printed), reusing its command and coordinates instead of tokenizing
+        it again. The coordinates are taken as already converted to mm.
+        gline is returned unchanged."""
+        command = gline.command
+        if not command:
+            return gline
+        code = command[0]
+        if gline.is_move:
+            x, y, z, e, f = gline.x, gline.y, gline.z, gline.e, gline.f
+            start_e = self.current_e
+            if f is not None:
+                self.current_f = f
+            if self.relative:
+                self.current_x += (x or 0)
+                self.current_y += (y or 0)
+                self.current_z += (z or 0)
+            else:
+                if x is not None: self.current_x = x + self.offset_x
+                if y is not None: self.current_y = y + self.offset_y
+                if z is not None: self.current_z = z + self.offset_z
+            if e is not None:
+                if self.relative_e:
+                    self.current_e += e
+                else:
+                    self.current_e = e + self.offset_e
+                self.total_e += self.current_e - start_e
+                if self.total_e > self.max_e:
+                    self.max_e = self.total_e
+        elif command == "G20":
+            self.imperial = True
+        elif command == "G21":
+            self.imperial = False
+        elif command == "G90":
+            self.relative = False
+            self.relative_e = False
+        elif command == "G91":
+            self.relative = True
+            self.relative_e = True
+        elif command == "M82":
+            self.relative_e = False
+        elif command == "M83":
+            self.relative_e = True
+        elif code == "T":
+            self.current_tool = int(command[1:])
+        elif command == "G28":
+            x, y, z = gline.x, gline.y, gline.z
+            home_all = not any([x, y, z])
+            if home_all or x is not None:
+                self.offset_x = 0
+                self.current_x = self.home_x
+            if home_all or y is not None:
+                self.offset_y = 0
+                self.current_y = self.home_y
+            if home_all or z is not None:
+                self.offset_z = 0
+                self.current_z = self.home_z
+        elif command == "G92":
+            if gline.x is not None: self.offset_x = self.current_x - gline.x
+            if gline.y is not None: self.offset_y = self.current_y - gline.y
+            if gline.z is not None: self.offset_z = self.current_z - gline.z
+            if gline.e is not None: self.offset_e = self.current_e - gline.e
+        return gline
+
+    def _start_layers(self):
+        """Resets the layer detection and bounding box state used by
+        _preprocess(build_layers = True)"""
+        self.total_e = 0
+        self.max_e = 0
+        self.all_layers = []
+        self.layer_idxs = array('I')
+        self.line_idxs = array('I')
+        # Layer detection state
+        self._layer_heights = LayerHeightEstimator()
+        self._line_count = 0
+        self._layer_ranges = {}
+        self._moving_zs = set()
+        self._layer_start = 0
+        self._layer_moving = False
+        self._layer_line = 0
+        self._last_layer_z = None
+        self._prev_z = None
+        self._prev_base_z = (None, None)
+        self._cur_z = None
+        # Moves used to estimate the durations
+        if gcoder_kinematics is not None:
+            self._moves = gcoder_kinematics.MoveTable()
+        # Bounding boxes of extruding moves and of all moves, the latter
+        # being used when the file does not extrude at all
+        inf = float("inf")
+        self._bbox_e = [inf, -inf, inf, -inf, 0, -inf]
+        self._bbox_all = [inf, -inf, inf, -inf, 0, -inf]
+
+    def _preprocess(self, lines = None, build_layers = False, tokens = None,
+                    zs = None):
+        """Analyzes lines in a single pass: each line is tokenized once, then
+        the imperial/relativeness settings, tool, position and extrusion are
+        updated and, if build_layers is set, the line is assigned to a layer
+        and accounted in the bounding box.
+        All the state is kept on self between calls, so that lines can be fed
+        in several batches.
+        tokens, if given, holds the results of _tokenize_chunk for lines,
+        which are then used instead of tokenizing the lines again.
+        zs, if given, is a list the Z of each line (in mm, None if unset) is
+        appended to, as the double used for the layers rather than the
+        single precision float the compiled Line stores."""
+        if lines is None:
             lines = self.lines
         imperial = self.imperial
         relative = self.relative
@@ -229,271 +527,437 @@ class GCode(object):
         current_x = self.current_x
         current_y = self.current_y
         current_z = self.current_z
+        current_f = self.current_f
         offset_x = self.offset_x
         offset_y = self.offset_y
         offset_z = self.offset_z
-
-        for line in lines:
-            split_raw = split(line)
-            if not line.command:
-                continue
-
-            # Update properties
-            if line.is_move:
-                line.relative = relative
-                line.relative_e = relative_e
-                line.current_tool = current_tool
-            elif line.command == "G20":
-                imperial = True
-            elif line.command == "G21":
-                imperial = False
-            elif line.command == "G90":
-                relative = False
-                relative_e = False
-            elif line.command == "G91":
-                relative = True
-                relative_e = True
-            elif line.command == "M82":
-                relative_e = False
-            elif line.command == "M83":
-                relative_e = True
-            elif line.command[0] == "T":
-                current_tool = int(line.command[1:])
-
-            if line.command[0] == "G":
-                parse_coordinates(line, split_raw, imperial)
-
-            # Compute current position
-            if line.is_move:
-                x = line.x
-                y = line.y
-                z = line.z
-
-                if line.f is not None:
-                    self.current_f = line.f
-
-                if line.relative:
-                    x = current_x + (x or 0)
-                    y = current_y + (y or 0)
-                    z = current_z + (z or 0)
-                else:
-                    if x is not None: x = x + offset_x
-                    if y is not None: y = y + offset_y
-                    if z is not None: z = z + offset_z
-
-                if x is not None: current_x = x
-                if y is not None: current_y = y
-                if z is not None: current_z = z
-
-            elif line.command == "G28":
-                home_all = not any([line.x, line.y, line.z])
-                if home_all or line.x is not None:
-                    offset_x = 0
-                    current_x = self.home_x
-                if home_all or line.y is not None:
-                    offset_y = 0
-                    current_y = self.home_y
-                if home_all or line.z is not None:
-                    offset_z = 0
-                    current_z = self.home_z
-
-            elif line.command == "G92":
-                if line.x is not None: offset_x = current_x - line.x
-                if line.y is not None: offset_y = current_y - line.y
-                if line.z is not None: offset_z = current_z - line.z
-
-            line.current_x = current_x
-            line.current_y = current_y
-            line.current_z = current_z
-        self.imperial = imperial
-        self.relative = relative
-        self.relative_e = relative_e
-        self.current_tool = current_tool
-        self.current_x = current_x
-        self.current_y = current_y
-        self.current_z = current_z
-        self.offset_x = offset_x
-        self.offset_y = offset_y
-        self.offset_z = offset_z
-
-    def _preprocess_extrusion(self, lines = None):
-        if not lines:
-            lines = self.lines
-
         current_e = self.current_e
         offset_e = self.offset_e
-        total_e = 0
-        max_e = 0
+        total_e = self.total_e
+        max_e = self.max_e
+        home_x, home_y, home_z = self.home_x, self.home_y, self.home_z
+
+        if build_layers:
+            all_layers = self.all_layers
+            layer_ranges = self._layer_ranges
+            moving_zs = self._moving_zs
+            layer_heights = self._layer_heights
+            layer_idxs_append = self.layer_idxs.append
+            line_idxs_append = self.line_idxs.append
+            line_count = self._line_count
+            layer_id = len(all_layers)
+            layer_start = self._layer_start
+            layer_moving = self._layer_moving
+            layer_line = self._layer_line
+            last_layer_z = self._last_layer_z
+            prev_z = self._prev_z
+            prev_base_z = self._prev_base_z
+            cur_z = self._cur_z
+            ex_xmin, ex_xmax, ex_ymin, ex_ymax, ex_zmin, ex_zmax = self._bbox_e
+            all_xmin, all_xmax, all_ymin, all_ymax, all_zmin, all_zmax = self._bbox_all
+            moves = self._moves
+            if moves is not None:
+                move_lines_append = moves.lines.append
+                move_values_extend = moves.values.extend
+                sync_commands = gcoder_kinematics.sync_commands
+        else:
+            moves = None
+
+        findall = gcode_exp.findall
+        commands = _command_cache
+        parsed_args = _parsed_args
+        if tokens is not None:
+            token_commands, token_flags, token_values = tokens
+            k = -1
 
         for line in lines:
-            if line.e is None:
-                continue
-            if line.is_move:
-                if line.relative_e:
-                    line.extruding = line.e > 0
-                    total_e += line.e
-                    current_e += line.e
+            # Tokenize
+            if tokens is None:
+                split_raw = findall(line.raw.lower())
+                if split_raw:
+                    token = split_raw[0]
+                    if token[0] == "n":
+                        token = split_raw[1]
+                    command, is_move = commands.get(token) or _command_info(token)
                 else:
-                    new_e = line.e + offset_e
-                    line.extruding = new_e > current_e
-                    total_e += new_e - current_e
-                    current_e = new_e
-                max_e = max(max_e, total_e)
-            elif line.command == "G92":
-                offset_e = current_e - line.e
-
-        self.current_e = current_e
-        self.offset_e = offset_e
-        return max_e
-
-    # FIXME : looks like this needs to be tested with list Z on move
-    def _create_layers(self):
-        layers = {}
-        all_layers = []
-        layer_idxs = []
-        line_idxs = []
-
-        layer_id = 0
-        layer_line = 0
-
-        last_layer_z = None
-        prev_z = None
-        prev_base_z = (None, None)
-        cur_z = None
-        cur_lines = []
-        for line in self.lines:
-            if line.command == "G92" and line.z is not None:
-                cur_z = line.z
-            elif line.is_move:
-                if line.z is not None:
-                    if line.relative:
-                        cur_z += line.z
+                    command = None
+            else:
+                k += 1
+                command = token_commands[k]
+                is_move = token_flags[k] >= TOKEN_IS_MOVE
+            if command is None:
+                command = line.raw
+                is_move = False
+                logging.warning(_("raw G-Code line \"%s\" could not be parsed") % line.raw)
+            line.command = command
+            line.is_move = is_move
+
+            extruding = False
+            x = y = z = e = f = None
+            if command:
+                code = command[0]
+                # Update properties
+                if is_move:
+                    line.relative = relative
+                    line.relative_e = relative_e
+                    line.current_tool = current_tool
+                elif command == "G20":
+                    imperial = True
+                elif command == "G21":
+                    imperial = False
+                elif command == "G90":
+                    relative = False
+                    relative_e = False
+                elif command == "G91":
+                    relative = True
+                    relative_e = True
+                elif command == "M82":
+                    relative_e = False
+                elif command == "M83":
+                    relative_e = True
+                elif code == "T":
+                    current_tool = int(command[1:])
+
+                if code == "G":
+                    # Parse coordinates, keeping the ones we need in locals
+                    # as reading unset attributes is slow on PyLine
+                    unit_factor = 25.4 if imperial else 1
+                    if tokens is None:
+                        for bit_code, bit_value in split_raw:
+                            if bit_value and bit_code in parsed_args:
+                                value = unit_factor * float(bit_value)
+                                setattr(line, bit_code, value)
+                                if bit_code == "x": x = value
+                                elif bit_code == "y": y = value
+                                elif bit_code == "e": e = value
+                                elif bit_code == "z": z = value
+                                elif bit_code == "f": f = value
                     else:
-                        cur_z = line.z
+                        # Coordinates were parsed by _tokenize_chunk, the
+                        # flag bits following the gcode_parsed_args order
+                        flags = token_flags[k]
+                        if flags & 0x7f:
+                            base = 7 * k
+                            if flags & 1:
+                                x = line.x = unit_factor * token_values[base]
+                            if flags & 2:
+                                y = line.y = unit_factor * token_values[base + 1]
+                            if flags & 4:
+                                e = line.e = unit_factor * token_values[base + 2]
+                            if flags & 8:
+                                f = line.f = unit_factor * token_values[base + 3]
+                            if flags & 16:
+                                z = line.z = unit_factor * token_values[base + 4]
+                            if flags & 32:
+                                line.i = unit_factor * token_values[base + 5]
+                            if flags & 64:
+                                line.j = unit_factor * token_values[base + 6]
+
+                    # Compute current position
+                    if is_move:
+                        start_x, start_y, start_z, start_e = \
+                            current_x, current_y, current_z, current_e
+                        if f is not None:
+                            current_f = f
+
+                        if relative:
+                            current_x += (x or 0)
+                            current_y += (y or 0)
+                            current_z += (z or 0)
+                        else:
+                            if x is not None: current_x = x + offset_x
+                            if y is not None: current_y = y + offset_y
+                            if z is not None: current_z = z + offset_z
+
+                    elif command == "G28":
+                        home_all = not any([x, y, z])
+                        if home_all or x is not None:
+                            offset_x = 0
+                            current_x = home_x
+                        if home_all or y is not None:
+                            offset_y = 0
+                            current_y = home_y
+                        if home_all or z is not None:
+                            offset_z = 0
+                            current_z = home_z
+
+                    elif command == "G92":
+                        if x is not None: offset_x = current_x - x
+                        if y is not None: offset_y = current_y - y
+                        if z is not None: offset_z = current_z - z
+
+                    # Compute extrusion
+                    if e is not None:
+                        if is_move:
+                            if relative_e:
+                                extruding = e > 0
+                                total_e += e
+                                current_e += e
+                            else:
+                                new_e = e + offset_e
+                                extruding = new_e > current_e
+                                total_e += new_e - current_e
+                                current_e = new_e
+                            line.extruding = extruding
+                            if total_e > max_e:
+                                max_e = total_e
+                        elif command == "G92":
+                            offset_e = current_e - e
+
+                # Record the move for the duration estimation
+                if moves is not None:
+                    if is_move:
+                        dx = current_x - start_x
+                        dy = current_y - start_y
+                        dz = current_z - start_z
+                        de = current_e - start_e
+                        if dx or dy or dz or de:
+                            if command == "G2" or command == "G3":
+                                moves.add_arc(line, start_x, start_y, dx, dy, dz)
+                            move_lines_append(line_count)
+                            move_values_extend((dx, dy, dz, de, current_f))
+                    elif command in sync_commands:
+                        moves.add_sync(line_count, line)
+
+                line.current_x = current_x
+                line.current_y = current_y
+                line.current_z = current_z
+
+            if zs is not None:
+                zs.append(z)
+            if not build_layers:
+                continue
 
-            # FIXME: the logic behind this code seems to work, but it might be
-            # broken
-            if cur_z != prev_z:
-                if prev_z is not None and last_layer_z is not None:
-                    offset = self.est_layer_height if self.est_layer_height else 0.01
-                    if abs(prev_z - last_layer_z) < offset:
-                        if self.est_layer_height is None:
-                            zs = sorted([l.z for l in all_layers if l.z is not None])
-                            heights = [round(zs[i + 1] - zs[i], 3) for i in range(len(zs) - 1)]
-                            if len(heights) >= 2: self.est_layer_height = heights[1]
-                            elif heights: self.est_layer_height = heights[0]
-                            else: self.est_layer_height = 0.1
-                        base_z = round(prev_z - (prev_z % self.est_layer_height), 2)
+            # Assign the line to a layer
+            # FIXME : looks like this needs to be tested with list Z on move
+            if command == "G92" and z is not None:
+                cur_z = z
+            elif is_move:
+                if z is not None:
+                    if relative:
+                        cur_z += z
                     else:
-                        base_z = round(prev_z, 2)
-                else:
-                    base_z = prev_z
+                        cur_z = z
 
+            if cur_z != prev_z:
+                base_z = self._layer_base_z(prev_z, last_layer_z, layer_heights)
                 if base_z != prev_base_z:
-                    all_layers.append(Layer(cur_lines, base_z))
-                    old_lines = layers.get(base_z, [])
-                    old_lines += cur_lines
-                    layers[base_z] = old_lines
-                    cur_lines = []
+                    all_layers.append(self._build_layer([(layer_start, line_count)], base_z))
+                    layer_heights.add(base_z)
+                    layer_ranges.setdefault(base_z, []).append((layer_start, line_count))
+                    if layer_moving:
+                        moving_zs.add(base_z)
+                    layer_start = line_count
+                    layer_moving = False
                     layer_id += 1
                     layer_line = 0
                     last_layer_z = base_z
 
                 prev_base_z = base_z
 
-            cur_lines.append(line)
-            layer_idxs.append(layer_id)
-            line_idxs.append(layer_line)
+            if is_move:
+                if e is not None:
+                    layer_moving = True
+                # Update the bounding boxes
+                if current_x < all_xmin: all_xmin = current_x
+                if current_x > all_xmax: all_xmax = current_x
+                if current_y < all_ymin: all_ymin = current_y
+                if current_y > all_ymax: all_ymax = current_y
+                if current_z < all_zmin: all_zmin = current_z
+                if current_z > all_zmax: all_zmax = current_z
+                if extruding:
+                    if current_x < ex_xmin: ex_xmin = current_x
+                    if current_x > ex_xmax: ex_xmax = current_x
+                    if current_y < ex_ymin: ex_ymin = current_y
+                    if current_y > ex_ymax: ex_ymax = current_y
+                    if current_z < ex_zmin: ex_zmin = current_z
+                    if current_z > ex_zmax: ex_zmax = current_z
+
+            layer_idxs_append(layer_id)
+            line_idxs_append(layer_line)
             layer_line += 1
+            line_count += 1
             prev_z = cur_z
 
-        if cur_lines:
-            all_layers.append(Layer(cur_lines, prev_z))
-            old_lines = layers.get(prev_z, [])
-            old_lines += cur_lines
-            layers[prev_z] = old_lines
-
-        for zindex in layers.keys():
-            cur_lines = layers[zindex]
-            has_movement = False
-            for l in layers[zindex]:
-                if l.is_move and l.e is not None:
-                    has_movement = True
-                    break
-            if has_movement:
-                layers[zindex] = Layer(cur_lines, zindex)
+        self.imperial = imperial
+        self.relative = relative
+        self.relative_e = relative_e
+        self.current_tool = current_tool
+        self.current_x = current_x
+        self.current_y = current_y
+        self.current_z = current_z
+        self.current_f = current_f
+        self.offset_x = offset_x
+        self.offset_y = offset_y
+        self.offset_z = offset_z
+        self.current_e = current_e
+        self.offset_e = offset_e
+        self.total_e = total_e
+        self.max_e = max_e
+
+        if build_layers:
+            self._line_count = line_count
+            self._layer_start = layer_start
+            self._layer_moving = layer_moving
+            self._layer_line = layer_line
+            self._last_layer_z = last_layer_z
+            self._prev_z = prev_z
+            self._prev_base_z = prev_base_z
+            self._cur_z = cur_z
+            self._bbox_e = [ex_xmin, ex_xmax, ex_ymin, ex_ymax, ex_zmin, ex_zmax]
+            self._bbox_all = [all_xmin, all_xmax, all_ymin, all_ymax, all_zmin, all_zmax]
+
+    # FIXME: the logic behind this code seems to work, but it might be
+    # broken
+    def _layer_base_z(self, prev_z, last_layer_z, layer_heights):
+        """Computes the Z of the layer the lines at prev_z belong to, when Z
+        changes from prev_z. last_layer_z is the Z of the last layer and
+        layer_heights the LayerHeightEstimator fed with the layers found so
+        far."""
+        if prev_z is not None and last_layer_z is not None:
+            offset = self.est_layer_height if self.est_layer_height else 0.01
+            if abs(prev_z - last_layer_z) < offset:
+                if self.est_layer_height is None:
+                    self.est_layer_height = layer_heights.estimate()
+                return round(prev_z - (prev_z % self.est_layer_height), 2)
             else:
-                del layers[zindex]
+                return round(prev_z, 2)
+        return prev_z
+
+    def _end_layers(self):
+        """Closes the last layer, then builds the per-Z layers, the append
+        layer and the bounding box from the state accumulated by
+        _preprocess(build_layers = True)"""
+        all_layers = self.all_layers
+        layer_ranges = self._layer_ranges
+        if self._layer_start < self._line_count:
+            last_range = (self._layer_start, self._line_count)
+            all_layers.append(self._build_layer([last_range], self._prev_z))
+            layer_ranges.setdefault(self._prev_z, []).append(last_range)
+            if self._layer_moving:
+                self._moving_zs.add(self._prev_z)
+
+        self.layers = self._merge_layers(layer_ranges, self._moving_zs)
 
         self.append_layer_id = len(all_layers)
         self.append_layer = Layer([])
         all_layers.append(self.append_layer)
-        self.all_layers = all_layers
-        self.layers = layers
-        self.layer_idxs = array('I', layer_idxs)
-        self.line_idxs = array('I', line_idxs)
+        self.filament_length = self.max_e
+
+        # Count moves without extrusion if filament length is lower than 0
+        if self.filament_length <= 0:
+            bbox = self._bbox_all
+        else:
+            bbox = self._bbox_e
+        bbox = [value if not math.isinf(value) else 0 for value in bbox]
+        self.xmin, self.xmax, self.ymin, self.ymax, self.zmin, self.zmax = bbox
+        self.width = self.xmax - self.xmin
+        self.depth = self.ymax - self.ymin
+        self.height = self.zmax - self.zmin
+        del self._layer_ranges, self._moving_zs, self._layer_heights
+
+    def _build_layer(self, ranges, z):
+        """Builds a Layer holding the lines found in the given list of
+        (start, end) index ranges of self.lines"""
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            return Layer(self.lines[start:end], z)
+        return Layer([line for start, end in ranges
+                      for line in self.lines[start:end]], z)
+
+    def _merge_layers(self, layer_ranges, moving_zs):
+        """Builds the dict of layers indexed by Z, merging all the lines
+        found at a given Z and skipping the Z without any extrusion move"""
+        return dict((zindex, self._build_layer(ranges, zindex))
+                    for zindex, ranges in layer_ranges.items()
+                    if zindex in moving_zs)
 
     def idxs(self, i):
         return self.layer_idxs[i], self.line_idxs[i]
 
+    def layer_line(self, i):
+        """Returns the index of the layer of line i and the line, or None if
+        there are no more lines; this is how printcore reads the lines to
+        print"""
+        line_idxs = self.line_idxs
+        if line_idxs is None or i >= len(line_idxs):
+            return None
+        layer = self.layer_idxs[i]
+        return layer, self.all_layers[layer][line_idxs[i]]
+
+    def checkpoint(self, i):
+        """Returns (offset, state) to read the lines again from line i
+        without parsing the lines preceding it (see GCodeStream): the
+        offset of line i in the file and the analyzer state before it, as a
+        dict. Returns None when unknown, which is always the case for GCode
+        as the lines are not read from a file"""
+        return None
+
     def num_layers(self):
         return len(self.layers)
 
-    def _preprocess_layers(self):
-        xmin = float("inf")
-        ymin = float("inf")
-        zmin = 0
-        xmax = float("-inf")
-        ymax = float("-inf")
-        zmax = float("-inf")
-
-        # Count moves without extrusion if filament length is lower than 0
-        count_noe = self.filament_length <= 0
-
-        for line in self.lines:
-            if line.is_move and (line.extruding or count_noe):
-                if line.current_x is not None:
-                    xmin = min(xmin, line.current_x)
-                    xmax = max(xmax, line.current_x)
-                if line.current_y is not None:
-                    ymin = min(ymin, line.current_y)
-                    ymax = max(ymax, line.current_y)
-                if line.current_z is not None:
-                    zmin = min(zmin, line.current_z)
-                    zmax = max(zmax, line.current_z)
-
-        self.xmin = xmin if not math.isinf(xmin) else 0
-        self.xmax = xmax if not math.isinf(xmax) else 0
-        self.ymin = ymin if not math.isinf(ymin) else 0
-        self.ymax = ymax if not math.isinf(ymax) else 0
-        self.zmin = zmin if not math.isinf(zmin) else 0
-        self.zmax = zmax if not math.isinf(zmax) else 0
-        self.width = self.xmax - self.xmin
-        self.depth = self.ymax - self.ymin
-        self.height = self.zmax - self.zmin
-
     def estimate_duration(self):
         if self.duration is not None:
             return self.duration
-        lastx = lasty = lastz = laste = lastf = 0.0
-        lastdx = 0
-        lastdy = 0
-        x = y = e = f = 0.0
+        if self._moves is not None:
+            totalduration = self._estimate_kinematic_duration()
+        else:
+            totalduration = self._estimate_layers_duration(self.all_layers)
+        totaltime = datetime.timedelta(seconds = int(totalduration))
+        self.duration = totaltime
+        return "%d layers, %s" % (len(self.layers), str(totaltime))
+
+    def set_kinematic_profile(self, profile):
+        """Sets the gcoder_kinematics.KinematicProfile used to estimate
+        durations, updating the estimates already made"""
+        self.kinematic_profile = profile
+        if self.duration is not None and self._moves is not None:
+            totalduration = self._estimate_kinematic_duration()
+            self.duration = datetime.timedelta(seconds = int(totalduration))
+
+    def _estimate_kinematic_duration(self):
+        """Estimates the duration of each layer with gcoder_kinematics from
+        the moves recorded while loading, and returns the total estimated
+        duration"""
+        layers = self.all_layers[:self.append_layer_id]
+        bounds = [0]
+        for layer in layers:
+            bounds.append(bounds[-1] + len(layer))
+        moves = self._moves
+        durations = gcoder_kinematics.layer_durations(
+            moves, gcoder_kinematics.plan(moves, self.kinematic_profile), bounds)
+        for layer, duration in zip(layers, durations):
+            layer.duration = float(duration)
+        self.append_layer.duration = 0
+        return float(durations.sum())
+
+    # State of the duration estimation, kept between calls to
+    # _estimate_layers_duration: lastx, lasty, lastz, laste, lastf, lastdx,
+    # lastdy and totalduration
+    _duration_state = (0.0, 0.0, 0.0, 0.0, 0.0, 0, 0, 0.0)
+
+    def _estimate_layers_duration(self, layers):
+        """Estimates the duration of each of the given layers, continuing
+        from the previous call, and returns the total estimated duration.
+        This is the simple estimator used when NumPy isn't available."""
+        lastx, lasty, lastz, laste, lastf, lastdx, lastdy, totalduration = \
+            self._duration_state
+        x, y, z, e, f = lastx, lasty, lastz, laste, lastf
         currenttravel = 0.0
         moveduration = 0.0
-        totalduration = 0.0
         acceleration = 2000.0  # mm/s^2
-        layerbeginduration = 0.0
+        layerbeginduration = totalduration
         #TODO:
         # get device caps from firmware: max speed, acceleration/axis
         # (including extruder)
         # calculate the maximum move duration accounting for above ;)
-        for layer in self.all_layers:
+        for layer in layers:
             for line in layer:
                 if line.command not in ["G1", "G0", "G4"]:
                     continue
                 if line.command == "G4":
-                    moveduration = line.p
+                    # GLine has no p field, PyLine returns None for it
+                    moveduration = getattr(line, "p", None)
                     if not moveduration:
                         continue
                     else:
@@ -562,9 +1026,702 @@ class GCode(object):
             layer.duration = totalduration - layerbeginduration
             layerbeginduration = totalduration
 
-        totaltime = datetime.timedelta(seconds = int(totalduration))
-        self.duration = totaltime
-        return "%d layers, %s" % (len(self.layers), str(totaltime))
+        self._duration_state = (lastx, lasty, lastz, laste, lastf,
+                                lastdx, lastdy, totalduration)
+        return totalduration
+
+class LayerSummary(object):
+    """Summary of a layer emitted by StreamingGCode once the layer is over:
+    its index in all_layers, Z, [start, end) line numbers and estimated
+    duration"""
+
+    __slots__ = ("index", "z", "start", "end", "duration")
+
+    def __init__(self, index, z, start, end, duration):
+        self.index = index
+        self.z = z
+        self.start = start
+        self.end = end
+        self.duration = duration
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __repr__(self):
+        return "<LayerSummary %d: Z=%s, lines %d-%d, %ss>" \
+            % (self.index, self.z, self.start, self.end, self.duration)
+
+class StreamingGCode(GCode):
+    """GCode analyzer consuming lines from an iterable without keeping them.
+
+    analyze() is a generator yielding ("line", line) for each parsed line
+    and ("layer", LayerSummary) each time a layer is over. Only the lines of
+    the current layer are held in memory. Once the generator is exhausted,
+    filament_length, the bounding box, all_layers (as LayerSummary objects),
+    layers (Z -> list of LayerSummary) and duration match what GCode would
+    compute on the same data. If processes is greater than 1, lines are
+    tokenized in that many worker processes.
+
+    With gcoder_kinematics, durations are estimated once all the moves are
+    known: the duration of the LayerSummary objects is None until the
+    generator is exhausted. The moves are then kept, so that
+    set_kinematic_profile() can update the estimates."""
+
+    chunk_size = 1024
+
+    def __init__(self, home_pos = None, processes = None):
+        self.home_pos = home_pos
+        self.processes = processes
+        self.lines = None
+
+    def analyze(self, data):
+        self._start_layers()
+        # Only keep the last layer and line indices
+        self.layer_idxs = deque(maxlen = 1)
+        self.line_idxs = deque(maxlen = 1)
+        self._pending = []
+        self._pending_start = 0
+        self._finished = deque()
+        for raws, tokens in tokenized_chunks(raw_chunks(data, self.chunk_size),
+                                             self.processes):
+            chunk = [Line(raw) for raw in raws]
+            for event in self._analyze_chunk(chunk, tokens):
+                yield event
+        self._end_layers()
+        for event in self._flush_layers(None):
+            yield event
+        if self._moves is not None:
+            total = self._estimate_kinematic_duration()
+        else:
+            total = self._estimate_layers_duration([])
+        self.duration = datetime.timedelta(seconds = int(total))
+        del self._pending, self._finished
+
+    def _analyze_chunk(self, chunk, tokens = None):
+        first = self._line_count
+        self._pending.extend(chunk)
+        self._preprocess(chunk, build_layers = True, tokens = tokens)
+        for i, line in enumerate(chunk):
+            for event in self._flush_layers(first + i):
+                yield event
+            yield ("line", line)
+
+    def _flush_layers(self, line_number):
+        finished = self._finished
+        while finished and (line_number is None
+                            or finished[0].end <= line_number):
+            yield ("layer", finished.popleft())
+
+    def _build_layer(self, ranges, z):
+        (start, end), = ranges
+        pending_start = self._pending_start
+        layer = Layer(self._pending[start - pending_start:end - pending_start], z)
+        del self._pending[:end - pending_start]
+        self._pending_start = end
+        duration = None
+        if gcoder_kinematics is None:
+            self._estimate_layers_duration([layer])
+            duration = layer.duration
+        summary = LayerSummary(len(self.all_layers), z, start, end, duration)
+        self._finished.append(summary)
+        return summary
+
+    def _merge_layers(self, layer_ranges, moving_zs):
+        layers = {}
+        for summary in self.all_layers:
+            if summary.z in moving_zs:
+                layers.setdefault(summary.z, []).append(summary)
+        return layers
+
+    def estimate_duration(self):
+        return "%d layers, %s" % (len(self.layers), str(self.duration))
+
+class MappedLayer(object):
+    """Layer-like view over lines [start, end) of a MappedGCode. Lines are
+    parsed when accessed, and the duration is only estimated when first
+    read."""
+
+    __slots__ = ("gcode", "start", "end", "z", "_duration")
+
+    def __init__(self, gcode, start, end, z = None):
+        self.gcode = gcode
+        self.start = start
+        self.end = end
+        self.z = z
+        self._duration = None
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, idx):
+        length = self.end - self.start
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(length)
+            if step == 1:
+                return list(self.gcode._iter_lines(self.start + start,
+                                                   self.start + max(start, stop)))
+            return [self[i] for i in xrange(start, stop, step)]
+        if idx < 0:
+            idx += length
+        if idx < 0 or idx >= length:
+            raise IndexError("layer index out of range")
+        return self.gcode._line(self.start + idx)
+
+    def __iter__(self):
+        return self.gcode._iter_lines(self.start, self.end)
+
+    def _get_duration(self):
+        if self._duration is None:
+            self.gcode._analyze()
+        return self._duration
+
+    def _set_duration(self, duration):
+        self._duration = duration
+    duration = property(_get_duration, _set_duration)
+
+class MappedLines(object):
+    """Sequence of the lines of a MappedGCode. Lines appended after loading
+    are regular line objects kept in a side list."""
+
+    def __init__(self, gcode):
+        self.gcode = gcode
+        self.extra = []
+
+    def __len__(self):
+        return len(self.gcode.offsets) + len(self.extra)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in xrange(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError("line index out of range")
+        mapped = len(self.gcode.offsets)
+        if idx < mapped:
+            return self.gcode._line(idx)
+        return self.extra[idx - mapped]
+
+    def __iter__(self):
+        for line in self.gcode._iter_lines(0, len(self.gcode.offsets)):
+            yield line
+        for line in self.extra:
+            yield line
+
+    def append(self, line):
+        self.extra.append(line)
+
+def _analysis_property(name):
+    def getter(self):
+        if self._analysis is None:
+            self._analyze()
+        return self._analysis[name]
+    return property(getter)
+
+class MappedGCode(GCode):
+    """GCode variant for huge files, which mmaps the file instead of reading
+    it.
+
+    Loading only builds the offsets of the lines in the file, the layers
+    and the layer_idxs/line_idxs arrays: the lines which may change Z are
+    the only ones parsed at this point. Other lines are parsed chunk by chunk
+    when accessed, starting from the analyzer state saved at the beginning
+    of the chunk, and only the cache_size most recently used chunks are
+    kept. Attributes describing the whole file (filament_length, bounding
+    box, layers, duration) are computed by a StreamingGCode pass the first
+    time one of them is read; layers then maps Z to lists of MappedLayer.
+
+    As lines may be parsed several times, attributes set on them only live
+    as long as their chunk stays cached, except for gcview_end_vertex which
+    is saved when a chunk is dropped. Unlike files opened in universal
+    newlines mode, lines must be separated by "\n" or "\r\n".
+
+    The index built at load time and the analysis results can be retrieved
+    with dump_index() and passed back as the index argument to reload the
+    same file without parsing it (see gcoder_cache). processes is passed to
+    the StreamingGCode analyzer."""
+
+    chunk_size = 1024
+    cache_size = 64
+
+    layers = _analysis_property("layers")
+    filament_length = _analysis_property("filament_length")
+    duration = _analysis_property("duration")
+    xmin = _analysis_property("xmin")
+    xmax = _analysis_property("xmax")
+    ymin = _analysis_property("ymin")
+    ymax = _analysis_property("ymax")
+    zmin = _analysis_property("zmin")
+    zmax = _analysis_property("zmax")
+    width = _analysis_property("width")
+    depth = _analysis_property("depth")
+    height = _analysis_property("height")
+
+    def __init__(self, filename, home_pos = None, index = None,
+                 processes = None):
+        self.home_pos = home_pos
+        self.filename = filename
+        self.processes = processes
+        with open(filename, "rb") as f:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files can't be mapped
+                self._map = None
+        self.lines = MappedLines(self)
+        self._analysis = None
+        self._parser = GCode(None, home_pos)
+        self._snapshots = [self._save_state(self._parser)]
+        self._chunks = OrderedDict()
+        self._end_vertices = {}
+        # Guards the parser, snapshots and chunk cache, as the file is read
+        # by the print thread along with the viewer and status threads
+        self._chunk_lock = Lock()
+        if index is not None:
+            self._load_index(index)
+        else:
+            self._scan_lines()
+            self._scan_layers()
+
+    def _save_state(self, analyzer):
+        return tuple(getattr(analyzer, name) for name in _analyzer_state)
+
+    def _restore_state(self, analyzer, state):
+        for name, value in zip(_analyzer_state, state):
+            setattr(analyzer, name, value)
+
+    def _raw(self, n):
+        """Returns the stripped text of line n"""
+        start = self.offsets[n]
+        end = self._map.find("\n", start)
+        if end < 0:
+            end = len(self._map)
+        return self._map[start:end].strip()
+
+    def _raw_lines(self):
+        if self._map is None:
+            return iter([])
+        self._map.seek(0)
+        return iter(self._map.readline, "")
+
+    def _scan_lines(self):
+        """Builds the offsets of the non blank lines"""
+        self.offsets = array('L')
+        append = self.offsets.append
+        pos = 0
+        for line in self._raw_lines():
+            if not line.isspace():
+                append(pos)
+            pos += len(line)
+
+    def _scan_layers(self):
+        """Finds the layers by parsing the lines which may change Z, using
+        the same detection logic as _preprocess(build_layers = True)"""
+        offsets = self.offsets
+        all_layers = self.all_layers = []
+        self.layer_idxs = array('I')
+        self.line_idxs = array('I')
+        scanner = GCode(None, self.home_pos)
+        layer_heights = LayerHeightEstimator()
+        layer_start = 0
+        last_layer_z = None
+        prev_z = None
+        prev_base_z = (None, None)
+        cur_z = None
+        for n, line, z in self._parsed_candidates(scanner):
+            if line.command == "G92" and z is not None:
+                cur_z = z
+            elif line.is_move:
+                if z is not None:
+                    if line.relative:
+                        cur_z += z
+                    else:
+                        cur_z = z
+
+            if cur_z != prev_z:
+                base_z = self._layer_base_z(prev_z, last_layer_z, layer_heights)
+                if base_z != prev_base_z:
+                    self._add_layer(layer_start, n, base_z)
+                    layer_heights.add(base_z)
+                    layer_start = n
+                    last_layer_z = base_z
+                prev_base_z = base_z
+            prev_z = cur_z
+        if layer_start < len(offsets):
+            self._add_layer(layer_start, len(offsets), prev_z)
+
+        self.append_layer_id = len(all_layers)
+        self.append_layer = Layer([])
+        all_layers.append(self.append_layer)
+
+    def _parsed_candidates(self, scanner, batch_size = 4096):
+        """Yields (index, line, z) for the lines which may change Z, parsed by
+        scanner in batches, z being the Z of the line as parsed by
+        _preprocess"""
+        candidates = self._layer_candidates()
+        for start in xrange(0, len(candidates), batch_size):
+            batch = candidates[start:start + batch_size]
+            raws = [self._raw(n) for n in batch]
+            lines = [Line(raw) for raw in raws]
+            zs = []
+            scanner._preprocess(lines, tokens = chunk_tokens(raws), zs = zs)
+            for item in zip(batch, lines, zs):
+                yield item
+
+    def _layer_candidates(self):
+        """Returns the sorted indices of the lines which may change Z"""
+        candidates = set()
+        if self._map is None:
+            return []
+        find = self._map.find
+        offsets = self.offsets
+        for needle in _layer_candidate_needles:
+            pos = find(needle, 0)
+            while pos >= 0:
+                candidates.add(bisect_right(offsets, pos) - 1)
+                pos = find(needle, pos + 1)
+        return sorted(candidates)
+
+    def _add_layer(self, start, end, z):
+        self.layer_idxs.extend(array('I', [len(self.all_layers)]) * (end - start))
+        self.line_idxs.extend(array('I', xrange(end - start)))
+        self.all_layers.append(MappedLayer(self, start, end, z))
+
+    def dump_index(self):
+        """Returns the line offsets, layer table and analysis results as a
+        dict of arrays and plain values, or None if the analysis did not
+        give every layer a duration (the layers it found not matching the
+        ones found at load time), as such an index could not be reloaded"""
+        if self._analysis is None:
+            self._analyze()
+        count = len(self.offsets)
+        layers = self.all_layers[:self.append_layer_id]
+        if any(layer._duration is None for layer in layers):
+            return None
+        layer_ids = dict((id(layer), i) for i, layer in enumerate(layers))
+        analysis = dict(self._analysis)
+        analysis["duration"] = int(analysis["duration"].total_seconds())
+        analysis["layers"] = dict((z, [layer_ids[id(layer)] for layer in zlayers])
+                                  for z, zlayers in analysis["layers"].items())
+        return {"offsets": self.offsets,
+                "layer_idxs": self.layer_idxs[:count],
+                "line_idxs": self.line_idxs[:count],
+                "layer_starts": array('L', [layer.start for layer in layers]),
+                "layer_durations": array('d', [layer.duration for layer in layers]),
+                "layer_zs": [layer.z for layer in layers],
+                "est_layer_height": self.est_layer_height,
+                "state": self._save_state(self),
+                "analysis": analysis}
+
+    def _load_index(self, index):
+        self.offsets = index["offsets"]
+        self.layer_idxs = index["layer_idxs"]
+        self.line_idxs = index["line_idxs"]
+        self.est_layer_height = index["est_layer_height"]
+        starts = index["layer_starts"]
+        ends = list(starts[1:]) + [len(self.offsets)]
+        all_layers = self.all_layers = []
+        for start, end, z, duration in zip(starts, ends, index["layer_zs"],
+                                           index["layer_durations"]):
+            layer = MappedLayer(self, start, end, z)
+            layer.duration = duration
+            all_layers.append(layer)
+        self.append_layer_id = len(all_layers)
+        self.append_layer = Layer([])
+        self.append_layer.duration = 0
+        all_layers.append(self.append_layer)
+        analysis = dict(index["analysis"])
+        analysis["duration"] = datetime.timedelta(seconds = analysis["duration"])
+        analysis["layers"] = dict((z, [all_layers[i] for i in ids])
+                                  for z, ids in analysis["layers"].items())
+        self._analysis = analysis
+        self._restore_state(self, index["state"])
+
+    def _chunk(self, index):
+        """Returns the parsed lines of the given chunk, parsing it and the
+        chunks preceding it which have never been parsed if needed"""
+        with self._chunk_lock:
+            chunks = self._chunks
+            lines = chunks.pop(index, None)
+            if lines is None:
+                snapshots = self._snapshots
+                parser = self._parser
+                first = min(index, len(snapshots) - 1)
+                self._restore_state(parser, snapshots[first])
+                for i in xrange(first, index + 1):
+                    start = i * self.chunk_size
+                    end = min(start + self.chunk_size, len(self.offsets))
+                    raws = [self._raw(n) for n in xrange(start, end)]
+                    lines = [Line(raw) for raw in raws]
+                    parser._preprocess(lines, tokens = chunk_tokens(raws))
+                    if i + 1 == len(snapshots):
+                        snapshots.append(self._save_state(parser))
+                end_vertices = self._end_vertices.get(index)
+                if end_vertices is not None:
+                    for line, vertex in zip(lines, end_vertices):
+                        if vertex >= 0:
+                            line.gcview_end_vertex = vertex
+                if len(chunks) >= self.cache_size:
+                    self._drop_chunk(*chunks.popitem(last = False))
+            chunks[index] = lines
+            return lines
+
+    def _drop_chunk(self, index, lines):
+        """Saves the vertices set by the viewers on the lines of a chunk
+        which is being dropped from the cache"""
+        end_vertices = [line.gcview_end_vertex for line in lines]
+        if any(vertex is not None for vertex in end_vertices):
+            self._end_vertices[index] = array('l', [vertex if vertex is not None
+                                                    else -1
+                                                    for vertex in end_vertices])
+
+    def _line(self, n):
+        index, offset = divmod(n, self.chunk_size)
+        return self._chunk(index)[offset]
+
+    def checkpoint(self, i):
+        if self._map is None or i >= len(self.offsets):
+            return None
+        index = i // self.chunk_size
+        # Parsing the chunk saves the state at its start if not known yet
+        self._chunk(index)
+        start = index * self.chunk_size
+        raws = [self._raw(n) for n in xrange(start, i)]
+        return self.offsets[i], _state_after(self._snapshots[index], raws,
+                                             self.home_pos)
+
+    def _iter_lines(self, start, end):
+        chunk_size = self.chunk_size
+        while start < end:
+            index = start // chunk_size
+            first = index * chunk_size
+            stop = min(end, first + chunk_size)
+            for line in self._chunk(index)[start - first:stop - first]:
+                yield line
+            start = stop
+
+    def _analyze(self):
+        """Computes the attributes describing the whole file"""
+        analyzer = StreamingGCode(self.home_pos, self.processes)
+        analyzer.kinematic_profile = self.kinematic_profile
+        all_layers = self.all_layers
+        for event in analyzer.analyze(self._raw_lines()):
+            pass
+        if len(analyzer.all_layers) != len(all_layers):
+            logging.warning(_("Layer detection mismatch in %s") % self.filename)
+        for summary in analyzer.all_layers[:analyzer.append_layer_id]:
+            if summary.index < self.append_layer_id:
+                all_layers[summary.index].duration = summary.duration
+        self._moves = analyzer._moves
+        layers = dict((z, [all_layers[summary.index] for summary in summaries])
+                      for z, summaries in analyzer.layers.items())
+        self._analysis = dict((name, getattr(analyzer, name))
+                              for name in ("filament_length", "duration",
+                                           "xmin", "xmax", "ymin", "ymax",
+                                           "zmin", "zmax",
+                                           "width", "depth", "height"))
+        self._analysis["layers"] = layers
+        self.append_layer.duration = 0
+        # Lines appended afterwards are analyzed from the end of file state
+        if not self.lines.extra:
+            self._restore_state(self, self._save_state(analyzer))
+
+    def append(self, command, store = True):
+        if self._analysis is None:
+            self._analyze()
+        return super(MappedGCode, self).append(command, store)
+
+    def estimate_duration(self):
+        return "%d layers, %s" % (len(self.layers), str(self.duration))
+
+    def set_kinematic_profile(self, profile):
+        self.kinematic_profile = profile
+        if self._analysis is None:
+            return
+        if self._moves is not None:
+            totalduration = self._estimate_kinematic_duration()
+            self._analysis["duration"] = \
+                datetime.timedelta(seconds = int(totalduration))
+        else:
+            # The analysis comes from an index: it will be done again when
+            # needed
+            self._analysis = None
+            for layer in self.all_layers[:self.append_layer_id]:
+                layer.duration = None
+
+class GCodeStream(GCode):
+    """Lines to print read lazily from a file, or from an iterable of lines,
+    so that printcore can start printing right away with a flat memory use,
+    whatever the size of the file.
+
+    Lines are parsed chunk by chunk as printcore asks for them, which keeps
+    track of the position (used when pausing) and of the layers: a layer
+    starts with the first extruding move at another height. Only the behind
+    lines preceding the last line asked for are kept; going back further,
+    e.g. to print again, reads the file again from its start, which is not
+    possible with other iterables. The number of lines is estimated from
+    the size of the file until it was read entirely. Neither all_layers
+    nor the dimensions or duration of the print are computed.
+
+    A stream can also start in the middle of a file, from a line returned
+    by the checkpoint method of a GCode read from the same file: index is
+    then the index of that line, offset its offset in the file, state the
+    analyzer state before it and layer the index of its layer. Lines before
+    index are not available."""
+
+    chunk_size = 256
+    behind = 1024
+
+    def __init__(self, data, home_pos = None, index = 0, offset = 0,
+                 state = None, layer = 0):
+        self.home_pos = home_pos
+        if state is None:
+            state = dict((name, getattr(self, name))
+                         for name in _analyzer_state)
+        self._initial_state = tuple(state[name] for name in _analyzer_state)
+        self._start = (index, offset, layer)
+        self._appended = []  # commands to print once the data is read
+        self._file = None
+        if isinstance(data, basestring):
+            self.filename = data
+            self.size = os.path.getsize(data)
+        else:
+            self.filename = None
+            self.size = None
+            self._source = iter(data)
+        self._rewind()
+
+    def _rewind(self):
+        """Starts reading the data again from its start"""
+        if self.filename is not None:
+            if self._file is not None:
+                self._file.close()
+            self._file = self._source = open(self.filename, "rb")
+        index, offset, layer = self._start
+        if offset and self.filename is not None:
+            self._file.seek(offset)
+        for name, value in zip(_analyzer_state, self._initial_state):
+            setattr(self, name, value)
+        self._lines = deque()
+        self._layers = deque()  # layer index of each of the kept lines
+        self._offsets = deque()  # offset in the file of each of the kept
+                                 # lines, None for the appended ones
+        self._states = deque()  # (index of its first line, analyzer state
+                                # before it) of the chunks of kept lines
+        self._first = index  # index of the first kept line
+        self._count = index  # index of the next line to read
+        self._bytes = offset  # offset of the next line to read
+        self._exhausted = False
+        self._layer = layer
+        self._layer_z = None
+
+    def _read_chunk(self):
+        """Reads and parses the next lines, returning False if there are no
+        more"""
+        raws = []
+        offsets = []
+        if not self._exhausted:
+            size = self._bytes
+            for raw in self._source:
+                start = size
+                size += len(raw)
+                raw = raw.strip()
+                if raw:
+                    raws.append(raw)
+                    offsets.append(start)
+                    if len(raws) == self.chunk_size:
+                        break
+            else:
+                self._exhausted = True
+            self._bytes = size
+        if self._exhausted:
+            raws.extend(self._appended)
+            offsets.extend([None] * len(self._appended))
+            del self._appended[:]
+        if not raws:
+            return False
+        self._states.append((self._count,
+                             tuple(getattr(self, name)
+                                   for name in _analyzer_state)))
+        self._offsets.extend(offsets)
+        lines = [Line(raw) for raw in raws]
+        self._preprocess(lines, tokens = chunk_tokens(raws))
+        layer, layer_z = self._layer, self._layer_z
+        layers_append = self._layers.append
+        for line in lines:
+            if line.is_move and line.extruding and line.current_z != layer_z:
+                if layer_z is not None:
+                    layer += 1
+                layer_z = line.current_z
+            layers_append(layer)
+        self._layer, self._layer_z = layer, layer_z
+        self._lines.extend(lines)
+        self._count += len(lines)
+        return True
+
+    def layer_line(self, i):
+        if i < self._first:
+            if i < self._start[0]:
+                return None
+            if self.filename is None:
+                raise IndexError(_("Line %d was dropped and can not be read again") % i)
+            self._rewind()
+        while i >= self._count:
+            if not self._read_chunk():
+                return None
+        lines = self._lines
+        layers = self._layers
+        offsets = self._offsets
+        while self._first < i - self.behind:
+            lines.popleft()
+            layers.popleft()
+            offsets.popleft()
+            self._first += 1
+        states = self._states
+        while len(states) > 1 and states[1][0] <= self._first:
+            states.popleft()
+        return layers[i - self._first], lines[i - self._first]
+
+    def checkpoint(self, i):
+        if self.filename is None or self.layer_line(i) is None:
+            return None
+        offset = self._offsets[i - self._first]
+        if offset is None:
+            return None
+        for start, state in reversed(self._states):
+            if start <= i:
+                break
+        if start < self._first:
+            # Lines of the chunk were dropped
+            return None
+        raws = [self._lines[n - self._first].raw for n in xrange(start, i)]
+        return offset, _state_after(state, raws, self.home_pos)
+
+    def append(self, command, store = True):
+        """Queues command to be printed after the lines of the data"""
+        command = command.strip()
+        if command:
+            self._appended.append(command)
+
+    def __len__(self):
+        count = self._count + len(self._appended)
+        if self._exhausted or not self.size or not self._bytes:
+            return count
+        return max(count + 1, int(count * float(self.size) / self._bytes))
+
+    def __iter__(self):
+        i = 0
+        while True:
+            item = self.layer_line(i)
+            if item is None:
+                return
+            yield item[1]
+            i += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
 
 def main():
     if len(sys.argv) < 2:
@@ -572,7 +1729,9 @@ def main():
         return
 
     print "Line object size:", sys.getsizeof(Line("G0 X0"))
-    gcode = GCode(open(sys.argv[1], "rU"))
+    gcode = StreamingGCode()
+    for event in gcode.analyze(open(sys.argv[1], "rU")):
+        pass
 
     print "Dimensions:"
     xdims = (gcode.xmin, gcode.xmax, gcode.width)
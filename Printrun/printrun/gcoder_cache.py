@@ -0,0 +1,192 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# On-disk cache of G-code analysis results. Each analyzed file gets a binary
+# sidecar holding the index of a gcoder.MappedGCode (line offsets, layer
+# table, layer_idxs/line_idxs, per-layer durations, bounding box...), so
+# that reopening an unchanged file skips both the parsing and the duration
+# estimation.
+#
+# Sidecar layout: a header (magic, version, array item size, length of the
+# metadata), the metadata as a marshal dump, then the raw arrays in the order
+# given by the metadata.
+
+import os
+import errno
+import struct
+import marshal
+import hashlib
+import logging
+import tempfile
+import traceback
+from array import array
+
+from printrun import gcoder
+from printrun.printrun_utils import install_locale
+install_locale('pronterface')
+
+MAGIC = "PRGC"
+VERSION = 2
+header_format = "<4sHHI"
+header_size = struct.calcsize(header_format)
+array_fields = ("offsets", "layer_idxs", "line_idxs",
+                "layer_starts", "layer_durations")
+
+def file_digest(filename, blocksize = 1 << 20):
+    """Returns the SHA-1 hex digest of the contents of filename"""
+    digest = hashlib.sha1()
+    with open(filename, "rb") as f:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+class GCodeCache(object):
+    """Size bounded on-disk cache of G-code analysis results.
+
+    Entries are keyed by file path, home position and kinematic profile,
+    and are only used if the size, modification time and content hash of
+    the file still match.
+    When the cache grows over max_size bytes, the least recently used
+    entries are removed."""
+
+    def __init__(self, directory = None, max_size = 64 * 1024 * 1024):
+        if directory is None:
+            directory = os.path.expanduser("~/.printrun/gcodecache")
+        self.directory = directory
+        self.max_size = max_size
+
+    def entry_path(self, filename, home_pos = None, profile = None):
+        key = repr((os.path.abspath(filename),
+                    tuple(home_pos) if home_pos else None,
+                    profile.key() if profile is not None else None))
+        return os.path.join(self.directory,
+                            hashlib.sha1(key).hexdigest() + ".idx")
+
+    def load(self, filename, home_pos = None, processes = None,
+             profile = None):
+        """Returns a gcoder.MappedGCode for filename, reusing the cached
+        analysis if there is a valid one, and storing it otherwise.
+        processes is the number of processes used to parse the file when
+        it has to be analyzed, and profile the
+        gcoder_kinematics.KinematicProfile used to estimate durations.
+        If the file can't be indexed, it is loaded as a plain gcoder.GCode,
+        without using the cache."""
+        stat = os.stat(filename)
+        digest = file_digest(filename)
+        path = self.entry_path(filename, home_pos, profile)
+        index = self._read(path, stat, digest)
+        if index is not None:
+            gcode = gcoder.MappedGCode(filename, home_pos, index, processes)
+            gcode.kinematic_profile = profile
+            return gcode
+        try:
+            gcode = gcoder.MappedGCode(filename, home_pos,
+                                       processes = processes)
+            gcode.kinematic_profile = profile
+            index = gcode.dump_index()
+            if index is None:
+                raise ValueError(_("some layers have no duration"))
+            self._write(path, stat, digest, index)
+        except Exception:
+            logging.warning(_("Could not index %s, loading it without the G-code cache:") % filename +
+                            "\n" + traceback.format_exc())
+            gcode = gcoder.GCode(open(filename, "rU"), home_pos, processes)
+            gcode.set_kinematic_profile(profile)
+            gcode.filename = filename
+        return gcode
+
+    def _read(self, path, stat, digest):
+        try:
+            with open(path, "rb") as f:
+                magic, version, itemsize, meta_size = \
+                    struct.unpack(header_format, f.read(header_size))
+                if magic != MAGIC or version != VERSION \
+                   or itemsize != array('L').itemsize:
+                    return None
+                meta = marshal.loads(f.read(meta_size))
+                if (meta["size"], meta["mtime"], meta["digest"]) \
+                   != (stat.st_size, stat.st_mtime, digest):
+                    return None
+                for name in array_fields:
+                    typecode, count = meta["arrays"][name]
+                    data = array(typecode)
+                    data.fromfile(f, count)
+                    meta[name] = data
+            # Mark the entry as recently used
+            os.utime(path, None)
+        except (IOError, OSError, EOFError, ValueError,
+                KeyError, TypeError, struct.error):
+            return None
+        return meta
+
+    def _write(self, path, stat, digest, index):
+        meta = dict((name, value) for name, value in index.items()
+                    if name not in array_fields)
+        meta["size"] = stat.st_size
+        meta["mtime"] = stat.st_mtime
+        meta["digest"] = digest
+        meta["arrays"] = dict((name, (index[name].typecode, len(index[name])))
+                              for name in array_fields)
+        meta_data = marshal.dumps(meta)
+        try:
+            try:
+                os.makedirs(self.directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            fd, tmp = tempfile.mkstemp(dir = self.directory, suffix = ".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(struct.pack(header_format, MAGIC, VERSION,
+                                    array('L').itemsize, len(meta_data)))
+                f.write(meta_data)
+                for name in array_fields:
+                    index[name].tofile(f)
+            os.rename(tmp, path)
+        except (IOError, OSError), e:
+            logging.warning(_("Could not write G-code cache entry %s: %s")
+                            % (path, e))
+            return
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in
+        max_size bytes"""
+        try:
+            names = [name for name in os.listdir(self.directory)
+                     if name.endswith(".idx")]
+        except OSError:
+            return
+        entries = []
+        total = 0
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+                total -= size
+            except OSError:
+                pass
@@ -0,0 +1,304 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Struct-of-arrays storage for gcoder.GCode. Instead of keeping one line
+# object per G-code line, every parsed field lives in a typed NumPy column
+# and the raw text of all the lines is kept in a single buffer. Lines are
+# exposed to the existing callers (printcore, the viewers...) through light
+# ColumnarLine views which are created on access and thrown away afterwards.
+
+from array import array
+
+import numpy
+
+from printrun import gcoder
+
+NAN = float("nan")
+
+# Flags column bits
+FLAG_IS_MOVE = 1 << 0
+FLAG_RELATIVE = 1 << 1
+FLAG_RELATIVE_E = 1 << 2
+FLAG_EXTRUDING = 1 << 3
+FLAG_HAS_TOOL = 1 << 4
+FLAG_HAS_END_VERTEX = 1 << 5
+
+float_columns = ("x", "y", "z", "e", "f", "i", "j",
+                 "current_x", "current_y", "current_z")
+
+class ColumnarStore(object):
+    """Typed columns holding the parsed lines of a ColumnarGCode.
+
+    Float fields are stored as float32 (just like gcoder_line.GLine), with NaN
+    standing for None. The raw lines are concatenated in self.raw, line n
+    spanning raw[offsets[n]:offsets[n + 1]]."""
+
+    def __init__(self):
+        self._columns = dict((name, array('f')) for name in float_columns)
+        self._flags = array('B')
+        self._tool = array('B')
+        self._command = array('I')
+        self.commands = []
+        self._command_ids = {}
+        self.raw = bytearray()
+        self._offsets = array('L', [0])
+        self.count = 0
+
+    def extend(self, lines):
+        """Appends the already preprocessed line objects to the columns"""
+        columns = [(self._columns[name].append, name)
+                   for name in float_columns]
+        flags_append = self._flags.append
+        tool_append = self._tool.append
+        command_append = self._command.append
+        command_ids = self._command_ids
+        raw = self.raw
+        offsets_append = self._offsets.append
+        for line in lines:
+            for append, name in columns:
+                value = getattr(line, name)
+                append(NAN if value is None else value)
+            flags = 0
+            if line.is_move: flags |= FLAG_IS_MOVE
+            if line.relative: flags |= FLAG_RELATIVE
+            if line.relative_e: flags |= FLAG_RELATIVE_E
+            if line.extruding: flags |= FLAG_EXTRUDING
+            if line.current_tool is not None:
+                flags |= FLAG_HAS_TOOL
+                tool_append(line.current_tool)
+            else:
+                tool_append(0)
+            flags_append(flags)
+            command = line.command
+            command_id = command_ids.get(command)
+            if command_id is None:
+                command_id = command_ids[command] = len(self.commands)
+                self.commands.append(command)
+            command_append(command_id)
+            raw.extend(line.raw)
+            offsets_append(len(raw))
+        self.count += len(lines)
+
+    def finish(self):
+        """Exposes the filled columns as NumPy arrays. The arrays share their
+        memory with the array.array buffers they were built in."""
+        for name in float_columns:
+            setattr(self, name, numpy.frombuffer(self._columns[name],
+                                                 numpy.float32))
+        self.flags = numpy.frombuffer(self._flags, numpy.uint8)
+        self.tool = numpy.frombuffer(self._tool, numpy.uint8)
+        self.command = numpy.frombuffer(self._command, numpy.uint32)
+        self.offsets = self._offsets
+        self._end_vertex = array('I', [0]) * self.count
+        self.end_vertex = numpy.frombuffer(self._end_vertex, numpy.uint32)
+
+    def nbytes(self):
+        """Approximate memory used by the columns and the raw buffer"""
+        total = len(self.raw) + self.offsets.itemsize * len(self.offsets)
+        for name in float_columns:
+            total += getattr(self, name).nbytes
+        for column in (self.flags, self.tool, self.command, self.end_vertex):
+            total += column.nbytes
+        return total
+
+# Views read single values from the array.array buffers rather than from the
+# NumPy arrays sharing them, as scalar indexing is much cheaper there
+
+def _float_property(name):
+    def getter(self):
+        value = self._store._columns[name][self._idx]
+        return None if value != value else value
+    return property(getter)
+
+def _flag_property(flag):
+    def getter(self):
+        return bool(self._store._flags[self._idx] & flag)
+    return property(getter)
+
+class ColumnarLine(object):
+    """Line-like read-only view over one row of a ColumnarStore"""
+
+    __slots__ = ('_store', '_idx')
+
+    def __init__(self, store, idx):
+        self._store = store
+        self._idx = idx
+
+    def __getattr__(self, name):
+        return None
+
+    x = _float_property("x")
+    y = _float_property("y")
+    z = _float_property("z")
+    e = _float_property("e")
+    f = _float_property("f")
+    i = _float_property("i")
+    j = _float_property("j")
+    current_x = _float_property("current_x")
+    current_y = _float_property("current_y")
+    current_z = _float_property("current_z")
+    is_move = _flag_property(FLAG_IS_MOVE)
+    relative = _flag_property(FLAG_RELATIVE)
+    relative_e = _flag_property(FLAG_RELATIVE_E)
+    extruding = _flag_property(FLAG_EXTRUDING)
+
+    def _get_raw(self):
+        offsets = self._store.offsets
+        idx = self._idx
+        return str(self._store.raw[offsets[idx]:offsets[idx + 1]])
+    raw = property(_get_raw)
+
+    def _get_command(self):
+        return self._store.commands[self._store._command[self._idx]]
+    command = property(_get_command)
+
+    def _get_current_tool(self):
+        if self._store._flags[self._idx] & FLAG_HAS_TOOL:
+            return self._store._tool[self._idx]
+        return None
+    current_tool = property(_get_current_tool)
+
+    def _get_gcview_end_vertex(self):
+        if self._store._flags[self._idx] & FLAG_HAS_END_VERTEX:
+            return self._store._end_vertex[self._idx]
+        return None
+
+    def _set_gcview_end_vertex(self, value):
+        self._store._end_vertex[self._idx] = value
+        self._store._flags[self._idx] |= FLAG_HAS_END_VERTEX
+    gcview_end_vertex = property(_get_gcview_end_vertex,
+                                 _set_gcview_end_vertex)
+
+    def __eq__(self, other):
+        return isinstance(other, ColumnarLine) \
+            and other._store is self._store and other._idx == self._idx
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((id(self._store), self._idx))
+
+class ColumnarLines(object):
+    """Sequence of ColumnarLine views over a ColumnarStore. Lines appended
+    after loading (e.g. through GCode.append during a print) are regular
+    line objects kept in a side list."""
+
+    def __init__(self, store = None):
+        self.store = store
+        self.extra = []
+
+    def _stored(self):
+        return self.store.count if self.store is not None else 0
+
+    def __len__(self):
+        return self._stored() + len(self.extra)
+
+    def __getitem__(self, idx):
+        stored = self._stored()
+        if isinstance(idx, slice):
+            return [self[i] for i in xrange(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError("line index out of range")
+        if idx < stored:
+            return ColumnarLine(self.store, idx)
+        return self.extra[idx - stored]
+
+    def __iter__(self):
+        store = self.store
+        for idx in xrange(self._stored()):
+            yield ColumnarLine(store, idx)
+        for line in self.extra:
+            yield line
+
+    def append(self, line):
+        self.extra.append(line)
+
+class ColumnarLayer(object):
+    """Layer-like view over one or more ranges of rows of a ColumnarStore"""
+
+    __slots__ = ("store", "ranges", "z", "duration", "_length")
+
+    def __init__(self, store, ranges, z = None):
+        self.store = store
+        self.ranges = ranges
+        self.z = z
+        self.duration = None
+        self._length = sum(end - start for start, end in ranges)
+
+    def __len__(self):
+        return self._length
+
+    def _row(self, idx):
+        if idx < 0:
+            idx += self._length
+        if idx < 0 or idx >= self._length:
+            raise IndexError("layer index out of range")
+        for start, end in self.ranges:
+            if idx < end - start:
+                return start + idx
+            idx -= end - start
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in xrange(*idx.indices(self._length))]
+        return ColumnarLine(self.store, self._row(idx))
+
+    def __iter__(self):
+        store = self.store
+        for start, end in self.ranges:
+            for idx in xrange(start, end):
+                yield ColumnarLine(store, idx)
+
+    def rows(self):
+        """Returns the row indices of this layer as a NumPy array"""
+        if not self.ranges:
+            return numpy.zeros(0, numpy.intp)
+        return numpy.concatenate([numpy.arange(start, end)
+                                  for start, end in self.ranges])
+
+class ColumnarGCode(gcoder.GCode):
+    """GCode variant storing its lines in NumPy columns.
+
+    Lines are parsed and analyzed chunk by chunk with regular line objects,
+    which are copied to the columns and dropped right after, so that the
+    memory usage stays proportional to the columns size."""
+
+    chunk_size = 4096
+    store = None
+
+    def __init__(self, data = None, home_pos = None):
+        self.home_pos = home_pos
+        if data:
+            self.store = ColumnarStore()
+            self.lines = ColumnarLines(self.store)
+            self._start_layers()
+            self._load(data)
+            self._end_layers()
+        else:
+            self.lines = ColumnarLines()
+
+    def _load(self, data):
+        store = self.store
+        for raws, tokens in gcoder.tokenized_chunks(gcoder.raw_chunks(data, self.chunk_size)):
+            chunk = [gcoder.Line(raw) for raw in raws]
+            self._preprocess(chunk, build_layers = True, tokens = tokens)
+            store.extend(chunk)
+        store.finish()
+
+    def _build_layer(self, ranges, z):
+        return ColumnarLayer(self.store, ranges, z)
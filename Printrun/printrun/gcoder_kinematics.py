@@ -0,0 +1,387 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Print duration estimation following what the firmware motion planner does.
+# The moves are recorded in a compact MoveTable while the file is parsed,
+# then plan() computes the duration of all of them at once with NumPy:
+# nominal speeds and accelerations are limited per axis, junction speeds
+# come from the jerk or junction deviation settings, and entry speeds are
+# planned with a look-ahead bounded by the size of the planner buffer, each
+# move then following a trapezoidal (or triangular) speed profile.
+#
+# The planner passes are recurrences (a move entry speed depends on the next
+# one and on the previous one), which are computed as running minima over
+# cumulative sums of 2 * acceleration * length, so that no Python loop runs
+# over the moves.
+#
+# The limits of a printer can be read from its answers to M115 and M503 with
+# a FirmwareSettingsReader, and are stored per port in
+# ~/.printrun/kinematics.json.
+
+import os
+import re
+import json
+import math
+import errno
+import logging
+import tempfile
+from array import array
+
+import numpy
+
+from printrun.printrun_utils import install_locale
+install_locale('pronterface')
+
+axes = ("x", "y", "z", "e")
+
+dwell_exp = re.compile(r"([ps])\s*([-+]?\d*\.?\d+)", re.I)
+settings_exp = re.compile(r"^(M20[1345])\s(.*)")
+setting_param_exp = re.compile(r"([A-Z])\s*([-+]?\d*\.?\d+)")
+firmware_name_exp = re.compile(r"FIRMWARE_NAME:\s*(.*?)\s*(?:[A-Z_]+:|$)")
+
+# Commands which make the firmware wait for the moves in the planner buffer
+# to be done, so that the next move starts from standstill
+sync_commands = frozenset(("G4", "G28", "G29", "M109", "M190", "M400"))
+
+class KinematicProfile(object):
+    """Motion limits of a printer. Feedrates and jerk are in mm/s,
+    accelerations in mm/s^2, junction_deviation in mm.
+
+    Junction speeds are limited by the jerk settings unless
+    junction_deviation is set. planner_buffer is the number of moves the
+    firmware plans ahead. firmware is the name reported by M115, if known.
+    The defaults are the Marlin ones."""
+
+    fields = ("max_feedrate", "max_acceleration", "acceleration",
+              "retract_acceleration", "travel_acceleration", "jerk",
+              "junction_deviation", "planner_buffer", "firmware")
+
+    def __init__(self, max_feedrate = None, max_acceleration = None,
+                 acceleration = 3000.0, retract_acceleration = 3000.0,
+                 travel_acceleration = 3000.0, jerk = None,
+                 junction_deviation = None, planner_buffer = 16,
+                 firmware = None):
+        self.max_feedrate = {"x": 300.0, "y": 300.0, "z": 5.0, "e": 25.0}
+        self.max_feedrate.update(max_feedrate or {})
+        self.max_acceleration = {"x": 3000.0, "y": 3000.0,
+                                 "z": 100.0, "e": 10000.0}
+        self.max_acceleration.update(max_acceleration or {})
+        self.acceleration = acceleration
+        self.retract_acceleration = retract_acceleration
+        self.travel_acceleration = travel_acceleration
+        self.jerk = {"x": 10.0, "y": 10.0, "z": 0.3, "e": 5.0}
+        self.jerk.update(jerk or {})
+        self.junction_deviation = junction_deviation
+        self.planner_buffer = planner_buffer
+        self.firmware = firmware
+
+    def axis_values(self, values):
+        return numpy.array([values[axis] for axis in axes], numpy.float64)
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.fields)
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**dict((str(name), value) for name, value in values.items()
+                          if name in cls.fields))
+
+    def key(self):
+        """Returns a string identifying the limits of this profile"""
+        return json.dumps(self.to_dict(), sort_keys = True)
+
+class FirmwareSettingsReader(object):
+    """Builds a KinematicProfile from the answers of a printer to M115 and
+    M503, which are fed line by line to feed(). Only Marlin style M201,
+    M203, M204 and M205 reports are understood. done is set once all of
+    them have been read and acknowledged."""
+
+    groups = ("M201", "M203", "M204", "M205")
+
+    def __init__(self):
+        self.settings = {}
+        self.firmware = None
+        self.done = False
+
+    def feed(self, line):
+        line = line.strip()
+        if line.startswith("ok"):
+            if all(group in self.settings for group in self.groups):
+                self.done = True
+            return
+        match = firmware_name_exp.search(line)
+        if match:
+            self.firmware = match.group(1)
+            return
+        if line.startswith("echo:"):
+            line = line[5:].strip()
+        match = settings_exp.match(line)
+        if not match:
+            return
+        params = self.settings.setdefault(match.group(1), {})
+        # With distinct E factors, E limits are reported for each tool on
+        # their own line: only keep the first ones
+        for code, value in setting_param_exp.findall(match.group(2)):
+            params.setdefault(code, float(value))
+
+    def profile(self, base = None):
+        """Returns the profile read so far, starting from base for the
+        values which were not reported, or None if nothing was read"""
+        if not self.settings and self.firmware is None:
+            return None
+        profile = KinematicProfile.from_dict(base.to_dict()) if base \
+            else KinematicProfile()
+        settings = self.settings
+        for group, limits in (("M203", profile.max_feedrate),
+                              ("M201", profile.max_acceleration)):
+            for axis in axes:
+                if axis.upper() in settings.get(group, {}):
+                    limits[axis] = settings[group][axis.upper()]
+        params = settings.get("M204", {})
+        if "P" in params or "R" in params:
+            profile.acceleration = params.get("P", profile.acceleration)
+            profile.retract_acceleration = params.get("R", profile.retract_acceleration)
+            profile.travel_acceleration = params.get("T", profile.travel_acceleration)
+        else:
+            # Older firmwares: S for all moves, T for retracts
+            if "S" in params:
+                profile.acceleration = profile.travel_acceleration = params["S"]
+            profile.retract_acceleration = params.get("T", profile.retract_acceleration)
+        params = settings.get("M205", {})
+        if "X" in params and "Y" not in params:
+            params["Y"] = params["X"]
+        for axis in axes:
+            if axis.upper() in params:
+                profile.jerk[axis] = params[axis.upper()]
+        if "J" in params:
+            profile.junction_deviation = params["J"]
+        if self.firmware is not None:
+            profile.firmware = self.firmware
+        return profile
+
+def default_profiles_file():
+    return os.path.expanduser("~/.printrun/kinematics.json")
+
+def _read_profiles(filename):
+    try:
+        with open(filename) as f:
+            profiles = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    return profiles if isinstance(profiles, dict) else {}
+
+def load_profile(port, filename = None):
+    """Returns the KinematicProfile stored for port, or None"""
+    values = _read_profiles(filename or default_profiles_file()).get(port)
+    if not isinstance(values, dict):
+        return None
+    try:
+        return KinematicProfile.from_dict(values)
+    except (TypeError, ValueError):
+        return None
+
+def save_profile(port, profile, filename = None):
+    """Stores the KinematicProfile of the printer connected to port"""
+    filename = filename or default_profiles_file()
+    profiles = _read_profiles(filename)
+    profiles[port] = profile.to_dict()
+    directory = os.path.dirname(filename)
+    try:
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, tmp = tempfile.mkstemp(dir = directory, suffix = ".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(profiles, f, indent = 1, sort_keys = True)
+        os.rename(tmp, filename)
+    except (IOError, OSError), e:
+        logging.warning(_("Could not save the kinematic profile of %s: %s")
+                        % (port, e))
+
+def arc_length(line, startx, starty, dx, dy, dz):
+    """Length of a G2/G3 arc starting at (startx, starty), or None if it has
+    no I/J center offset"""
+    i = line.i or 0
+    j = line.j or 0
+    if not i and not j:
+        return None
+    centerx = startx + i
+    centery = starty + j
+    radius = math.hypot(i, j)
+    start_angle = math.atan2(starty - centery, startx - centerx)
+    end_angle = math.atan2(starty + dy - centery, startx + dx - centerx)
+    sweep = end_angle - start_angle
+    if line.command == "G2":
+        if sweep >= 0:
+            sweep -= 2 * math.pi
+    elif sweep <= 0:
+        sweep += 2 * math.pi
+    return math.hypot(radius * sweep, dz)
+
+class MoveTable(object):
+    """Moves of a G-code file in the compact form used by plan(), as
+    recorded by gcoder.GCode._preprocess while loading the file.
+
+    lines holds the line number of each move and values its X/Y/Z/E deltas
+    and feedrate in mm/min (0 if none was set yet), five values per move.
+    The other arrays are sparse: the moves which start from standstill, the
+    arcs with their path length, and the dwells with their line number."""
+
+    def __init__(self):
+        self.lines = array('L')
+        self.values = array('f')
+        self.stops = array('L')
+        self.arcs = array('L')
+        self.arc_lengths = array('d')
+        self.dwell_lines = array('L')
+        self.dwells = array('d')
+
+    def __len__(self):
+        return len(self.lines)
+
+    def add_arc(self, line, startx, starty, dx, dy, dz):
+        """Records the path length of the G2/G3 move about to be added"""
+        length = arc_length(line, startx, starty, dx, dy, dz)
+        if length is not None:
+            self.arcs.append(len(self.lines))
+            self.arc_lengths.append(length)
+
+    def add_sync(self, line_number, line):
+        """Records a command from sync_commands: the next move starts from
+        standstill, after the dwell time if line is a G4"""
+        self.stops.append(len(self.lines))
+        if line.command != "G4":
+            return
+        duration = 0.0
+        for code, value in dwell_exp.findall(line.raw.split(";")[0]):
+            if code in "pP":
+                duration = float(value) / 1000.0
+            else:
+                duration = float(value)
+        if duration > 0:
+            self.dwell_lines.append(line_number)
+            self.dwells.append(duration)
+
+def plan(moves, profile = None):
+    """Returns the durations in seconds of the moves of the given MoveTable
+    as a NumPy array"""
+    if profile is None:
+        profile = KinematicProfile()
+    count = len(moves)
+    if not count:
+        return numpy.zeros(0)
+    values = numpy.frombuffer(moves.values, numpy.float32).reshape(count, 5)
+    delta = values[:, :4].astype(numpy.float64)
+    feed = values[:, 4] / 60.0
+    de = delta[:, 3]
+
+    # Moves without X/Y/Z motion only move the extruder
+    length = numpy.sqrt((delta[:, :3] ** 2).sum(1))
+    e_only = length == 0
+    length[e_only] = numpy.abs(de[e_only])
+    chord = length.copy()
+    if moves.arcs:
+        arcs = numpy.frombuffer(moves.arcs, numpy.uint).astype(numpy.intp)
+        length[arcs] = numpy.frombuffer(moves.arc_lengths, numpy.float64)
+    # Share of each axis in the move
+    ratio = numpy.abs(delta) / chord[:, None]
+
+    with numpy.errstate(divide = "ignore"):
+        # Nominal speed and acceleration, limited per axis
+        axis_speed = (profile.axis_values(profile.max_feedrate) / ratio).min(1)
+        nominal = numpy.where(feed > 0, numpy.minimum(feed, axis_speed),
+                              axis_speed)
+        accel = numpy.where(e_only, profile.retract_acceleration,
+                            numpy.where(de > 0, profile.acceleration,
+                                        profile.travel_acceleration))
+        accel = numpy.minimum(accel,
+                              (profile.axis_values(profile.max_acceleration)
+                               / ratio).min(1))
+
+        # Junction speeds
+        unit = numpy.zeros((count, 4))
+        unit[:, :3] = delta[:, :3] / chord[:, None]
+        unit[e_only, :3] = 0
+        unit[e_only, 3] = numpy.sign(de[e_only])
+        if profile.junction_deviation:
+            cos_theta = -(unit[1:] * unit[:-1]).sum(1)
+            cos_theta = numpy.clip(cos_theta, -0.999999, 0.999999)
+            sin_half = numpy.sqrt(0.5 * (1 - cos_theta))
+            junction2 = accel[1:] * profile.junction_deviation \
+                * sin_half / (1 - sin_half)
+            safe = numpy.zeros(count)
+        else:
+            jerk = profile.axis_values(profile.jerk)
+            junction2 = (jerk / numpy.abs(unit[1:] - unit[:-1])).min(1) ** 2
+            safe = numpy.minimum((jerk / numpy.abs(unit)).min(1), nominal)
+
+    nominal2 = nominal ** 2
+    safe2 = safe ** 2
+    # Maximum squared entry speed of each move, plus the final exit speed
+    limit = numpy.empty(count + 1)
+    limit[0] = safe2[0]
+    limit[1:count] = numpy.minimum(junction2,
+                                   numpy.minimum(nominal2[1:], nominal2[:-1]))
+    stops = numpy.frombuffer(moves.stops, numpy.uint).astype(numpy.intp)
+    stops = stops[(stops > 0) & (stops < count)]
+    limit[stops] = numpy.minimum(safe2[stops], safe2[stops - 1])
+    limit[count] = safe2[-1]
+
+    # Squared speed which can be gained or lost along each move
+    reach = numpy.zeros(count + 1)
+    numpy.cumsum(2 * accel * length, out = reach[1:])
+    # Backward pass: entry[i] <= min(limit[i], entry[i + 1] + 2 a_i d_i)
+    entry = numpy.minimum.accumulate((limit + reach)[::-1])[::-1] - reach
+    # While move i - 1 runs, the firmware only knows the planner_buffer
+    # moves from i - 1 on, and must be able to stop at the end of the last
+    # one
+    horizon = numpy.clip(numpy.arange(count + 1) + profile.planner_buffer - 1,
+                         1, count)
+    entry = numpy.minimum(entry, reach[horizon] - reach + safe2[horizon - 1])
+    # Forward pass: entry[i + 1] <= entry[i] + 2 a_i d_i
+    entry = numpy.minimum.accumulate(entry - reach) + reach
+    numpy.maximum(entry, 0, out = entry)
+
+    # Trapezoidal speed profiles, or triangular ones for moves too short to
+    # reach their nominal speed
+    start2 = entry[:-1]
+    end2 = entry[1:]
+    start = numpy.sqrt(start2)
+    end = numpy.sqrt(end2)
+    cruise = length - (2 * nominal2 - start2 - end2) / (2 * accel)
+    trapezoid = (2 * nominal - start - end) / accel + cruise / nominal
+    peak = numpy.sqrt(numpy.maximum((2 * accel * length + start2 + end2) / 2,
+                                    numpy.maximum(start2, end2)))
+    triangle = (2 * peak - start - end) / accel
+    return numpy.where(cruise >= 0, trapezoid, triangle)
+
+def layer_durations(moves, times, bounds):
+    """Sums the given move and dwell durations over line ranges: bounds
+    holds the first line of each range followed by the end of the last
+    one"""
+    bounds = numpy.asarray(bounds, numpy.int64)
+    total = numpy.zeros(len(bounds) - 1)
+    for lines, durations in ((moves.lines, times),
+                             (moves.dwell_lines, moves.dwells)):
+        if not lines:
+            continue
+        lines = numpy.frombuffer(lines, numpy.uint).astype(numpy.int64)
+        cumulated = numpy.zeros(len(durations) + 1)
+        numpy.cumsum(durations, out = cumulated[1:])
+        cumulated = cumulated[numpy.searchsorted(lines, bounds)]
+        total += cumulated[1:] - cumulated[:-1]
+    return total
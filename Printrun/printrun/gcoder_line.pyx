@@ -15,7 +15,12 @@
 
 from libc.stdlib cimport malloc, free
 from libc.stdint cimport uint32_t
-from libc.string cimport strlen, strncpy
+from libc.string cimport strlen, strncpy, memcpy, memset
+from cpython.bytes cimport PyBytes_FromStringAndSize
+
+cdef extern from "Python.h":
+    double PyOS_string_to_double(char *s, char **endptr,
+                                 object overflow_exception) except? -1.0
 
 cdef char* copy_string(object value):
     cdef char* orig = value
@@ -208,3 +213,166 @@ cdef class GLine:
             # if self._command != NULL: free(self._command)
             self._command = copy_string(value)
             self._status = set_has_var(self._status, pos_command)
+
+
+# Tokenizer
+
+# Coordinates parsed by tokenize_chunk, in gcoder.gcode_parsed_args order
+cdef char* parsed_args = "xyefzij"
+cdef int n_parsed_args = 7
+# Letters starting a token in gcoder.gcode_exp
+cdef char* token_letters = "xyefzijgtmn"
+# Flag set on moves in the flags returned by tokenize_chunk
+cdef int token_is_move = 1 << 7
+
+cdef inline char lower(char c):
+    if c >= 'A' and c <= 'Z':
+        return c + 32
+    return c
+
+cdef inline bint is_digit(char c):
+    return c >= '0' and c <= '9'
+
+cdef int find_char(char* chars, char c):
+    cdef int i = 0
+    while chars[i]:
+        if chars[i] == c:
+            return i
+        i += 1
+    return -1
+
+cdef double parse_float(char* s, Py_ssize_t length) except? -1.0:
+    """Parses s[:length] like float() does"""
+    cdef char buf[64]
+    cdef char* end
+    cdef double value
+    if length == 0 or length >= 64:
+        return float(s[:length])
+    memcpy(buf, s, length)
+    buf[length] = 0
+    value = PyOS_string_to_double(buf, &end, None)
+    if end != buf + length:
+        raise ValueError("could not convert string to float: " + s[:length])
+    return value
+
+cdef inline Py_ssize_t number_end(char* s, Py_ssize_t i, Py_ssize_t n):
+    """Returns the end of the [-+]?[0-9]*\\.?[0-9]* number starting at i"""
+    if i < n and (s[i] == '-' or s[i] == '+'):
+        i += 1
+    while i < n and is_digit(s[i]):
+        i += 1
+    if i < n and s[i] == '.':
+        i += 1
+    while i < n and is_digit(s[i]):
+        i += 1
+    return i
+
+def tokenize_chunk(raws):
+    """Compiled version of gcoder._tokenize_chunk, returning the same packed
+    results. Lines are scanned the way gcoder.gcode_exp.findall scans their
+    lowercased text: comments in parentheses, comments starting with ";"
+    and "/" or "*" blocks ending with a newline yield empty tokens, and
+    letters of gcoder.gcode_parsed_args and gcode_parsed_nonargs yield
+    (letter, number) tokens."""
+    cdef Py_ssize_t count = len(raws)
+    cdef Py_ssize_t n, i, j, start, k
+    cdef Py_ssize_t ntokens, command_start, command_length
+    cdef char* s
+    cdef char c
+    cdef char command_letter
+    cdef int slot, mask
+    cdef bint is_g
+    cdef unsigned char* flags = <unsigned char*>malloc(count + 1)
+    cdef double* values = <double*>malloc(sizeof(double) * n_parsed_args * count + 1)
+    if flags == NULL or values == NULL:
+        free(flags)
+        free(values)
+        raise MemoryError()
+    memset(values, 0, sizeof(double) * n_parsed_args * count)
+    commands = []
+    command_cache = {}
+    try:
+        for k in range(count):
+            raw = raws[k]
+            s = raw
+            n = len(raw)
+            ntokens = 0
+            command_letter = 0
+            command_start = 0
+            command_length = 0
+            is_g = False
+            mask = 0
+            i = 0
+            while i < n:
+                c = lower(s[i])
+                if c == '(':
+                    j = i + 1
+                    while j < n and s[j] != '(' and s[j] != ')':
+                        j += 1
+                    if j < n and s[j] == ')':
+                        i = j + 1
+                    else:
+                        i += 1
+                        continue
+                elif c == ';':
+                    j = i + 1
+                    while j < n and s[j] != '\n':
+                        j += 1
+                    i = j
+                elif c == '/' or c == '*':
+                    j = i + 1
+                    while j < n and s[j] != '\n':
+                        j += 1
+                    if j < n:
+                        i = j + 1
+                    else:
+                        i += 1
+                        continue
+                elif find_char(token_letters, c) >= 0:
+                    start = i + 1
+                    i = number_end(s, start, n)
+                    # The command is the first token, or the second one if
+                    # the first one is a line number
+                    if ntokens == 0 or (ntokens == 1 and command_letter == 'n'):
+                        command_letter = c
+                        command_start = start
+                        command_length = i - start
+                        is_g = c == 'g'
+                    elif is_g and i > start:
+                        slot = find_char(parsed_args, c)
+                        if slot >= 0:
+                            values[n_parsed_args * k + slot] = parse_float(s + start, i - start)
+                            mask |= 1 << slot
+                    ntokens += 1
+                    continue
+                else:
+                    i += 1
+                    continue
+                # Comment token
+                if ntokens == 0 or (ntokens == 1 and command_letter == 'n'):
+                    command_letter = 0
+                    command_length = 0
+                    is_g = False
+                ntokens += 1
+            if ntokens == 0:
+                commands.append(None)
+                flags[k] = 0
+                continue
+            if ntokens == 1 and command_letter == 'n':
+                raise IndexError("list index out of range")
+            if command_letter == 0:
+                command = ""
+            else:
+                command = chr(command_letter - 32) + s[command_start:command_start + command_length]
+                command = command_cache.setdefault(command, command)
+                if command_length == 1 and command_letter == 'g' \
+                   and s[command_start] >= '0' and s[command_start] <= '3':
+                    mask |= token_is_move
+            commands.append(command)
+            flags[k] = mask
+        return (commands, PyBytes_FromStringAndSize(<char*>flags, count),
+                PyBytes_FromStringAndSize(<char*>values,
+                                          sizeof(double) * n_parsed_args * count))
+    finally:
+        free(flags)
+        free(values)
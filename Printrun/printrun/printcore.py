@@ -19,8 +19,8 @@ __version__ = "2013.10.19"
 
 from serial import Serial, SerialException
 from select import error as SelectError
-from threading import Thread, Lock
-from Queue import Queue, Empty as QueueEmpty
+from threading import Thread, Lock, Condition, current_thread
+from Queue import Empty as QueueEmpty
 import time
 import platform
 import os
@@ -32,8 +32,19 @@ import errno
 import socket
 import re
 from functools import wraps
+from operator import xor
 from collections import deque
 from printrun import gcoder
+from printrun.printcore_metrics import PrintMetrics
+from printrun.printcore_writer import CoalescingWriter
+from printrun.printcore_scheduler import CommandScheduler, EMERGENCY, \
+    command_class
+from printrun.printcore_protocol import ReplyParser, TEMPERATURES, RESEND, \
+    ERROR, GREETING, DEBUG
+try:
+    from printrun import gcoder_kinematics
+except ImportError:
+    gcoder_kinematics = None
 from printrun.printrun_utils import install_locale, decode_utf8, setup_logging
 install_locale('pronterface')
 
@@ -61,7 +72,34 @@ def enable_hup(port):
 def disable_hup(port):
     control_ttyhup(port, True)
 
-class printcore():
+class ResendWindow(object):
+    """Keeps the last size lines sent, indexed by line number, for the
+    firmware to ask them again. Older lines are dropped, looking them up
+    raises a KeyError like for a dict."""
+
+    def __init__(self, size):
+        self.size = size
+        self.clear()
+
+    def clear(self):
+        self._linenos = [None] * self.size
+        self._lines = [None] * self.size
+
+    def __setitem__(self, lineno, line):
+        slot = lineno % self.size
+        self._linenos[slot] = lineno
+        self._lines[slot] = line
+
+    def __getitem__(self, lineno):
+        slot = lineno % self.size
+        if self._linenos[slot] != lineno:
+            raise KeyError(lineno)
+        return self._lines[slot]
+
+    def __contains__(self, lineno):
+        return self._linenos[lineno % self.size] == lineno
+
+class printcore(object):
     def __init__(self, port = None, baud = None):
         """Initializes a printcore instance. Pass the port and baud rate to
            connect immediately"""
@@ -70,20 +108,51 @@ class printcore():
         self.analyzer = gcoder.GCode()
         self.printer = None  # Serial instance connected to the printer,
                              # should be None when disconnected
-        self.clear = 0  # clear to send, enabled after responses
+        # Clear to send, enabled after responses. Senders block on
+        # _clear_condition until _listen sets it, see _wait_clear
+        self._clear = False
+        self._clear_condition = Condition()
+        # Size of the firmware receive buffer in bytes (e.g. 127 for Grbl).
+        # When set, lines are streamed as long as they fit in it instead of
+        # waiting for an "ok" after each line (character counting)
+        self.rx_buffer_size = 0
+        self._inflight = deque()  # (size, send time) of the lines awaiting
+                                  # an "ok"
+        self._inflight_bytes = 0
+        # TCP printers: lines are written together once tcp_write_size bytes
+        # are waiting or the first of them waited for tcp_write_latency
+        # seconds, 0 to write each line on its own (see printcore_writer)
+        self.tcp_write_latency = 0.002
+        self.tcp_write_size = 1400
+        self._tcp_writer = None
+        self._resyncing = False  # a resend was requested, see _wait_quiet
+        self._rtt = 0.05  # average time between sending a line and its "ok"
+        self._last_response = 0
         self.online = False  # The printer has responded to the initial command
                              # and is active
-        self.printing = False  # is a print currently running, true if printing
-                               # , false if paused
+        self._printing = False  # is a print currently running, true if
+                                # printing, false if paused
         self.mainqueue = None
-        self.priqueue = Queue(0)
+        # Number of lines of mainqueue numbered and checksummed ahead of
+        # time, while waiting for the printer, see _encode_ahead
+        self.encode_ahead = 16
+        self._encoded = deque()
+        # Commands sent ahead of the print, by priority class (see
+        # printcore_scheduler)
+        self.priqueue = CommandScheduler()
         self.queueindex = 0
         self.lineno = 0
         self.resendfrom = -1
         self.paused = False
-        self.sentlines = {}
+        # Firmwares only ask to resend lines they did not acknowledge yet,
+        # i.e. at most a receive buffer worth of lines
+        self.sentlines = ResendWindow(1024)
+        self.resend_requests = 0  # resend requests received during the print
+        self.resent_lines = 0  # lines sent again during the print
         self.log = deque(maxlen = 10000)
-        self.sent = []
+        self.sent = deque(maxlen = 10000)
+        # Latency, throughput, starvation, resend and callback time metrics
+        self.metrics = PrintMetrics()
         self.writefailures = 0
         self.tempcb = None  # impl (wholeline)
         self.recvcb = None  # impl (wholeline)
@@ -95,20 +164,171 @@ class printcore():
         self.startcb = None  # impl ()
         self.endcb = None  # impl ()
         self.onlinecb = None  # impl ()
+        # printcore_dispatcher.CallbackDispatcher running the recvcb, sendcb,
+        # tempcb, printsendcb and layerchangecb callbacks from its own
+        # thread, if any
+        self.dispatcher = None
+        # printcore_journal.PrintJournal recording the progress of the
+        # prints, if any
+        self.journal = None
         self.loud = False  # emit sent and received lines to terminal
-        self.greetings = ['start', 'Grbl ']
+        # printcore_protocol.ReplyParser classifying the lines received,
+        # running the handlers registered with it (from the dispatcher, if
+        # any)
+        self.protocol = ReplyParser(['start', 'Grbl '])
         self.wait = 0  # default wait period for send(), send_now()
         self.read_thread = None
         self.stop_read_thread = False
         self.send_thread = None
         self.stop_send_thread = False
         self.print_thread = None
+        # gcoder_kinematics.KinematicProfile of the printer, if known
+        self.kinematic_profile = None
+        # Read the motion settings of the printer (M115/M503) once online
+        self.query_kinematics = False
+        self.kinematicscb = None  # impl (profile)
+        self._kinematics_reader = None
         if port is not None and baud is not None:
             self.connect(port, baud)
         self.xy_feedrate = None
         self.z_feedrate = None
         self.pronterface = None
 
+    def _get_clear(self):
+        return self._clear
+
+    def _set_clear(self, value):
+        with self._clear_condition:
+            self._clear = bool(value)
+            if self._clear:
+                self._clear_condition.notify_all()
+    clear = property(_get_clear, _set_clear)
+
+    def _get_printing(self):
+        return self._printing
+
+    def _set_printing(self, value):
+        with self._clear_condition:
+            self._printing = value
+            if not value:
+                self._clear_condition.notify_all()
+    printing = property(_get_printing, _set_printing)
+
+    def _get_greetings(self):
+        """Starts of the lines sent by the firmware when it (re)starts"""
+        return self.protocol.greetings
+
+    def _set_greetings(self, greetings):
+        self.protocol.set_greetings(greetings)
+    greetings = property(_get_greetings, _set_greetings)
+
+    def _wait_clear(self, stop = None):
+        """Blocks until the printer is clear to send, while printing. Waits
+        without a timeout, as a timed wait on a Python 2 Condition polls
+        with sleeps of up to 50ms."""
+        if not self._clear and self._tcp_writer is not None:
+            # The printer may wait for lines held by the writer
+            try:
+                self._tcp_writer.flush()
+            except socket.error:
+                pass
+        with self._clear_condition:
+            while self.printer and self.printing and not self._clear \
+                    and not (stop and stop()) and not self.priqueue.urgent():
+                self._clear_condition.wait()
+
+    def _counting(self):
+        return self.rx_buffer_size and not self.printer_tcp
+
+    def _reset_inflight(self):
+        with self._clear_condition:
+            self._inflight.clear()
+            self._inflight_bytes = 0
+        self.metrics.flush()
+
+    def _acknowledge(self):
+        """Frees the buffer space taken by the oldest unacknowledged line"""
+        with self._clear_condition:
+            if self._inflight:
+                size, sent = self._inflight.popleft()
+                self._inflight_bytes -= size
+                self._rtt += 0.1 * (time.time() - sent - self._rtt)
+            self.clear = True
+
+    def _request_resend(self, toresend, followed_by_ok):
+        """Handles a resend request when counting characters. Lines already
+        sent after the faulty one are either flushed by the firmware or
+        answered with requests for the same line, the last request received
+        being the one to follow, see _wait_quiet."""
+        with self._clear_condition:
+            if toresend is not None:
+                self.resendfrom = toresend
+                self._resyncing = True
+            # Marlin-like firmwares send an "ok" after their resend requests,
+            # Teacup does not
+            if not followed_by_ok:
+                self._acknowledge()
+
+    def _wait_quiet(self):
+        """Waits for the firmware to be done answering the lines sent before
+        a resend request, i.e. for it to keep quiet for twice the usual time
+        needed to answer a line. Nothing is left in its buffer then."""
+        while self.printer and self.printing and not self.stop_read_thread:
+            with self._clear_condition:
+                wait = self._last_response + 2 * self._rtt + 0.005 \
+                    - time.time()
+                if wait <= 0:
+                    self._reset_inflight()
+                    self._resyncing = False
+                    return
+            time.sleep(wait)
+
+    def _wait_room(self, size, lineno = None):
+        """Blocks until size bytes fit in the firmware receive buffer. A line
+        is always sent when nothing is outstanding, however long it is.
+        Returns False if the numbered line is not to be sent, a resend having
+        been requested meanwhile: it will be resent along with the others."""
+        stop = None
+        if current_thread() is self.send_thread:
+            stop = self._sender_stopped
+        condition = self._clear_condition
+        condition.acquire()
+        try:
+            while self._inflight \
+                    and self._inflight_bytes + size > self.rx_buffer_size \
+                    and self.printer and not self.stop_read_thread \
+                    and not (stop and stop()):
+                command = self.priqueue.get_urgent()
+                if command is not None:
+                    # Written without holding the condition, as the write
+                    # may block while the read thread needs the condition
+                    # to free the room of the lines acknowledged
+                    condition.release()
+                    try:
+                        self._write_urgent(command)
+                    finally:
+                        condition.acquire()
+                    continue
+                condition.wait()
+            if lineno is not None and self.resendfrom > -1:
+                return False
+            self._inflight.append((size, time.time()))
+            self._inflight_bytes += size
+            return True
+        finally:
+            condition.release()
+
+    def _wait_acknowledged(self):
+        """Waits for the lines in the firmware buffer to be acknowledged at
+        the end of a print, as they may have to be resent. Returns True if a
+        resend was requested."""
+        with self._clear_condition:
+            while self._inflight and self.resendfrom == -1 \
+                    and self.printing and self.printer \
+                    and not self.stop_read_thread:
+                self._clear_condition.wait()
+            return self.resendfrom > -1
+
     def logError(self, error):
         if self.errorcb:
             try: self.errorcb(error)
@@ -129,13 +349,20 @@ class printcore():
                 self.printing = False
                 self.print_thread.join()
             self._stop_sender()
+            if self._tcp_writer is not None:
+                self._tcp_writer.close()
+                self._tcp_writer = None
             try:
                 self.printer.close()
+                if self.printer_tcp is not None:
+                    # Closing the file made by makefile leaves the socket open
+                    self.printer_tcp.close()
             except socket.error:
                 pass
             except OSError:
                 pass
         self.printer = None
+        self.printer_tcp = None
         self.online = False
         self.printing = False
 
@@ -149,22 +376,13 @@ class printcore():
             self.port = port
         if baud is not None:
             self.baud = baud
+        if self.port is not None and gcoder_kinematics is not None:
+            self.kinematic_profile = gcoder_kinematics.load_profile(self.port)
         if self.port is not None and self.baud is not None:
-            # Connect to socket if "port" is an IP, device if not
-            host_regexp = re.compile("^(([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\.){3}([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])$|^(([a-zA-Z0-9]|[a-zA-Z0-9][a-zA-Z0-9\-]*[a-zA-Z0-9])\.)*([A-Za-z0-9]|[A-Za-z0-9][A-Za-z0-9\-]*[A-Za-z0-9])$")
-            is_serial = True
-            if ":" in port:
-                bits = port.split(":")
-                if len(bits) == 2:
-                    hostname = bits[0]
-                    try:
-                        port = int(bits[1])
-                        if host_regexp.match(hostname) and 1 <= port <= 65535:
-                            is_serial = False
-                    except:
-                        pass
+            address = self._tcp_address(self.port)
             self.writefailures = 0
-            if not is_serial:
+            if address is not None:
+                hostname, port = address
                 self.printer_tcp = socket.socket(socket.AF_INET,
                                                  socket.SOCK_STREAM)
                 self.timeout = 0.25
@@ -173,6 +391,13 @@ class printcore():
                     self.printer_tcp.connect((hostname, port))
                     self.printer_tcp.settimeout(self.timeout)
                     self.printer = self.printer_tcp.makefile()
+                    if self.tcp_write_latency > 0:
+                        # Lines are coalesced by the writer already
+                        self.printer_tcp.setsockopt(socket.IPPROTO_TCP,
+                                                    socket.TCP_NODELAY, 1)
+                    self._tcp_writer = CoalescingWriter(self.printer_tcp,
+                                                        self.tcp_write_latency,
+                                                        self.tcp_write_size)
                 except socket.error as e:
                     self.logError(_("Could not connect to %s:%s:") % (hostname, port) +
                                   "\n" + _("Socket error %s:") % e.errno +
@@ -202,6 +427,24 @@ class printcore():
             self.read_thread.start()
             self._start_sender()
 
+    def _tcp_address(self, port):
+        """Returns the (hostname, port) to connect to if port is an IP or
+        hostname followed by a port number, None for a serial device"""
+        host_regexp = re.compile("^(([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\.){3}([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])$|^(([a-zA-Z0-9]|[a-zA-Z0-9][a-zA-Z0-9\-]*[a-zA-Z0-9])\.)*([A-Za-z0-9]|[A-Za-z0-9][A-Za-z0-9\-]*[A-Za-z0-9])$")
+        if port is None or ":" not in port:
+            return None
+        bits = port.split(":")
+        if len(bits) != 2:
+            return None
+        hostname = bits[0]
+        try:
+            port = int(bits[1])
+        except ValueError:
+            return None
+        if host_regexp.match(hostname) and 1 <= port <= 65535:
+            return (hostname, port)
+        return None
+
     def reset(self):
         """Reset the printer
         """
@@ -211,21 +454,17 @@ class printcore():
             self.printer.setDTR(0)
 
     def _readline(self):
+        """Returns the Reply of the next line received, of an empty line if
+        none was, or None if the connection failed"""
         try:
             try:
                 line = self.printer.readline()
                 if self.printer_tcp and not line:
                     raise OSError(-1, "Read EOF from socket")
             except socket.timeout:
-                return ""
+                line = ""
 
-            if len(line) > 1:
-                self.log.append(line)
-                if self.recvcb:
-                    try: self.recvcb(line)
-                    except: pass
-                if self.loud: logging.info("RECV: %s" % line.rstrip())
-            return line
+            return self._received(line)
         except SelectError as e:
             if 'Bad file descriptor' in e.args[1]:
                 self.logError(_(u"Can't read from printer (disconnected?) (SelectError {0}): {1}").format(e.errno, decode_utf8(e.strerror)))
@@ -241,10 +480,37 @@ class printcore():
             return None
         except OSError as e:
             if e.errno == errno.EAGAIN:  # Not a real error, no data was available
-                return ""
+                return self._received("")
             self.logError(_(u"Can't read from printer (disconnected?) (OS Error {0}): {1}").format(e.errno, e.strerror))
             return None
 
+    def _received(self, line):
+        """Parses line, passes it to recvcb and its Reply to the handlers of
+        self.protocol, and returns its Reply"""
+        reply = self.protocol.parse(line)
+        if len(line) > 1:
+            self.log.append(line)
+            if self.recvcb:
+                if self.dispatcher is not None:
+                    self.dispatcher.post("recvcb", line)
+                else:
+                    started = time.time()
+                    try: self.recvcb(line)
+                    except: pass
+                    self.metrics.callback("recvcb", started)
+            if self.protocol.wants(reply):
+                if self.dispatcher is not None:
+                    self.dispatcher.post("_dispatch_reply", reply)
+                else:
+                    started = time.time()
+                    self.protocol.dispatch(reply)
+                    self.metrics.callback("_dispatch_reply", started)
+            if self.loud: logging.info("RECV: %s" % line.rstrip())
+        return reply
+
+    def _dispatch_reply(self, reply):
+        self.protocol.dispatch(reply)
+
     def _listen_can_continue(self):
         if self.printer_tcp:
             return not self.stop_read_thread and self.printer
@@ -260,8 +526,8 @@ class printcore():
                 return
             empty_lines = 0
             while self._listen_can_continue():
-                line = self._readline()
-                if line is None: break  # connection problem
+                reply = self._readline()
+                if reply is None: break  # connection problem
                 # workaround cases where M105 was sent before printer Serial
                 # was online an empty line means read timeout was reached,
                 # meaning no data was received thus we count those empty lines,
@@ -271,54 +537,106 @@ class printcore():
                 # Gen7 bootloader to time out, and that the non received M105
                 # issues should be quite rare so we can wait for a long time
                 # before resending
-                if not line:
+                if not reply.line:
                     empty_lines += 1
                     if empty_lines == 15: break
                 else: empty_lines = 0
-                if line.startswith(tuple(self.greetings)) \
-                   or line.startswith('ok') or "T:" in line:
-                    if self.onlinecb:
-                        try: self.onlinecb()
-                        except: pass
-                    self.online = True
+                if self._check_online(reply):
                     return
 
+    def _check_online(self, reply):
+        """Marks the printer as online if reply is a first answer from it,
+        returning whether it was"""
+        if reply.ok or reply.kind == GREETING \
+           or reply.temperatures is not None:
+            if self.onlinecb:
+                try: self.onlinecb()
+                except: pass
+            self.online = True
+            return True
+        return False
+
     def _listen(self):
         """This function acts on messages from the firmware
         """
         self.clear = True
         if not self.printing:
             self._listen_until_online()
+            self._reset_inflight()
+            if self.online and self.query_kinematics \
+               and gcoder_kinematics is not None:
+                self._query_kinematics()
         while self._listen_can_continue():
-            line = self._readline()
-            if line is None:
+            reply = self._readline()
+            if reply is None:
                 break
-            if line.startswith('DEBUG_'):
-                continue
-            if line.startswith(tuple(self.greetings)) or line.startswith('ok'):
-                self.clear = True
-            if line.startswith('ok') and "T:" in line and self.tempcb:
+            self._handle_reply(reply)
+        self.clear = True
+
+    def _handle_reply(self, reply):
+        """Acts on a line received from the firmware once online"""
+        line = reply.line
+        if line:
+            self._last_response = time.time()
+        if self._kinematics_reader is not None:
+            self._read_kinematics(line)
+        kind = reply.kind
+        if kind == DEBUG:
+            return
+        if reply.ok:
+            self._acknowledge()
+            self.metrics.acknowledged(self.printing)
+            if kind == TEMPERATURES and self.tempcb:
                 #callback for temp, status, whatever
-                try: self.tempcb(line)
-                except: pass
-            elif line.startswith('Error'):
-                self.logError(line)
-            # Teststrings for resend parsing       # Firmware     exp. result
-            # line="rs N2 Expected checksum 67"    # Teacup       2
-            if line.lower().startswith("resend") or line.startswith("rs"):
-                for haystack in ["N:", "N", ":"]:
-                    line = line.replace(haystack, " ")
-                linewords = line.split()
-                while len(linewords) != 0:
-                    try:
-                        toresend = int(linewords.pop(0))
-                        self.resendfrom = toresend
-                        #print str(toresend)
-                        break
-                    except:
-                        pass
+                if self.dispatcher is not None:
+                    self.dispatcher.post("tempcb", line)
+                else:
+                    started = time.time()
+                    try: self.tempcb(line)
+                    except: pass
+                    self.metrics.callback("tempcb", started)
+        elif kind == GREETING:
+            self._reset_inflight()
+            self.clear = True
+        elif kind == ERROR:
+            self.logError(line)
+        elif kind == RESEND:
+            toresend = reply.resend
+            self.resend_requests += 1
+            self.metrics.resend(toresend)
+            if self._counting():
+                # Teacup's rs is not followed by an ok
+                self._request_resend(toresend, not line.startswith("rs"))
+            else:
+                if toresend is not None:
+                    self.resendfrom = toresend
                 self.clear = True
-        self.clear = True
+
+    def _query_kinematics(self):
+        """Asks the firmware for its motion settings, the answers being
+        handled by _read_kinematics"""
+        self._kinematics_reader = gcoder_kinematics.FirmwareSettingsReader()
+        self._kinematics_deadline = time.time() + 10
+        self.send_now("M115")
+        self.send_now("M503")
+
+    def _read_kinematics(self, line):
+        reader = self._kinematics_reader
+        reader.feed(line)
+        if not reader.done and time.time() < self._kinematics_deadline:
+            return
+        self._kinematics_reader = None
+        profile = reader.profile(self.kinematic_profile)
+        if profile is None:
+            logging.warning(_("Could not read the motion settings of the printer"))
+            return
+        self.kinematic_profile = profile
+        gcoder_kinematics.save_profile(self.port, profile)
+        if self.kinematicscb:
+            try: self.kinematicscb(profile)
+            except:
+                self.logError(_("Kinematics callback failed with:") +
+                              "\n" + traceback.format_exc())
 
     def _start_sender(self):
         self.stop_send_thread = False
@@ -327,27 +645,75 @@ class printcore():
 
     def _stop_sender(self):
         if self.send_thread:
-            self.stop_send_thread = True
+            with self._clear_condition:
+                self.stop_send_thread = True
+                self._clear_condition.notify_all()
             self.send_thread.join()
             self.send_thread = None
 
     def _sender(self):
         while not self.stop_send_thread:
             try:
-                command = self.priqueue.get(True, 0.1)
+                priority, command = self.priqueue.get_next(True, 0.1)
             except QueueEmpty:
                 continue
-            while self.printer and self.printing and not self.clear:
-                time.sleep(0.001)
+            if priority == EMERGENCY:
+                self._write_urgent(command)
+                continue
+            self._wait_clear(self._sender_stopped)
             self._send(command)
-            while self.printer and self.printing and not self.clear:
-                time.sleep(0.001)
+            self._wait_clear(self._sender_stopped)
+
+    def _sender_stopped(self):
+        return self.stop_send_thread
 
     def _checksum(self, command):
-        return reduce(lambda x, y: x ^ y, map(ord, command))
+        return reduce(xor, bytearray(command))
+
+    def _number(self, command, lineno):
+        prefix = "N" + str(lineno) + " " + command
+        return prefix + "*" + str(self._checksum(prefix))
+
+    def _encode_line(self, gline, lineno):
+        """Returns the text to send for gline, numbered and checksummed if
+        needed, "" if there is nothing to send or None for host commands"""
+        tline = gline.raw
+        if tline.lstrip().startswith(";@"):
+            return None
+        tline = tline.split(";")[0]
+        if tline and not self.printer_tcp:
+            return self._number(tline, lineno)
+        return tline
+
+    def _encode_ahead(self):
+        """Prepares the next encode_ahead lines of mainqueue, so that they
+        are ready to be written once the printer is clear to send. Lines are
+        queued in self._encoded as (queue index, line number, layer, gline,
+        text) tuples, see _encode_line for the text."""
+        encoded = self._encoded
+        if encoded:
+            index, lineno, layer, gline, command = encoded[-1]
+            index += 1
+            if command:
+                lineno += 1
+        else:
+            index, lineno = self.queueindex, self.lineno
+        layer_line = self.mainqueue.layer_line
+        end = index + self.encode_ahead - len(encoded)
+        while index < end:
+            item = layer_line(index)
+            if item is None:
+                break
+            layer, gline = item
+            command = self._encode_line(gline, lineno)
+            encoded.append((index, lineno, layer, gline, command))
+            index += 1
+            if command:
+                lineno += 1
 
     def startprint(self, gcode, startindex = 0):
-        """Start a print, gcode is an array of gcode commands.
+        """Start a print, gcode is a gcoder.GCode (or any of its variants,
+        such as a GCodeStream reading the lines lazily).
         returns True on success, False if already printing.
         The print queue will be replaced with the contents of the data array,
         the next line will be set to 0 and the firmware notified. Printing
@@ -360,15 +726,24 @@ class printcore():
         self.lineno = 0
         self.queueindex = startindex
         self.resendfrom = -1
+        self.resend_requests = 0
+        self.resent_lines = 0
+        if self.journal is not None:
+            self.journal.started(gcode, startindex)
+        # Not clear to send until the M110 is acknowledged. This is set
+        # before sending it, as the "ok" may arrive right after the write.
+        self.clear = False
         self._send("M110", -1, True)
-        if not gcode.lines:
+        if not startindex and gcode.layer_line(0) is None:
+            self.clear = True
             return True
-        self.clear = False
-        resuming = (startindex != 0)
+        self._start_print(resuming = (startindex != 0))
+        return True
+
+    def _start_print(self, resuming):
         self.print_thread = Thread(target = self._print,
                                    kwargs = {"resuming": resuming})
         self.print_thread.start()
-        return True
 
     # run a simple script if it exists, no multithreading
     def runSmallScript(self, filename):
@@ -398,6 +773,8 @@ class printcore():
             pass
 
         self.print_thread = None
+        if self.journal is not None:
+            self.journal.paused(self.queueindex)
 
         # saves the status
         self.pauseX = self.analyzer.abs_x
@@ -434,9 +811,7 @@ class printcore():
 
         self.paused = False
         self.printing = True
-        self.print_thread = Thread(target = self._print,
-                                   kwargs = {"resuming": True})
-        self.print_thread.start()
+        self._start_print(resuming = True)
 
     def send(self, command, wait = 0):
         """Adds a command to the checksummed main command queue if printing, or
@@ -450,34 +825,37 @@ class printcore():
         else:
             self.logError(_("Not connected to printer."))
 
-    def send_now(self, command, wait = 0):
+    def send_now(self, command, wait = 0, priority = None):
         """Sends a command to the printer ahead of the command queue, without a
-        checksum"""
+        checksum. priority is the class of the command (see
+        printcore_scheduler), guessed from the command if None"""
         if self.online:
-            self.priqueue.put_nowait(command)
+            if priority is None:
+                priority = command_class(command)
+            self.priqueue.put_nowait(command, priority)
+            if priority == EMERGENCY:
+                # Wake the threads waiting for the printer, which write the
+                # emergency commands right away, see _write_urgent
+                with self._clear_condition:
+                    self._clear_condition.notify_all()
         else:
             self.logError(_("Not connected to printer."))
 
     def _print(self, resuming = False):
         self._stop_sender()
+        self._encoded.clear()
         try:
             if self.startcb:
                 #callback for printing started
+                started = time.time()
                 try: self.startcb(resuming)
                 except:
                     self.logError(_("Print start callback failed with:") +
                                   "\n" + traceback.format_exc())
+                self.metrics.callback("startcb", started)
             while self.printing and self.printer and self.online:
                 self._sendnext()
-            self.sentlines = {}
-            self.log.clear()
-            self.sent = []
-            if self.endcb:
-                #callback for printing done
-                try: self.endcb()
-                except:
-                    self.logError(_("Print end callback failed with:") +
-                                  "\n" + traceback.format_exc())
+            self._end_print()
         except:
             self.logError(_("Print thread died due to the following error:") +
                           "\n" + traceback.format_exc())
@@ -485,6 +863,20 @@ class printcore():
             self.print_thread = None
             self._start_sender()
 
+    def _end_print(self):
+        self.sentlines.clear()
+        self.log.clear()
+        self.sent.clear()
+        self.metrics.stopped()
+        if self.endcb:
+            #callback for printing done
+            started = time.time()
+            try: self.endcb()
+            except:
+                self.logError(_("Print end callback failed with:") +
+                              "\n" + traceback.format_exc())
+            self.metrics.callback("endcb", started)
+
     #now only "pause" is implemented as host command
     def processHostCommand(self, command):
         command = command.lstrip()
@@ -497,96 +889,165 @@ class printcore():
     def _sendnext(self):
         if not self.printer:
             return
-        while self.printer and self.printing and not self.clear:
-            time.sleep(0.001)
-        # Only wait for oks when using serial connections
-        if not self.printer_tcp:
+        if self.printing and self.mainqueue is not None:
+            # Encode the next lines while the printer processes the last one
+            self._encode_ahead()
+        self._wait_clear()
+        if self.priqueue.urgent():
+            self._write_urgent()
+            return
+        if self._resyncing:
+            self._wait_quiet()
+        # Only wait for oks when using serial connections, and only when not
+        # streaming lines as long as they fit in the firmware buffer
+        if not self.printer_tcp and not self._counting():
             self.clear = False
         if not (self.printing and self.printer and self.online):
             self.clear = True
             return
         if self.resendfrom < self.lineno and self.resendfrom > -1:
+            if self.resendfrom not in self.sentlines:
+                self.logError(_("Printer asked to resend line %d, which is too old to be resent, stopping the print") % self.resendfrom)
+                self.resendfrom = -1
+                self.printing = False
+                return
             self._send(self.sentlines[self.resendfrom], self.resendfrom, False)
+            self.resent_lines += 1
+            self.metrics.resent()
             self.resendfrom += 1
             return
         self.resendfrom = -1
-        if not self.priqueue.empty():
-            self._send(self.priqueue.get_nowait())
-            self.priqueue.task_done()
+        command = self.priqueue.get_printing()
+        if command is not None:
+            self._send(command)
             return
-        if self.printing and self.queueindex < len(self.mainqueue):
-            (layer, line) = self.mainqueue.idxs(self.queueindex)
-            gline = self.mainqueue.all_layers[layer][line]
+        encoded = self._encoded
+        if self.printing:
+            if encoded and encoded[0][:2] != (self.queueindex, self.lineno):
+                # The print position changed since the lines were encoded
+                encoded.clear()
+            if not encoded:
+                self._encode_ahead()
+        if self.printing and encoded:
+            (index, lineno, layer, gline, command) = encoded.popleft()
+            parsed = gline
             if self.layerchangecb and self.queueindex > 0:
-                (prev_layer, prev_line) = self.mainqueue.idxs(self.queueindex - 1)
-                if prev_layer != layer:
-                    try: self.layerchangecb(layer)
-                    except: traceback.print_exc()
+                prev_item = self.mainqueue.layer_line(self.queueindex - 1)
+                if prev_item is not None and prev_item[0] != layer:
+                    if self.dispatcher is not None:
+                        self.dispatcher.post("layerchangecb", layer)
+                    else:
+                        started = time.time()
+                        try: self.layerchangecb(layer)
+                        except: traceback.print_exc()
+                        self.metrics.callback("layerchangecb", started)
             if self.preprintsendcb:
-                if self.queueindex + 1 < len(self.mainqueue):
-                    (next_layer, next_line) = self.mainqueue.idxs(self.queueindex + 1)
-                    next_gline = self.mainqueue.all_layers[next_layer][next_line]
-                else:
-                    next_gline = None
-                gline = self.preprintsendcb(gline, next_gline)
+                next_item = self.mainqueue.layer_line(self.queueindex + 1)
+                next_gline = next_item[1] if next_item is not None else None
+                started = time.time()
+                new_gline = self.preprintsendcb(gline, next_gline)
+                self.metrics.callback("preprintsendcb", started)
+                if new_gline is not gline:
+                    # The lines encoded after this one may need other numbers
+                    encoded.clear()
+                    gline = new_gline
+                    parsed = None
+                    if gline is not None:
+                        command = self._encode_line(gline, self.lineno)
             if gline is None:
                 self.queueindex += 1
                 self.clear = True
                 return
-            tline = gline.raw
-            if tline.lstrip().startswith(";@"):  # check for host command
-                self.processHostCommand(tline)
+            if command is None:  # host command
+                self.processHostCommand(gline.raw)
                 self.queueindex += 1
                 self.clear = True
                 return
 
-            tline = tline.split(";")[0]
-            if len(tline) > 0:
-                self._send(tline, self.lineno, True)
+            if len(command) > 0:
+                if self.journal is not None:
+                    self.journal.sent(index, layer, gline)
+                self._send_encoded(command, self.lineno, parsed)
                 self.lineno += 1
                 if self.printsendcb:
-                    try: self.printsendcb(gline)
-                    except: traceback.print_exc()
+                    if self.dispatcher is not None:
+                        self.dispatcher.post("printsendcb", gline)
+                    else:
+                        started = time.time()
+                        try: self.printsendcb(gline)
+                        except: traceback.print_exc()
+                        self.metrics.callback("printsendcb", started)
             else:
                 self.clear = True
             self.queueindex += 1
         else:
+            if self._counting() and self._wait_acknowledged():
+                return
             self.printing = False
             self.clear = True
             if not self.paused:
+                if self.journal is not None:
+                    self.journal.finished()
                 self.queueindex = 0
                 self.lineno = 0
                 self._send("M110", -1, True)
 
     def _send(self, command, lineno = 0, calcchecksum = False):
         # Only add checksums if over serial (tcp does the flow control itself)
-        if calcchecksum and not self.printer_tcp:
-            prefix = "N" + str(lineno) + " " + command
-            command = prefix + "*" + str(self._checksum(prefix))
-            if "M110" not in command:
-                self.sentlines[lineno] = command
+        if calcchecksum:
+            if not self.printer_tcp:
+                command = self._number(command, lineno)
+            self._send_encoded(command, lineno)
+        else:
+            if self.journal is not None:
+                self.journal.command(command)
+            self._write(command)
+
+    def _write_urgent(self, command = None):
+        """Writes command and the emergency commands queued, without waiting
+        for the printer to be clear to send nor for room in its receive
+        buffer: firmwares such as Marlin act on M112, M108 and M410 as soon
+        as they receive them."""
+        if command is None:
+            command = self.priqueue.get_urgent()
+        while command is not None:
+            if self.journal is not None:
+                self.journal.command(command)
+            self._write(command, urgent = True)
+            command = self.priqueue.get_urgent()
+
+    def _send_encoded(self, command, lineno, gline = None):
+        """Sends a command numbered lineno, already numbered and checksummed
+        when over serial. gline is the command as parsed in mainqueue, if
+        any."""
+        if not self.printer_tcp and "M110" not in command:
+            self.sentlines[lineno] = command
+        self._write(command, lineno, gline)
+
+    def _write(self, command, lineno = None, gline = None, urgent = False):
         if self.printer:
+            if urgent:
+                if self._counting():
+                    # Still takes its room, freed by its acknowledgement
+                    with self._clear_condition:
+                        self._inflight.append((len(command) + 1, time.time()))
+                        self._inflight_bytes += len(command) + 1
+            elif self._counting() and current_thread() is not self.read_thread:
+                if not self._wait_room(len(command) + 1, lineno):
+                    return
             self.sent.append(command)
-            # run the command through the analyzer
-            gline = None
-            try:
-                gline = self.analyzer.append(command, store = False)
-            except:
-                logging.warning(_("Could not analyze command %s:") % command +
-                                "\n" + traceback.format_exc())
-            if self.loud:
-                logging.info("SENT: %s" % command)
-            if self.sendcb:
-                try: self.sendcb(command, gline)
-                except: pass
             try:
-                self.printer.write(str(command + "\n"))
-                if self.printer_tcp:
+                if self._tcp_writer is not None:
                     try:
-                        self.printer.flush()
+                        self._tcp_writer.write(str(command + "\n"))
+                        if urgent:
+                            self._tcp_writer.flush()
                     except socket.timeout:
                         pass
+                else:
+                    self.printer.write(str(command + "\n"))
                 self.writefailures = 0
+                self.metrics.sent(lineno, len(command) + 1, self.printing)
             except socket.error as e:
                 if e.errno is None:
                     self.logError(_(u"Can't write to printer (disconnected ?):") +
@@ -600,3 +1061,24 @@ class printcore():
             except RuntimeError as e:
                 self.logError(_(u"Socket connection broken, disconnected. ({0}): {1}").format(e.errno, decode_utf8(e.strerror)))
                 self.writefailures += 1
+            # Run the command through the analyzer once written, the printer
+            # can meanwhile start processing it. Lines from mainqueue were
+            # already parsed, only commands sent on their own need to be.
+            try:
+                if gline is not None:
+                    self.analyzer.append_parsed(gline)
+                else:
+                    gline = self.analyzer.append(command, store = False)
+            except:
+                logging.warning(_("Could not analyze command %s:") % command +
+                                "\n" + traceback.format_exc())
+            if self.loud:
+                logging.info("SENT: %s" % command)
+            if self.sendcb:
+                if self.dispatcher is not None:
+                    self.dispatcher.post("sendcb", command, gline)
+                else:
+                    started = time.time()
+                    try: self.sendcb(command, gline)
+                    except: pass
+                    self.metrics.callback("sendcb", started)
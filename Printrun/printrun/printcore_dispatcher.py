@@ -0,0 +1,142 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Runs the callbacks of a printcore from a thread of their own, so that
+slow consumers (e.g. interface updates) do not delay the lines sent to the
+printer.
+
+The recvcb, sendcb, tempcb, printsendcb and layerchangecb events, and the
+replies for the handlers of printcore.protocol, are then posted by the
+print and read threads of printcore to a bounded queue, which a worker
+thread empties in order. An event of a callback named in coalesce
+replaces the event of the same callback still waiting in the queue, if any,
+when only the last one matters (e.g. the last temperature report). Events
+posted while the queue is full are dropped. Other callbacks are still run
+synchronously: preprintsendcb returns the line to send, and the others are
+rare.
+
+    p = printcore(port, baud)
+    p.dispatcher = CallbackDispatcher(p)
+"""
+
+import time
+import logging
+import traceback
+from collections import deque
+from threading import Thread, Condition, current_thread
+
+from printrun.printrun_utils import install_locale
+install_locale('pronterface')
+
+class CallbackDispatcher(object):
+    """Worker thread running the callbacks posted by a printcore"""
+
+    def __init__(self, core, size = 10000,
+                 coalesce = ("tempcb", "layerchangecb")):
+        self.core = core
+        self.size = size  # maximal number of events waiting in the queue
+        self.coalesce = frozenset(coalesce)
+        self._queue = deque()  # [callback name, args] events
+        self._pending = {}  # callback name: its event waiting in the queue,
+                            # for the coalesced callbacks
+        self._condition = Condition()
+        self._waiting = False  # the worker waits for events
+        self._running = False  # the worker runs callbacks
+        self._stopped = False
+        self.posted = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.thread = Thread(target = self._run, name = "printcore callbacks")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def post(self, name, *args):
+        """Queues a call of the callback name of the core with args,
+        returning False if the queue is full and the event was dropped"""
+        with self._condition:
+            if name in self.coalesce:
+                event = self._pending.get(name)
+                if event is not None:
+                    event[1] = args
+                    self.coalesced += 1
+                    return True
+            queue = self._queue
+            if len(queue) >= self.size:
+                self.dropped += 1
+                return False
+            event = [name, args]
+            queue.append(event)
+            if name in self.coalesce:
+                self._pending[name] = event
+            self.posted += 1
+            if len(queue) > self.max_depth:
+                self.max_depth = len(queue)
+            if self._waiting:
+                # flush may be waiting too
+                self._condition.notify_all()
+        return True
+
+    def _run(self):
+        condition = self._condition
+        while True:
+            with condition:
+                self._running = False
+                condition.notify_all()  # see flush
+                while not self._queue and not self._stopped:
+                    self._waiting = True
+                    condition.wait()
+                    self._waiting = False
+                if not self._queue:
+                    return
+                # Run the events queued so far, later ones cannot be
+                # coalesced with them anymore
+                events = self._queue
+                self._queue = deque()
+                self._pending.clear()
+                self._running = True
+            for name, args in events:
+                callback = getattr(self.core, name)
+                if callback is None:
+                    continue
+                started = time.time()
+                try: callback(*args)
+                except:
+                    logging.error(_("Callback %s failed with:") % name +
+                                  "\n" + traceback.format_exc())
+                self.core.metrics.callback(name, started)
+
+    def flush(self):
+        """Waits for the events posted so far to be run"""
+        if current_thread() is self.thread:
+            return
+        with self._condition:
+            while (self._queue or self._running) and self.thread.is_alive():
+                self._condition.wait()
+
+    def stop(self):
+        """Runs the events posted so far and stops the worker"""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if current_thread() is not self.thread:
+            self.thread.join()
+
+    def summary(self):
+        return {"posted": self.posted,
+                "coalesced": self.coalesced,
+                "dropped": self.dropped,
+                "queued": len(self._queue),
+                "max_depth": self.max_depth}
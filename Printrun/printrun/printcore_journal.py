@@ -0,0 +1,305 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Journal of the progress of the prints of a printcore, to resume them
+after the host crashed or lost power.
+
+The journal is a file to which JSON records are appended, one per line: a
+"start" record naming the printed file when a print starts, then
+"checkpoint" records every interval_lines lines or interval_seconds
+seconds, and an "end" record when the print is over. A checkpoint holds the
+index of the line being sent, its offset in the file and the analyzer state
+before it (position, E, feedrate, tool, relative modes...) when the GCode
+printed knows them (see gcoder.GCode.checkpoint), and the target
+temperatures set so far. Records are flushed as soon as written, so that
+they survive a crash of the host, but synced to the disk at most every
+sync_interval seconds (and when the print is paused or over), which bounds
+the progress lost on a power loss.
+
+    p.journal = PrintJournal("~/.printrun/journal")
+    ...
+    checkpoint = load_checkpoint("~/.printrun/journal")
+    if checkpoint is not None:
+        resume(p, checkpoint)
+
+resume reopens the file at the offset of the checkpoint, without parsing
+the lines before it, restores the temperatures and the state of the
+printer, and prints the rest of the file.
+
+Checkpoints record the lines sent, not the ones the printer executed, so
+the print is resumed from the first line not sent at the last checkpoint
+rather than from where the printer stopped:
+- the lines sent after the last checkpoint, at most interval_lines lines or
+  interval_seconds seconds of printing (plus sync_interval seconds of
+  checkpoints on a power loss), are printed again;
+- the lines sent before it but still waiting in the buffers of the
+  firmware (its receive buffer and planner queue) when the printer lost
+  power are skipped. When only the host stopped, the printer executed them
+  before waiting for more.
+"""
+
+import os
+import re
+import json
+import time
+import logging
+
+from printrun import gcoder
+from printrun.printrun_utils import install_locale
+install_locale('pronterface')
+
+# Heater set by the temperature commands (B for the bed, T for the tool)
+temperature_commands = {"M104": "T", "M109": "T", "M140": "B", "M190": "B"}
+temperature_exp = re.compile("^(?:N\d+\s*)?(M104|M109|M140|M190)\\b(.*)", re.I)
+parameter_exp = re.compile("([ST])\s*([-+]?[0-9]*\.?[0-9]+)", re.I)
+
+class PrintJournal(object):
+    """Append-only journal of the prints of a printcore, fed by it from its
+    print thread (see printcore.journal)"""
+
+    interval_lines = 500
+    interval_seconds = 2.
+    sync_interval = 10.
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self._file = None
+        self.gcode = None
+        # Targets set by the commands sent to the printer, during the prints
+        # or not: heater ("T0", "T1", "B"): target
+        self.temperatures = {}
+        self.tool = 0
+        self.layer = 0
+        self._lines = 0  # lines sent since the last checkpoint
+        self._last_checkpoint = 0
+        self._last_sync = 0
+
+    def _write(self, record, sync = False):
+        if self._file is None:
+            return
+        record["time"] = time.time()
+        try:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+            if sync or record["time"] - self._last_sync >= self.sync_interval:
+                os.fsync(self._file.fileno())
+                self._last_sync = record["time"]
+        except (IOError, OSError), e:
+            logging.error(_("Could not write to the print journal %s: %s")
+                          % (self.path, e))
+            self.close()
+
+    def started(self, gcode, index):
+        """Starts journaling the print of gcode from line index, replacing
+        the records of the previous print"""
+        self.close()
+        directory = os.path.dirname(self.path)
+        try:
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._file = open(self.path, "w")
+        except (IOError, OSError), e:
+            logging.error(_("Could not open the print journal %s: %s")
+                          % (self.path, e))
+            return
+        self.gcode = gcode
+        item = gcode.layer_line(index)
+        self.layer = item[0] if item is not None else 0
+        filename = gcode.filename
+        record = {"event": "start", "index": index, "file": None}
+        if filename is not None and os.path.exists(filename):
+            filename = os.path.abspath(filename)
+            stat = os.stat(filename)
+            record.update(file = filename, size = stat.st_size,
+                          mtime = stat.st_mtime)
+        self._write(record, sync = True)
+        self.checkpoint(index)
+
+    def command(self, command):
+        """Records the temperatures set by a command sent outside of the
+        lines of the print"""
+        match = temperature_exp.match(command.strip())
+        if match is not None:
+            self._set_temperature(match.group(1).upper(), match.group(2))
+
+    def _set_temperature(self, command, parameters):
+        heater = temperature_commands[command]
+        tool = self.tool
+        target = None
+        for name, value in parameter_exp.findall(parameters):
+            if name in "sS":
+                target = float(value)
+            else:
+                tool = int(float(value))
+        if target is None:
+            return
+        if heater == "T":
+            heater = "T%d" % tool
+        self.temperatures[heater] = target
+
+    def sent(self, index, layer, gline):
+        """Records line index of the print, from layer layer, which is about
+        to be sent"""
+        command = gline.command
+        if command in temperature_commands:
+            match = temperature_exp.match(gline.raw)
+            if match is not None:
+                self._set_temperature(command, match.group(2))
+        elif command and command[0] == "T":
+            try:
+                self.tool = int(command[1:])
+            except ValueError:
+                pass
+        self.layer = layer
+        self._lines += 1
+        if self._lines >= self.interval_lines \
+           or time.time() - self._last_checkpoint >= self.interval_seconds:
+            self.checkpoint(index)
+
+    def checkpoint(self, index, sync = False):
+        """Records that the print is to be resumed from line index"""
+        self._lines = 0
+        self._last_checkpoint = time.time()
+        if self._file is None:
+            return
+        record = {"event": "checkpoint", "index": index, "layer": self.layer,
+                  "offset": None, "state": None,
+                  "temperatures": self.temperatures}
+        checkpoint = self.gcode.checkpoint(index)
+        if checkpoint is not None:
+            record["offset"], record["state"] = checkpoint
+        self._write(record, sync)
+
+    def paused(self, index):
+        self.checkpoint(index, sync = True)
+
+    def finished(self):
+        """Records the end of the print: there is nothing to resume"""
+        self._write({"event": "end"}, sync = True)
+        self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.gcode = None
+
+def load_checkpoint(path):
+    """Returns the last checkpoint recorded in the journal at path, along
+    with the file, size and mtime of its print, or None if the print is
+    over or there is no journal. The last record may have been partially
+    written when the host stopped, in which case it is ignored"""
+    start = checkpoint = None
+    try:
+        with open(os.path.expanduser(path)) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                event = record.get("event")
+                if event == "start":
+                    start, checkpoint = record, None
+                elif event == "checkpoint":
+                    checkpoint = record
+                elif event == "end":
+                    start = checkpoint = None
+    except IOError:
+        return None
+    if start is None or checkpoint is None:
+        return None
+    checkpoint = dict(checkpoint)
+    for name in ("file", "size", "mtime"):
+        checkpoint[name] = start.get(name)
+    return checkpoint
+
+def resume_commands(state, temperatures, feedrate = 3000):
+    """Returns the commands bringing a printer which lost its state back to
+    the analyzer state state (see gcoder.GCode.checkpoint) and heating it
+    to temperatures. X and Y are homed, while Z is assumed not to have
+    moved (as done by pronterface when recovering after a disconnection);
+    feedrate is the feedrate of the travel move back to the last position
+    (mm/min)."""
+    commands = []
+    tools = sorted((int(heater[1:]), target)
+                   for heater, target in temperatures.items()
+                   if heater[0] == "T" and target > 0)
+    bed = temperatures.get("B", 0)
+    # Heat everything, then wait for each heater
+    if bed > 0:
+        commands.append("M140 S%g" % bed)
+    for tool, target in tools:
+        commands.append("M104 T%d S%g" % (tool, target))
+    if bed > 0:
+        commands.append("M190 S%g" % bed)
+    for tool, target in tools:
+        commands.append("M109 T%d S%g" % (tool, target))
+    # Restore the position and state in millimeters and absolute
+    # coordinates first
+    commands += ["G21", "G90", "M82",
+                 "T%d" % state["current_tool"],
+                 "G92 Z%.3f" % (state["current_z"] - state["offset_z"]),
+                 "G28 X Y",
+                 "G1 X%.3f Y%.3f F%d" % (state["current_x"], state["current_y"],
+                                         feedrate)]
+    if state["offset_x"] or state["offset_y"]:
+        commands.append("G92 X%.3f Y%.3f"
+                        % (state["current_x"] - state["offset_x"],
+                           state["current_y"] - state["offset_y"]))
+    commands.append("G92 E%.5f" % (state["current_e"] - state["offset_e"]))
+    if state["current_f"]:
+        commands.append("G1 F%.3f" % state["current_f"])
+    if state["relative"]:
+        commands.append("G91")
+        if not state["relative_e"]:
+            commands.append("M82")
+    elif state["relative_e"]:
+        commands.append("M83")
+    if state["imperial"]:
+        commands.append("G20")
+    return commands
+
+def resume(core, checkpoint, home_pos = None, feedrate = 3000):
+    """Resumes the print of checkpoint (see load_checkpoint) on the printer
+    of the printcore core, returning the gcoder.GCodeStream printed"""
+    filename = checkpoint["file"]
+    if filename is None:
+        raise ValueError(_("The journal does not tell which file was printed"))
+    if os.path.getsize(filename) != checkpoint["size"] \
+       or os.path.getmtime(filename) != checkpoint["mtime"]:
+        raise ValueError(_("%s changed since it was printed") % filename)
+    index = checkpoint["index"]
+    layer = checkpoint["layer"]
+    if checkpoint["offset"] is not None:
+        state = checkpoint["state"]
+        gcode = gcoder.GCodeStream(filename, home_pos, index,
+                                   checkpoint["offset"], state, layer)
+    else:
+        # The lines before the checkpoint have to be parsed to know the
+        # state
+        gcode = gcoder.GCodeStream(filename, home_pos)
+        found = gcode.checkpoint(index)
+        if found is None:
+            raise ValueError(_("Line %d of %s not found") % (index, filename))
+        state = found[1]
+    logging.info(_("Resuming the print of %s from line %d") % (filename, index))
+    if core.journal is not None:
+        core.journal.temperatures = dict(checkpoint["temperatures"])
+        core.journal.tool = state["current_tool"]
+    for command in resume_commands(state, checkpoint["temperatures"],
+                                   feedrate):
+        core.send_now(command)
+    core.startprint(gcode, index)
+    return gcode
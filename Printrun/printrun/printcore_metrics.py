@@ -0,0 +1,242 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Instrumentation of the exchanges of printcore with the printer, to tell
+whether a stuttering print is to blame on the host, the link or the
+firmware:
+
+- the send to "ok" latency of the lines, which grows with the link latency
+  and the time the firmware takes to process them,
+- the lines and bytes sent per second over sliding windows,
+- planner starvations: time spent printing with no line outstanding, the
+  firmware having nothing left to process while waiting for the host,
+- resend requests and lines resent,
+- the time spent in the printcore callbacks, which delays the sending of
+  the next line when they are run from the print thread.
+
+Firmwares answer the lines in order, so each "ok" is matched with the
+oldest line not acknowledged yet.
+
+The figures of the lines sent are only updated from the thread writing to
+the printer and those of the answers from the one reading from it, so that
+they are recorded without locking: this is run for every line.
+"""
+
+import time
+from bisect import bisect_left
+from collections import deque
+
+class Histogram(object):
+    """Counts of values by bucket: values up to bounds[i] and above
+    bounds[i - 1] are counted in counts[i], values above the last bound in
+    counts[-1]"""
+
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.clear()
+
+    def clear(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0.
+        self.max = 0.
+
+    def _get_count(self):
+        return sum(self.counts)
+    count = property(_get_count)
+
+    def add(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def mean(self):
+        count = self.count
+        return self.total / count if count else None
+
+    def percentile(self, fraction):
+        """Returns an upper bound of the given fraction of the values: the
+        bound of the bucket reaching it"""
+        count = self.count
+        if not count:
+            return None
+        rank = fraction * count
+        seen = 0
+        for bound, count in zip(self.bounds + [self.max], self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+class RateCounter(object):
+    """Lines and bytes counted per second, over the last seconds"""
+
+    def __init__(self, seconds):
+        self.buckets = deque(maxlen = seconds + 1)  # [second, lines, bytes]
+
+    def add(self, now, size):
+        second = int(now)
+        buckets = self.buckets
+        if buckets and buckets[-1][0] == second:
+            bucket = buckets[-1]
+            bucket[1] += 1
+            bucket[2] += size
+        else:
+            buckets.append([second, 1, size])
+
+    def rates(self, now, window):
+        """Returns the lines and bytes per second over the last window
+        seconds, not counting the current second which is not over"""
+        end = int(now)
+        start = end - window
+        lines = size = 0
+        for second, bucket_lines, bucket_size in list(self.buckets):
+            if start <= second < end:
+                lines += bucket_lines
+                size += bucket_size
+        return float(lines) / window, float(size) / window
+
+class PrintMetrics(object):
+    """Metrics of a printcore, fed by it from its threads"""
+
+    # Bounds of the latency histogram buckets (s)
+    latency_bounds = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1,
+                      0.2, 0.5, 1, 2, 5)
+    # Sliding windows of the throughput (s)
+    windows = (1, 10, 60)
+    # Minimal time with no line outstanding to count as a starvation (s)
+    starvation_threshold = 0.01
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.latency = Histogram(self.latency_bounds)
+        self._outstanding = deque(maxlen = 1024)  # (lineno, send time)
+        # (line number, send time, latency) of the last lines acknowledged
+        self.recent = deque(maxlen = 1000)
+        self._rates = RateCounter(max(self.windows))
+        self._rate_bucket = None  # current bucket of _rates
+        self._rate_bucket_end = 0
+        self.lines_sent = 0
+        self.bytes_sent = 0
+        self.idle_time = 0.
+        self.starvations = 0
+        # (time, line number sent, duration) of the last starvations
+        self.starvation_log = deque(maxlen = 100)
+        self._idle_since = None
+        self.resend_requests = 0
+        self.resent_lines = 0
+        self.callback_time = {}  # name: [calls, total time, max time]
+
+    def sent(self, lineno, size, printing):
+        """Records a line (of size bytes, lineno being None for unnumbered
+        lines) written to the printer"""
+        now = time.time()
+        self._outstanding.append((lineno, now))
+        self.lines_sent += 1
+        self.bytes_sent += size
+        if now < self._rate_bucket_end:
+            bucket = self._rate_bucket
+            bucket[1] += 1
+            bucket[2] += size
+        else:
+            self._rates.add(now, size)
+            self._rate_bucket = self._rates.buckets[-1]
+            self._rate_bucket_end = self._rate_bucket[0] + 1
+        idle_since = self._idle_since
+        if idle_since is not None:
+            self._idle_since = None
+            if printing:
+                idle = now - idle_since
+                self.idle_time += idle
+                if idle >= self.starvation_threshold:
+                    self.starvations += 1
+                    self.starvation_log.append((now, lineno, idle))
+
+    def acknowledged(self, printing):
+        """Records an "ok" from the printer"""
+        try:
+            lineno, sent = self._outstanding.popleft()
+        except IndexError:
+            return
+        now = time.time()
+        latency = now - sent
+        histogram = self.latency
+        histogram.counts[bisect_left(histogram.bounds, latency)] += 1
+        histogram.total += latency
+        if latency > histogram.max:
+            histogram.max = latency
+        self.recent.append((lineno, sent, latency))
+        if printing and not self._outstanding:
+            self._idle_since = now
+
+    def resend(self, lineno):
+        """Records a resend request: the lines outstanding are either
+        flushed by the printer or answered with other requests"""
+        self.resend_requests += 1
+        self._outstanding.clear()
+
+    def resent(self):
+        self.resent_lines += 1
+
+    def flush(self):
+        """Forgets about the lines outstanding, e.g. on printer reset"""
+        self._outstanding.clear()
+
+    def stopped(self):
+        """Records the end or pause of a print: the time until the next one
+        is not a starvation"""
+        self._idle_since = None
+
+    def callback(self, name, started):
+        """Records a call to the callback name which started at started"""
+        duration = time.time() - started
+        stats = self.callback_time.get(name)
+        if stats is None:
+            stats = self.callback_time[name] = [0, 0., 0.]
+        stats[0] += 1
+        stats[1] += duration
+        if duration > stats[2]:
+            stats[2] = duration
+
+    def summary(self):
+        """Returns the metrics as a dict, times being in seconds"""
+        now = time.time()
+        latency = self.latency
+        return {
+            "elapsed": now - self.started,
+            "lines_sent": self.lines_sent,
+            "bytes_sent": self.bytes_sent,
+            "outstanding": len(self._outstanding),
+            "latency": {"count": latency.count,
+                        "mean": latency.mean(),
+                        "p50": latency.percentile(0.5),
+                        "p90": latency.percentile(0.9),
+                        "p99": latency.percentile(0.99),
+                        "max": latency.max,
+                        "buckets": zip(latency.bounds + [None],
+                                       latency.counts)},
+            "rates": dict((window, self._rates.rates(now, window))
+                          for window in self.windows),
+            "idle_time": self.idle_time,
+            "starvations": self.starvations,
+            "starvation_log": list(self.starvation_log),
+            "resend_requests": self.resend_requests,
+            "resent_lines": self.resent_lines,
+            "callbacks": dict((name, tuple(stats)) for name, stats
+                              in self.callback_time.items()),
+        }
@@ -0,0 +1,180 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Parser of the lines received from the firmware.
+
+Each line is classified once, by a single compiled expression matching its
+start, into a Reply of one of the kinds below, the numbers it carries
+(temperatures, position, line to resend, SD progress) being parsed along.
+printcore acts on the replies (see printcore.protocol), then hands them to
+the handlers registered for their kind:
+
+    p.protocol.add_handler(temperatures_received, TEMPERATURES)
+    p.protocol.add_handler(replied)  # every reply
+"""
+
+import re
+import logging
+import traceback
+
+from printrun.printrun_utils import install_locale
+install_locale('pronterface')
+
+OK = "ok"  # acknowledgement of a line
+TEMPERATURES = "temperatures"  # temperature report, acknowledging a line
+                               # (ok T:...) or not (waits of M109...)
+POSITION = "position"  # position report (M114)
+RESEND = "resend"  # request to send lines again from Reply.resend
+ERROR = "error"
+SD = "sd"  # SD printing status (M27, file selection and end of print)
+ECHO = "echo"
+GREETING = "greeting"  # the firmware (re)started
+DEBUG = "debug"
+OTHER = "other"
+
+number = "([-+]?[0-9]*\.?[0-9]+)"
+temperature_exp = re.compile("([TB]\d*):\s*" + number + "(?:\s*/\s*" + number + ")?")
+position_exp = re.compile("([XYZE]):\s*" + number)
+resend_exp = re.compile("[\s:](\d+)(?!\S)")
+sd_exp = re.compile("SD printing byte (\d+)/(\d+)|Not SD printing|Done printing file|File opened|File selected|open failed")
+
+class Reply(object):
+    """Line received from the firmware, classified by a ReplyParser"""
+
+    __slots__ = ("kind", "line", "ok", "message", "temperatures", "position",
+                 "resend", "sd_progress")
+
+    def __init__(self, kind, line, ok = False, message = None):
+        self.kind = kind
+        self.line = line
+        self.ok = ok  # the line acknowledges a line sent
+        self.message = message  # text of error and echo lines
+        self.temperatures = None  # heater ("T", "T0", "B"...): (temperature,
+                                  # target or None)
+        self.position = None  # axis ("X", "Y", "Z", "E"): position
+        self.resend = None  # number of the line to send again, if given
+        self.sd_progress = None  # (bytes printed, size) of an SD print
+
+    def __repr__(self):
+        return "<Reply %s %r>" % (self.kind, self.line)
+
+class ReplyParser(object):
+    """Classifies the lines received from the firmware and runs the handlers
+    registered for them"""
+
+    def __init__(self, greetings = ("start", "Grbl ")):
+        # kind, or None for every kind: handlers. Replaced rather than
+        # modified, so that it can be read while handlers are added
+        self.handlers = {}
+        self._ok = Reply(OK, "ok\n", True)
+        self._empty = Reply(OTHER, "")
+        self.set_greetings(greetings)
+
+    def set_greetings(self, greetings):
+        """Sets the starts of the lines sent by the firmware when it
+        (re)starts"""
+        self.greetings = tuple(greetings)
+        starts = ["(ok)", "(Error)", "([Rr][Ee][Ss][Ee][Nn][Dd]|rs)",
+                  "(echo:)", "(DEBUG_)"]
+        if self.greetings:
+            starts.append("(%s)" % "|".join(re.escape(greeting)
+                                            for greeting in self.greetings))
+        self._start_exp = re.compile("|".join(starts))
+
+    def parse(self, line):
+        """Returns the Reply of line"""
+        if line == "ok\n":
+            return self._ok
+        if not line:
+            return self._empty
+        match = self._start_exp.match(line)
+        start = match.lastindex if match is not None else None
+        if start == 1:
+            reply = Reply(OK, line, True)
+        elif start == 2:
+            return Reply(ERROR, line, message = line[match.end():].lstrip(":").strip())
+        elif start == 3:
+            reply = Reply(RESEND, line)
+            # e.g. "Resend: 12", "Resend:N12" or "rs N12 Expected checksum 67"
+            found = resend_exp.search(line.replace("N", " "), match.end())
+            if found is not None:
+                reply.resend = int(found.group(1))
+            return reply
+        elif start == 4:
+            reply = Reply(ECHO, line, message = line[match.end():].strip())
+        elif start == 5:
+            return Reply(DEBUG, line)
+        elif start == 6:
+            return Reply(GREETING, line)
+        else:
+            reply = Reply(OTHER, line)
+            found = sd_exp.search(line)
+            if found is not None:
+                reply.kind = SD
+                if found.group(1) is not None:
+                    reply.sd_progress = (int(found.group(1)),
+                                         int(found.group(2)))
+                return reply
+        if "X:" in line:
+            position = {}
+            for axis, value in position_exp.findall(line):
+                if axis not in position:
+                    position[axis] = float(value)
+            if "X" in position and "Y" in position and "Z" in position:
+                reply.position = position
+                if reply.kind != ECHO:
+                    reply.kind = POSITION
+                return reply
+        if "T:" in line:
+            temperatures = {}
+            for heater, temperature, target in temperature_exp.findall(line):
+                temperatures[heater] = (float(temperature),
+                                        float(target) if target else None)
+            if temperatures:
+                reply.temperatures = temperatures
+                if reply.kind != ECHO:
+                    reply.kind = TEMPERATURES
+        return reply
+
+    def add_handler(self, handler, *kinds):
+        """Calls handler(reply) for the replies of the given kinds, or for
+        every reply if none is given"""
+        handlers = dict(self.handlers)
+        for kind in kinds or (None,):
+            handlers[kind] = handlers.get(kind, ()) + (handler,)
+        self.handlers = handlers
+
+    def remove_handler(self, handler):
+        handlers = {}
+        for kind, kind_handlers in self.handlers.items():
+            kind_handlers = tuple(h for h in kind_handlers if h != handler)
+            if kind_handlers:
+                handlers[kind] = kind_handlers
+        self.handlers = handlers
+
+    def wants(self, reply):
+        """Returns whether handlers are registered for reply"""
+        handlers = self.handlers
+        return bool(handlers) and (None in handlers or reply.kind in handlers)
+
+    def dispatch(self, reply):
+        """Runs the handlers registered for reply"""
+        handlers = self.handlers
+        for handler in handlers.get(reply.kind, ()) + handlers.get(None, ()):
+            try:
+                handler(reply)
+            except:
+                logging.error(_("Reply handler %s failed with:") % handler +
+                              "\n" + traceback.format_exc())
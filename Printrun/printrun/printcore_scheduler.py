@@ -0,0 +1,204 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Scheduler of the commands sent ahead of the print (printcore.priqueue).
+
+Commands are queued in priority classes: emergency commands (M112, M108,
+M410) go first, then user commands, then telemetry queries (M105, M114,
+M27), each class in the order its commands were queued. A telemetry query
+identical to one still waiting is dropped, as the answer to the waiting one
+will do: polls of the temperatures by several consumers do not pile up.
+
+While printing, a class may be given a share of the print lines sent:
+every print line credits it with its share, up to a burst, and each of its
+commands costs a credit, so that its commands are deferred in favor of the
+print lines once it used its share, e.g. 0.05 for at most 1 command for 20
+print lines. A class may also be given a deadline: a command which waited
+that many seconds is sent regardless of the credits, so that a slow print
+still gets its temperatures polled. By default only telemetry is limited:
+the user commands queued before a print (such as the heating and homing
+done when resuming one) have to be sent before its first line.
+
+Emergency commands are not scheduled along the others: printcore writes
+them as soon as they are queued, without waiting for the printer to be
+clear to send (see get_urgent), as firmwares act on them on receipt.
+
+    p.priqueue.shares[TELEMETRY] = 0.02
+    p.priqueue.deadlines[TELEMETRY] = 5
+"""
+
+import time
+from collections import deque
+from threading import Condition
+from Queue import Empty
+
+EMERGENCY = 0
+USER = 1
+TELEMETRY = 2
+classes = (EMERGENCY, USER, TELEMETRY)
+
+emergency_commands = frozenset(["M112", "M108", "M410"])
+telemetry_commands = frozenset(["M105", "M114", "M27"])
+
+def command_class(command):
+    """Returns the class of command, from its G-code"""
+    code = command.split(None, 1)[0].upper() if command.strip() else ""
+    if code in emergency_commands:
+        return EMERGENCY
+    if code in telemetry_commands:
+        return TELEMETRY
+    return USER
+
+class CommandScheduler(object):
+    """Queue of the commands sent with printcore.send_now, behaving like the
+    Queue it replaces for put_nowait, get, get_nowait, empty and
+    task_done"""
+
+    def __init__(self):
+        # (command, time queued) of each class
+        self._queues = [deque() for c in classes]
+        self._condition = Condition()
+        # Share of the print lines each class may use while printing, None
+        # for no limit, credits it can accumulate and seconds after which
+        # its commands are sent regardless of the credits
+        self.shares = {EMERGENCY: None, USER: None, TELEMETRY: 0.05}
+        self.bursts = {EMERGENCY: 1, USER: 8, TELEMETRY: 2}
+        self.deadlines = {EMERGENCY: None, USER: None, TELEMETRY: 2.0}
+        self._credits = dict(self.bursts)
+        self._lines = 0  # print lines sent
+        self._credited = dict((c, 0) for c in classes)  # value of _lines
+                                                        # when last credited
+        self.coalesce = True  # drop the telemetry queries already waiting
+        self.queued = [0] * len(classes)
+        self.coalesced = 0
+        self.deferred = 0  # print lines sent while commands were waiting
+                           # for credits
+        self.overdue = 0  # commands sent past their deadline
+
+    def put_nowait(self, command, priority = None):
+        """Queues command in class priority, guessed from the command if
+        None"""
+        if priority is None:
+            priority = command_class(command)
+        with self._condition:
+            queue = self._queues[priority]
+            if priority == TELEMETRY and self.coalesce:
+                key = command.strip().upper()
+                for waiting, queued in queue:
+                    if waiting.strip().upper() == key:
+                        self.coalesced += 1
+                        return
+            queue.append((command, time.time()))
+            self.queued[priority] += 1
+            self._condition.notify()
+
+    def put(self, command, block = True, timeout = None):
+        self.put_nowait(command)
+
+    def _pop(self):
+        for priority, queue in enumerate(self._queues):
+            if queue:
+                return priority, queue.popleft()[0]
+        raise Empty
+
+    def get_nowait(self):
+        """Returns the next command regardless of the shares, raising
+        Queue.Empty if there is none"""
+        with self._condition:
+            return self._pop()[1]
+
+    def urgent(self):
+        """Returns whether emergency commands are waiting"""
+        return bool(self._queues[EMERGENCY])
+
+    def get_urgent(self):
+        """Returns the next emergency command, or None if there is none"""
+        with self._condition:
+            queue = self._queues[EMERGENCY]
+            return queue.popleft()[0] if queue else None
+
+    def get_next(self, block = True, timeout = None):
+        """Returns the next command regardless of the shares, with its class,
+        as (class, command)"""
+        with self._condition:
+            if block:
+                end = time.time() + timeout if timeout is not None else None
+                while not any(self._queues):
+                    if end is None:
+                        self._condition.wait()
+                    else:
+                        remaining = end - time.time()
+                        if remaining <= 0:
+                            break
+                        self._condition.wait(remaining)
+            return self._pop()
+
+    def get(self, block = True, timeout = None):
+        return self.get_next(block, timeout)[1]
+
+    def get_printing(self):
+        """Returns the next command to send instead of a print line, or None
+        if the print line is to be sent. Called before each print line,
+        which credits the limited classes when it is sent"""
+        with self._condition:
+            queues = self._queues
+            if not (queues[EMERGENCY] or queues[USER] or queues[TELEMETRY]):
+                self._lines += 1
+                return None
+            now = None
+            for priority, queue in enumerate(queues):
+                if not queue:
+                    continue
+                share = self.shares[priority]
+                if share is None:
+                    return queue.popleft()[0]
+                # Credits earned by the print lines sent since the class was
+                # last credited
+                credit = min(self._credits[priority] + share *
+                             (self._lines - self._credited[priority]),
+                             self.bursts[priority])
+                self._credited[priority] = self._lines
+                if credit >= 1:
+                    self._credits[priority] = credit - 1
+                    return queue.popleft()[0]
+                self._credits[priority] = credit
+                deadline = self.deadlines[priority]
+                if deadline is not None:
+                    if now is None:
+                        now = time.time()
+                    if now - queue[0][1] >= deadline:
+                        self.overdue += 1
+                        return queue.popleft()[0]
+            self._lines += 1
+            self.deferred += 1
+            return None
+
+    def empty(self):
+        return not any(self._queues)
+
+    def qsize(self):
+        return sum(len(queue) for queue in self._queues)
+
+    def task_done(self):
+        pass
+
+    def summary(self):
+        return {"queued": {"emergency": self.queued[EMERGENCY],
+                           "user": self.queued[USER],
+                           "telemetry": self.queued[TELEMETRY]},
+                "coalesced": self.coalesced,
+                "deferred": self.deferred,
+                "overdue": self.overdue,
+                "waiting": self.qsize()}
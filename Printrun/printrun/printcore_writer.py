@@ -0,0 +1,131 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Coalesced writes to the socket of a TCP printer.
+
+printcore streams lines to TCP printers without waiting for their "ok", the
+network doing the flow control, so the throughput is bound by the cost of
+sending each line on its own: one system call and, with TCP_NODELAY, one
+packet per line. A CoalescingWriter holds the lines written for at most
+latency seconds, or until size bytes are waiting, and sends them at once.
+A thread of its own sends the lines which are still waiting once their
+latency budget is over, e.g. when no more lines follow.
+"""
+
+import time
+import logging
+import socket
+from threading import Thread, Condition
+
+from printrun.printrun_utils import install_locale
+install_locale('pronterface')
+
+class CoalescingWriter(object):
+    """Buffered writer of a socket, sending what was written at most
+    latency seconds ago in one go"""
+
+    def __init__(self, sock, latency = 0.002, size = 1400):
+        self.sock = sock
+        self.latency = latency  # s, 0 to send each write right away
+        self.size = size  # bytes waiting which trigger a send
+        self._buffer = []
+        self._buffered = 0
+        self._deadline = None  # time by which the buffer is to be sent
+        self._condition = Condition()
+        self._closed = False
+        self.writes = 0
+        self.sends = 0
+        self.thread = None
+        if latency > 0:
+            self.thread = Thread(target = self._run, name = "printcore writer")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def write(self, data):
+        """Queues data, sending what is waiting if the size or the latency
+        budget is reached. Errors are raised as socket.sendall raises them,
+        socket.timeout meaning the printer did not take the data yet: it
+        is kept to be sent later."""
+        with self._condition:
+            self._buffer.append(data)
+            self._buffered += len(data)
+            self.writes += 1
+            if self._deadline is None:
+                if self._buffered >= self.size or self.latency <= 0:
+                    self._send()
+                else:
+                    self._deadline = time.time() + self.latency
+                    self._condition.notify()
+            elif self._buffered >= self.size \
+                    or time.time() >= self._deadline:
+                self._send()
+
+    def flush(self):
+        """Sends what is waiting right away"""
+        with self._condition:
+            if self._buffered:
+                self._send()
+
+    def _send(self):
+        data = "".join(self._buffer)
+        sent = 0
+        self.sends += 1
+        try:
+            while sent < len(data):
+                sent += self.sock.send(data[sent:])
+        finally:
+            rest = data[sent:]
+            self._buffer = [rest] if rest else []
+            self._buffered = len(rest)
+            self._deadline = time.time() + self.latency if rest else None
+
+    def _run(self):
+        condition = self._condition
+        while True:
+            with condition:
+                while self._deadline is None and not self._closed:
+                    condition.wait()
+                if self._closed:
+                    return
+                delay = self._deadline - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            with condition:
+                if self._deadline is not None \
+                   and time.time() >= self._deadline:
+                    try:
+                        self._send()
+                    except socket.timeout:
+                        pass
+                    except socket.error, e:
+                        # printcore reports the error on its next write
+                        logging.debug("printcore writer: %s" % e)
+                        self._deadline = None
+
+    def close(self):
+        """Sends what is waiting, if possible, and stops the writer thread"""
+        with self._condition:
+            self._closed = True
+            if self._buffered:
+                try:
+                    self._send()
+                except socket.error:
+                    pass
+            self._buffer = []
+            self._buffered = 0
+            self._deadline = None
+            self._condition.notify()
+        if self.thread is not None:
+            self.thread.join()
@@ -112,8 +112,11 @@ class RemainingTimeEstimator(object):
     drift = None
     gcode = None
 
-    def __init__(self, gcode):
+    def __init__(self, gcode, profile = None):
         self.drift = 1
+        # Estimate durations with the kinematic profile of the printer
+        if profile is not None and profile is not gcode.kinematic_profile:
+            gcode.set_kinematic_profile(profile)
         self.previous_layers_estimate = 0
         self.current_layer_estimate = 0
         self.current_layer_lines = 0
@@ -33,6 +33,10 @@ from printrun.printrun_utils import install_locale, run_command, \
     get_home_pos, parse_build_dimensions
 install_locale('pronterface')
 from printrun import gcoder
+from printrun.gcoder_cache import GCodeCache
+from printrun.printcore_dispatcher import CallbackDispatcher
+from printrun.printcore_journal import PrintJournal, load_checkpoint, resume
+from printrun.printcore_protocol import TEMPERATURES
 
 from functools import wraps
 
@@ -303,10 +307,17 @@ class Settings(object):
         self._add(SpinSetting("xy_feedrate", 3000, 0, 50000, _("X && Y manual feedrate"), _("Feedrate for Control Panel Moves in X and Y (mm/min)"), "Printer"))
         self._add(SpinSetting("z_feedrate", 200, 0, 50000, _("Z manual feedrate"), _("Feedrate for Control Panel Moves in Z (mm/min)"), "Printer"))
         self._add(SpinSetting("e_feedrate", 100, 0, 1000, _("E manual feedrate"), _("Feedrate for Control Panel Moves in Extrusions (mm/min)"), "Printer"))
+        self._add(SpinSetting("rx_buffer_size", 0, 0, 4096, _("Firmware buffer size"), _("Size of the receive buffer of the firmware (bytes, e.g. 127 for Grbl). When set, lines are sent as long as they fit in it instead of waiting for an ok after each line. 0 to disable"), "Printer"))
+        self._add(FloatSpinSetting("tcp_write_latency", 2., 0, 100, _("Network write latency"), _("Longest time the lines sent to network (host:port) printers are held to be written together (ms). Takes effect when connecting. 0 to write each line right away"), "Printer"))
+        self._add(BooleanSetting("callback_thread", False, _("Run callbacks in a thread"), _("Handle the lines sent to and received from the printer in a thread of their own, so that slow interface updates do not delay the printer"), "Printer"))
+        self._add(BooleanSetting("query_kinematics", False, _("Read motion settings"), _("Read the maximum feedrates, accelerations and jerk of the printer (M115/M503) when connecting, to estimate print durations"), "Printer"))
         self._add(StringSetting("slicecommand", "python skeinforge/skeinforge_application/skeinforge_utilities/skeinforge_craft.py $s", _("Slice command"), _("Slice command"), "External"))
         self._add(StringSetting("sliceoptscommand", "python skeinforge/skeinforge_application/skeinforge.py", _("Slicer options command"), _("Slice settings command"), "External"))
         self._add(StringSetting("final_command", "", _("Final command"), _("Executable to run when the print is finished"), "External"))
         self._add(StringSetting("error_command", "", _("Error command"), _("Executable to run when an error occurs"), "External"))
+        self._add(SpinSetting("parse_processes", 1, 1, 64, _("Parsing processes"), _("Number of processes used to parse G-code files"), "External"))
+        self._add(SpinSetting("gcode_cache_size", 64, 0, 4096, _("G-code cache size"), _("Maximum size of the G-code analysis cache kept in ~/.printrun (MB), 0 to disable it"), "External"))
+        self._add(StringSetting("print_journal", "", _("Print journal"), _("File recording the progress of the prints (e.g. ~/.printrun/journal), to resume them with the recover command after a crash or power loss. Empty to disable it"), "External"))
 
         self._add(HiddenSetting("project_offset_x", 0.0))
         self._add(HiddenSetting("project_offset_y", 0.0))
@@ -400,14 +411,19 @@ class Status:
         self.print_job = None
         self.print_job_progress = 1.0
 
-    def update_tempreading(self, tempstr):
-            r = tempstr.split()
-            # eg. r = ["ok", "T:20.5", "/0.0", "B:0.0", "/0.0", "@:0"]
-            if len(r) == 6:
-                self.extruder_temp = float(r[1][2:])
-                self.extruder_temp_target = float(r[2][1:])
-                self.bed_temp = float(r[3][2:])
-                self.bed_temp_target = float(r[4][1:])
+    def update_temperatures(self, temperatures):
+        """Updates the readings from the temperatures of a report (see
+        printcore_protocol.Reply)"""
+        extruder = temperatures.get("T", temperatures.get("T0"))
+        if extruder is not None:
+            self.extruder_temp = extruder[0]
+            if extruder[1] is not None:
+                self.extruder_temp_target = extruder[1]
+        bed = temperatures.get("B")
+        if bed is not None:
+            self.bed_temp = bed[0]
+            if bed[1] is not None:
+                self.bed_temp_target = bed[1]
 
     @property
     def bed_enabled(self):
@@ -419,6 +435,9 @@ class Status:
 
 
 class pronsole(cmd.Cmd):
+    # Callbacks of which only the last event matters, see callback_thread
+    coalesced_callbacks = ("tempcb", "layerchangecb")
+
     def __init__(self):
         cmd.Cmd.__init__(self)
         if not READLINE:
@@ -428,6 +447,7 @@ class pronsole(cmd.Cmd):
         self.compute_eta = None
         self.p = printcore.printcore()
         self.p.recvcb = self.recvcb
+        self.p.protocol.add_handler(self.temperatures_received, TEMPERATURES)
         self.p.startcb = self.startcb
         self.p.endcb = self.endcb
         self.p.layerchangecb = self.layer_change_cb
@@ -435,6 +455,7 @@ class pronsole(cmd.Cmd):
         self.in_macro = False
         self.p.onlinecb = self.online
         self.p.errorcb = self.logError
+        self.p.kinematicscb = self.kinematicscb
         self.fgcode = None
         self.listing = 0
         self.sdfiles = []
@@ -455,6 +476,11 @@ class pronsole(cmd.Cmd):
         self.settings._temperature_pla_cb = self.set_temp_preset
         self.settings._bedtemp_abs_cb = self.set_temp_preset
         self.settings._bedtemp_pla_cb = self.set_temp_preset
+        self.settings._query_kinematics_cb = self.set_query_kinematics
+        self.settings._rx_buffer_size_cb = self.set_rx_buffer_size
+        self.settings._tcp_write_latency_cb = self.set_tcp_write_latency
+        self.settings._callback_thread_cb = self.set_callback_thread
+        self.settings._print_journal_cb = self.set_print_journal
         self.update_build_dimensions(None, self.settings.build_dimensions)
         self.monitoring = 0
         self.starttime = 0
@@ -566,6 +592,38 @@ class pronsole(cmd.Cmd):
         self.log("\rPrinter is now online")
         self.write_prompt()
 
+    def set_query_kinematics(self, key, value):
+        self.p.query_kinematics = self.settings.query_kinematics
+
+    def set_rx_buffer_size(self, key, value):
+        self.p.rx_buffer_size = self.settings.rx_buffer_size
+
+    def set_tcp_write_latency(self, key, value):
+        self.p.tcp_write_latency = self.settings.tcp_write_latency / 1000.
+
+    def set_callback_thread(self, key, value):
+        if self.settings.callback_thread and self.p.dispatcher is None:
+            self.p.dispatcher = CallbackDispatcher(self.p, coalesce = self.coalesced_callbacks)
+        elif not self.settings.callback_thread and self.p.dispatcher is not None:
+            dispatcher = self.p.dispatcher
+            self.p.dispatcher = None
+            dispatcher.stop()
+
+    def set_print_journal(self, key, value):
+        journal = self.p.journal
+        if self.settings.print_journal:
+            self.p.journal = PrintJournal(self.settings.print_journal)
+        else:
+            self.p.journal = None
+        if journal is not None:
+            journal.close()
+
+    def kinematicscb(self, profile):
+        self.log(_("Read the motion settings of the printer (%s)")
+                 % (profile.firmware or _("unknown firmware")))
+        if self.fgcode is not None and not self.p.printing:
+            self.fgcode.set_kinematic_profile(profile)
+
     def write_prompt(self):
         sys.stdout.write(self.promptf())
         sys.stdout.flush()
@@ -909,8 +967,17 @@ class pronsole(cmd.Cmd):
         self.log(_("Estimated duration: %s") % self.fgcode.estimate_duration())
 
     def load_gcode(self, filename):
-        self.fgcode = gcoder.GCode(open(filename, "rU"),
-                                   get_home_pos(self.build_dimensions_list))
+        home_pos = get_home_pos(self.build_dimensions_list)
+        profile = self.p.kinematic_profile
+        if self.settings.gcode_cache_size > 0:
+            cache = GCodeCache(max_size = self.settings.gcode_cache_size * 1024 * 1024)
+            self.fgcode = cache.load(filename, home_pos,
+                                     self.settings.parse_processes, profile)
+        else:
+            self.fgcode = gcoder.GCode(open(filename, "rU"), home_pos,
+                                       self.settings.parse_processes)
+            self.fgcode.set_kinematic_profile(profile)
+            self.fgcode.filename = filename
         self.fgcode.estimate_duration()
         self.filename = filename
 
@@ -1028,6 +1095,39 @@ class pronsole(cmd.Cmd):
     def help_resume(self):
         self.log(_("Resumes a paused print."))
 
+    def do_recover(self, l):
+        path = l.strip() or self.settings.print_journal
+        if not path:
+            self.logError(_("No print journal set, see the print_journal setting."))
+            return
+        if not self.p.online:
+            self.logError(_("Not connected to printer."))
+            return
+        if self.p.printing:
+            self.logError(_("Already printing."))
+            return
+        checkpoint = load_checkpoint(path)
+        if checkpoint is None:
+            self.logError(_("No print to recover in %s.") % path)
+            return
+        # The file is streamed from the checkpoint on, without the layers of
+        # the whole file the ETA is estimated from
+        self.compute_eta = None
+        try:
+            self.fgcode = resume(self.p, checkpoint,
+                                 get_home_pos(self.build_dimensions_list),
+                                 self.settings.xy_feedrate)
+        except (ValueError, IOError, OSError), e:
+            self.logError(_("Could not recover the print: %s") % e)
+            return
+        self.filename = checkpoint["file"]
+        self.paused = False
+        self.log(_("Recovering the print of %s from line %d.") % (self.filename, checkpoint["index"]))
+
+    def help_recover(self):
+        self.log(_("Resumes the print recorded in the print journal after a crash or a power loss: heats up, homes X and Y, restores Z, E, the feedrate and the coordinates modes, then prints the rest of the file."))
+        self.log(_("recover [journal] - Uses the given journal instead of the print_journal setting"))
+
     def emptyline(self):
         pass
 
@@ -1123,10 +1223,11 @@ class pronsole(cmd.Cmd):
         if (len(line.split()) == 2 and line[-1] != " ") or (len(line.split()) == 1 and line[-1] == " "):
             return [i for i in self.sdfiles if i.startswith(text)]
 
+    def temperatures_received(self, reply):
+        self.tempreadings = reply.line
+        self.status.update_temperatures(reply.temperatures)
+
     def recvcb(self, l):
-        if "T:" in l:
-            self.tempreadings = l
-            self.status.update_tempreading(l)
         tstring = l.rstrip()
         if tstring != "ok" and not self.listing and not self.monitoring:
             if tstring[:5] == "echo:":
@@ -1143,7 +1244,8 @@ class pronsole(cmd.Cmd):
             print _("Print resumed at: %s") % format_time(self.starttime)
         else:
             print _("Print started at: %s") % format_time(self.starttime)
-            self.compute_eta = RemainingTimeEstimator(self.fgcode)
+            self.compute_eta = RemainingTimeEstimator(self.fgcode,
+                                                      self.p.kinematic_profile)
 
     def endcb(self):
         if self.p.queueindex == 0:
@@ -1169,6 +1271,8 @@ class pronsole(cmd.Cmd):
     def do_eta(self, l):
         if not self.p.printing:
             self.logError(_("Printer is not currently printing. No ETA available."))
+        elif self.compute_eta is None:
+            self.logError(_("No ETA available for this print."))
         else:
             secondselapsed = int(time.time() - self.starttime + self.extra_print_time)
             secondsremain, secondsestimate = self.compute_eta(self.p.queueindex, secondselapsed)
@@ -1179,6 +1283,40 @@ class pronsole(cmd.Cmd):
     def help_eta(self):
         self.log(_("Displays estimated remaining print time."))
 
+    def do_metrics(self, l):
+        if l.strip() == "reset":
+            self.p.metrics.reset()
+            self.log(_("Metrics reset."))
+            return
+        metrics = self.p.metrics.summary()
+        self.log(_("%d lines (%d bytes) sent in %s") % (metrics["lines_sent"], metrics["bytes_sent"],
+                                                        format_duration(metrics["elapsed"])))
+        latency = metrics["latency"]
+        if latency["count"]:
+            self.log(_("Send to ok latency (ms): mean %.2f, median %.2f, 90%% %.2f, 99%% %.2f, max %.2f")
+                     % tuple(1000 * latency[key] for key in ("mean", "p50", "p90", "p99", "max")))
+            for bound, count in latency["buckets"]:
+                if count:
+                    label = "<= %g ms" % (1000 * bound) if bound is not None else _("more")
+                    self.log("  %-10s %d" % (label, count))
+        for window in sorted(metrics["rates"]):
+            lines, size = metrics["rates"][window]
+            self.log(_("Last %ds: %.1f lines/s, %.0f bytes/s") % (window, lines, size))
+        self.log(_("%d planner starvations (no line outstanding for %d ms or more), %.2fs without line outstanding")
+                 % (metrics["starvations"], 1000 * self.p.metrics.starvation_threshold, metrics["idle_time"]))
+        self.log(_("%d resend requests, %d lines resent") % (metrics["resend_requests"], metrics["resent_lines"]))
+        for name, (calls, total, longest) in sorted(metrics["callbacks"].items()):
+            self.log(_("%s: %d calls, %.1f ms in total, %.2f ms at most") % (name, calls, 1000 * total, 1000 * longest))
+        if self.p.dispatcher is not None:
+            dispatcher = self.p.dispatcher.summary()
+            self.log(_("Callback thread: %d events, %d coalesced, %d dropped, %d queued (%d at most)")
+                     % (dispatcher["posted"], dispatcher["coalesced"], dispatcher["dropped"],
+                        dispatcher["queued"], dispatcher["max_depth"]))
+
+    def help_metrics(self):
+        self.log(_("Displays the send to ok latencies, throughput, planner starvations, resends and callback times of the connection."))
+        self.log(_("metrics reset - Resets them"))
+
     def help_shell(self):
         self.log("Executes a python command. Example:")
         self.log("! os.listdir('.')")
@@ -17,7 +17,6 @@
 
 import os
 import Queue
-import re
 import sys
 import time
 import threading
@@ -57,12 +56,8 @@ from printrun.gui import MainWindow
 from printrun.excluder import Excluder
 from pronsole import dosify, wxSetting, HiddenSetting, StringSetting, SpinSetting, FloatSpinSetting, BooleanSetting, StaticTextSetting
 from printrun import gcoder
-
-tempreport_exp = re.compile("([TB]\d*):([-+]?\d*\.?\d*)(?: ?\/)?([-+]?\d*\.?\d*)")
-
-def parse_temperature_report(report):
-    matches = tempreport_exp.findall(report)
-    return dict((m[0], (m[1], m[2])) for m in matches)
+from printrun.printcore_journal import load_checkpoint
+from printrun.printcore_protocol import POSITION, TEMPERATURES
 
 class Tee(object):
     def __init__(self, target):
@@ -102,6 +97,8 @@ class ComboSetting(wxSetting):
 class PronterWindow(MainWindow, pronsole.pronsole):
 
     _fgcode = None
+    # printsentcb only highlights the last line sent
+    coalesced_callbacks = pronsole.pronsole.coalesced_callbacks + ("printsendcb",)
 
     def _get_fgcode(self):
         return self._fgcode
@@ -226,6 +223,9 @@ class PronterWindow(MainWindow, pronsole.pronsole):
         self.stdout = sys.stdout
         self.skeining = 0
         self.mini = False
+        # The replies are handled once classified, rather than as lines
+        self.p.recvcb = None
+        self.p.protocol.add_handler(self.received)
         self.p.sendcb = self.sentcb
         self.p.preprintsendcb = self.preprintsendcb
         self.p.printsendcb = self.printsentcb
@@ -526,7 +526,7 @@ class PronterWindow(MainWindow, pronsole.pronsole):
         self.menustrip.Append(m, _("&Tools"))
 
         m = wx.Menu()
-        self.recoverbtn = m.Append(-1, _("Recover"), _(" Recover previous print after a disconnect (homes X, Y, restores Z and E status)"))
+        self.recoverbtn = m.Append(-1, _("Recover"), _(" Recover previous print after a disconnect, or the print recorded in the print journal after a crash (homes X, Y, restores Z and E status)"))
         self.recoverbtn.Disable = lambda *a: self.recoverbtn.Enable(False)
         self.Bind(wx.EVT_MENU, self.recover, self.recoverbtn)
         self.menustrip.Append(m, _("&Advanced"))
@@ -1234,7 +1234,7 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
         if self.status_thread:
             self.status_thread.join()
             self.status_thread = None
-        self.p.recvcb = None
+        self.p.protocol.remove_handler(self.received)
         self.p.disconnect()
         if hasattr(self, "feedrates_changed"):
             self.save_in_rc("set xy_feedrate", "set xy_feedrate %d" % self.settings.xy_feedrate)
@@ -1296,57 +1296,35 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
     def clearOutput(self, e):
         self.logbox.Clear()
 
-    def update_tempdisplay(self):
+    def update_tempdisplay(self, temps):
         try:
-            # FIXME : we don't use setpoints here, we should probably exploit them
-            temps = parse_temperature_report(self.tempreport)
-            if "T0" in temps:
-                hotend_temp = float(temps["T0"][0])
-            else:
-                hotend_temp = float(temps["T"][0]) if "T" in temps else None
-            if hotend_temp is not None:
+            hotend = temps.get("T0", temps.get("T"))
+            if hotend is not None:
+                hotend_temp, setpoint = hotend
                 if self.display_graph: wx.CallAfter(self.graph.SetExtruder0Temperature, hotend_temp)
                 if self.display_gauges: wx.CallAfter(self.hottgauge.SetValue, hotend_temp)
-                setpoint = None
-                if "T0" in temps and temps["T0"][1]: setpoint = float(temps["T0"][1])
-                elif temps["T"][1]: setpoint = float(temps["T"][1])
                 if setpoint is not None:
                     if self.display_graph: wx.CallAfter(self.graph.SetExtruder0TargetTemperature, setpoint)
                     if self.display_gauges: wx.CallAfter(self.hottgauge.SetTarget, setpoint)
             if "T1" in temps:
-                hotend_temp = float(temps["T1"][0])
+                hotend_temp, setpoint = temps["T1"]
                 if self.display_graph: wx.CallAfter(self.graph.SetExtruder1Temperature, hotend_temp)
-                setpoint = temps["T1"][1]
-                if setpoint and self.display_graph:
-                    wx.CallAfter(self.graph.SetExtruder1TargetTemperature, float(setpoint))
-            bed_temp = float(temps["B"][0]) if "B" in temps else None
-            if bed_temp is not None:
+                if setpoint is not None and self.display_graph:
+                    wx.CallAfter(self.graph.SetExtruder1TargetTemperature, setpoint)
+            if "B" in temps:
+                bed_temp, setpoint = temps["B"]
                 if self.display_graph: wx.CallAfter(self.graph.SetBedTemperature, bed_temp)
                 if self.display_gauges: wx.CallAfter(self.bedtgauge.SetValue, bed_temp)
-                setpoint = temps["B"][1]
-                if setpoint:
-                    setpoint = float(setpoint)
+                if setpoint is not None:
                     if self.display_graph: wx.CallAfter(self.graph.SetBedTargetTemperature, setpoint)
                     if self.display_gauges: wx.CallAfter(self.bedtgauge.SetTarget, setpoint)
         except:
             traceback.print_exc()
 
-    def update_pos(self, l):
-        bits = gcoder.m114_exp.findall(l)
-        x = None
-        y = None
-        z = None
-        for bit in bits:
-            if not bit[0]: continue
-            if x is None and bit[0] == "X":
-                x = float(bit[1])
-            elif y is None and bit[0] == "Y":
-                y = float(bit[1])
-            elif z is None and bit[0] == "Z":
-                z = float(bit[1])
-        if x is not None: self.current_pos[0] = x
-        if y is not None: self.current_pos[1] = y
-        if z is not None: self.current_pos[2] = z
+    def update_pos(self, position):
+        if "X" in position: self.current_pos[0] = position["X"]
+        if "Y" in position: self.current_pos[1] = position["Y"]
+        if "Z" in position: self.current_pos[2] = position["Z"]
 
     def statuschecker(self):
         while self.statuscheck:
@@ -1372,10 +1350,12 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
                 string += _("Printing: %04.2f%% |") % (100 * float(self.p.queueindex) / len(self.p.mainqueue),)
                 string += _(" Line# %d of %d lines |") % (self.p.queueindex, len(self.p.mainqueue))
                 if self.p.queueindex > 0:
-                    secondselapsed = int(time.time() - self.starttime + self.extra_print_time)
-                    secondsremain, secondsestimate = self.compute_eta(self.p.queueindex, secondselapsed)
-                    string += _(" Est: %s of %s remaining | ") % (format_duration(secondsremain),
-                                                                  format_duration(secondsestimate))
+                    # No estimate for recovered prints, see do_recover
+                    if self.compute_eta is not None:
+                        secondselapsed = int(time.time() - self.starttime + self.extra_print_time)
+                        secondsremain, secondsestimate = self.compute_eta(self.p.queueindex, secondselapsed)
+                        string += _(" Est: %s of %s remaining | ") % (format_duration(secondsremain),
+                                                                      format_duration(secondsestimate))
                     string += _(" Z: %.3f mm") % self.curlayer
             wx.CallAfter(self.statusbar.SetStatusText, string)
             wx.CallAfter(self.gviz.Refresh)
@@ -1414,20 +1394,20 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
                 pass
         wx.CallAfter(self.statusbar.SetStatusText, _("Not connected to printer."))
 
-    def recvcb(self, l):
+    def received(self, reply):
+        l = reply.line
         isreport = False
-        if "ok C:" in l or "Count" in l \
-           or ("X:" in l and len(gcoder.m114_exp.findall(l)) == 6):
+        if reply.kind == POSITION:
             self.posreport = l
-            self.update_pos(l)
+            self.update_pos(reply.position)
             if self.userm114 > 0:
                 self.userm114 -= 1
             else:
                 isreport = True
-        if "ok T:" in l or ("T:" in l and "E:" in l):
+        elif reply.kind == TEMPERATURES:
             self.tempreport = l
             wx.CallAfter(self.tempdisp.SetLabel, self.tempreport.strip().replace("ok ", ""))
-            self.update_tempdisplay()
+            self.update_tempdisplay(reply.temperatures)
             if self.userm105 > 0:
                 self.userm105 -= 1
             else:
@@ -1781,7 +1761,9 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
             self.set("baudrate", str(baud))
         self.status_thread = threading.Thread(target = self.statuschecker)
         self.status_thread.start()
-        if self.predisconnect_mainqueue:
+        if self.predisconnect_mainqueue or \
+           (self.settings.print_journal
+            and load_checkpoint(self.settings.print_journal) is not None):
             self.recoverbtn.Enable()
 
     def recover(self, event):
@@ -1789,6 +1771,12 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
         if not self.p.online:
             wx.CallAfter(self.statusbar.SetStatusText, _("Not connected to printer."))
             return
+        if not self.predisconnect_mainqueue:
+            # Resume the print recorded in the journal, e.g. after a crash
+            self.do_recover("")
+            if self.p.printing:
+                self.on_startprint()
+            return
         # Reset Z
         self.p.send_now("G92 Z%f" % self.predisconnect_layer)
         # Home X and Y
@@ -0,0 +1,465 @@
+#!/usr/bin/env python
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Virtual printer: a simulated firmware behind a pseudo terminal or a TCP
+port, to test and benchmark hosts without hardware.
+
+Bytes reach the firmware at the given baud rate after a USB latency, land
+in a receive buffer of the given size (bytes received while it is full are
+lost) and are processed one line at a time, each line taking a fixed time
+to parse. Like Marlin, the firmware checks line numbers and checksums, asks
+for resends on errors after flushing its receive buffer, and only answers
+"ok" once a line is processed, the answer taking the USB latency to come
+back. Teacup style resend requests ("rs N", not followed by "ok") can be
+used instead. Lines can be corrupted on purpose, every error_every lines
+or at random with a probability of error_rate, to exercise the resend
+handling of the host.
+
+Moves go through a planner of planner_size moves: processing a move waits
+for a free slot, so that the ok pace follows the motion once the planner
+is full. Each move accelerates from and decelerates to a stop, and is
+timed from its length, feedrate, the maximum feedrates (M203) and the
+acceleration (M204). G4, M400, M109 and M190 wait for the planner to empty
+(and heaters to reach their target for M109 and M190). Heaters follow their
+target at heat_rate degrees per second. M105 reports temperatures, M115
+the firmware name and M503 the motion settings. speed scales the time of
+the motion and heating, 0 making them instantaneous; motion_time is the
+total unscaled time of the moves and dwells, to be compared with duration
+estimates.
+
+    python printrun/virtualprinter.py [--tcp PORT] [options]
+
+prints the name of the pseudo terminal (or the TCP port) to connect to.
+"""
+
+import os
+import sys
+import pty
+import tty
+import math
+import time
+import random
+import select
+import socket
+import hashlib
+import optparse
+from collections import deque
+
+def checksum(command):
+    return reduce(lambda x, y: x ^ y, bytearray(command), 0)
+
+def digest(lines):
+    return hashlib.md5("\n".join(lines)).hexdigest()
+
+class VirtualPrinter(object):
+    """Simulated firmware answering the lines sent by a host"""
+
+    room_temperature = 20.
+
+    def __init__(self, baud = 250000, latency = 1, line_time = 0.2,
+                 buffer_size = 127, planner_size = 16, flavor = "marlin",
+                 error_every = 0, error_rate = 0, seed = None, speed = 0,
+                 heat_rate = 5):
+        """latency and line_time are in ms, buffer_size in bytes"""
+        self.byte_time = 10. / baud
+        self.latency = latency / 1000.
+        self.line_time = line_time / 1000.
+        self.buffer_size = buffer_size
+        self.planner_size = planner_size
+        self.flavor = flavor
+        self.error_every = error_every
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.speed = speed
+        self.heat_rate = heat_rate
+        self.max_feedrate = {"X": 300., "Y": 300., "Z": 5., "E": 25.}
+        self.max_acceleration = {"X": 3000., "Y": 3000., "Z": 100., "E": 10000.}
+        self.acceleration = 3000.
+        self.jerk = {"X": 10., "Y": 10., "Z": .3, "E": 5.}
+        self.fd = None
+        self.received = 0  # numbered lines received
+        self.overflows = 0
+        self.resends = 0
+        self.executed = []  # commands of the numbered lines executed
+        self.motion_time = 0  # unscaled time of the moves and dwells
+        self.reset()
+
+    def reset(self):
+        """Puts the firmware back in its power on state"""
+        self.rx = deque()  # (arrival time, line, overflowed) of pending lines
+        self.rx_bytes = 0
+        self.arrival = 0  # arrival time of the last byte received
+        self.busy_until = 0
+        self.planner = deque()  # end times of the planned moves
+        self.motion_end = 0
+        self.responses = deque()  # (time, text) of the pending responses
+        self.pending = ""
+        self.last_n = -1
+        self.position = {"X": 0., "Y": 0., "Z": 0., "E": 0.}
+        self.feedrate = 1500.
+        self.relative = False
+        self.relative_e = False
+        # name: [temperature, target, time of the temperature]
+        self.heaters = dict((name, [self.room_temperature, 0., 0.])
+                            for name in ("T", "B"))
+
+    # Connections
+
+    def open_pty(self):
+        """Creates a pseudo terminal to talk through and returns the name of
+        the device the host is to open"""
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        # Keeping the slave open ensures reads of the master do not fail
+        # while the host is disconnected
+        self._slave = slave
+        self.fd = master
+        self.server = None
+        return os.ttyname(slave)
+
+    def listen_tcp(self, port = 0, host = "127.0.0.1"):
+        """Listens for a host on a TCP port and returns the port number;
+        one host can be connected at a time"""
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(1)
+        self.fd = None
+        return self.server.getsockname()[1]
+
+    def run(self):
+        """Serves the host until the pseudo terminal is closed or, over TCP,
+        forever"""
+        while True:
+            if self.fd is None:
+                self.client = self.server.accept()[0]
+                self.client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.fd = self.client.fileno()
+                self.reset()
+            if not self._serve():
+                if self.server is None:
+                    return
+                self.client.close()
+                self.fd = None
+
+    def _serve(self):
+        """Waits for data from the host and processes what is due; returns
+        False once the host disconnected"""
+        now = time.time()
+        self.process(now)
+        timeout = None
+        if self.responses:
+            timeout = max(0, self.responses[0][0] - now)
+        if self.rx:
+            start = max(self._start_time(self.rx[0][0]), now)
+            timeout = min(start - now, timeout if timeout is not None else 1)
+        readable = select.select([self.fd], [], [], timeout)[0]
+        if not readable:
+            return True
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError:
+            data = ""
+        if not data:
+            return False
+        self.feed(data, time.time())
+        return True
+
+    def feed(self, data, now):
+        """Receives data sent by the host at the given time"""
+        arrival = max(now + self.latency, self.arrival)
+        self.pending += data
+        lines = self.pending.split("\n")
+        self.pending = lines.pop()
+        for line in lines:
+            arrival += (len(line) + 1) * self.byte_time
+            self.receive(arrival, line.strip())
+        self.arrival = arrival
+
+    def process(self, now):
+        """Processes the lines due by now and sends the responses due"""
+        self.execute(now)
+        while self.responses and self.responses[0][0] <= now:
+            os.write(self.fd, self.responses.popleft()[1])
+
+    # Line processing
+
+    def receive(self, arrival, line):
+        # Free the buffer space of the lines processed by that time
+        self.execute(arrival)
+        overflowed = self.rx_bytes + len(line) + 1 > self.buffer_size
+        if overflowed:
+            self.overflows += 1
+        self.rx.append((arrival, line, overflowed))
+        self.rx_bytes += len(line) + 1
+
+    def _start_time(self, arrival):
+        """Time at which a line arrived at the given time can be processed:
+        once the previous line is, and a planner slot is free"""
+        start = max(arrival, self.busy_until)
+        if len(self.planner) >= self.planner_size:
+            start = max(start, self.planner[-self.planner_size])
+        return start
+
+    def execute(self, until):
+        """Processes the received lines up to the given time"""
+        while self.rx and self._start_time(self.rx[0][0]) <= until:
+            start = self._start_time(self.rx[0][0])
+            while self.planner and self.planner[0] <= start:
+                self.planner.popleft()
+            arrival, line, overflowed = self.rx.popleft()
+            self.rx_bytes -= len(line) + 1
+            self.busy_until = start + self.line_time
+            answer = self.handle(line, overflowed)
+            if answer.startswith(("Error", "rs")):
+                # Flush the lines received so far, like Marlin does
+                while self.rx and self.rx[0][0] <= start:
+                    self.rx_bytes -= len(self.rx.popleft()[1]) + 1
+            self.responses.append((self.busy_until + self.latency, answer))
+
+    def _resend(self, error):
+        self.resends += 1
+        if self.flavor == "teacup":
+            return "rs N%d %s\n" % (self.last_n + 1, error)
+        return "Error:%s, Last Line: %d\nResend: %d\nok\n" \
+            % (error, self.last_n, self.last_n + 1)
+
+    def _corrupted(self):
+        if self.error_every and self.received % self.error_every == 0:
+            return True
+        return self.error_rate and self.random.random() < self.error_rate
+
+    def handle(self, line, overflowed):
+        """Executes line, returning the answer to send"""
+        if line.startswith("N"):
+            self.received += 1
+            try:
+                number, command = line[1:].split(" ", 1)
+                command, sum = command.rsplit("*", 1)
+                number = int(number)
+                corrupted = overflowed \
+                    or checksum("N%d %s" % (number, command)) != int(sum)
+            except ValueError:
+                return self._resend("checksum mismatch")
+            if "M110" in command:
+                self.last_n = number
+                return "ok\n"
+            if number != self.last_n + 1:
+                return self._resend("Line Number is not Last Line Number+1")
+            if corrupted or self._corrupted():
+                return self._resend("checksum mismatch")
+            self.last_n = number
+            self.executed.append(command)
+            line = command
+        return self.command(line.split(";")[0].strip())
+
+    def command(self, line):
+        words = line.upper().split()
+        if not words:
+            return "ok\n"
+        code = words[0]
+        params = {}
+        for word in words[1:]:
+            try:
+                params[word[0]] = float(word[1:])
+            except ValueError:
+                params[word[0]] = None
+        if code in ("G0", "G1"):
+            self.move(params)
+        elif code == "G4":
+            duration = params.get("P") or 0
+            self.wait(duration / 1000. + (params.get("S") or 0))
+        elif code == "G28":
+            for axis in "XYZ":
+                if axis in params or not any(a in params for a in "XYZ"):
+                    self.position[axis] = 0.
+        elif code == "G90":
+            self.relative = self.relative_e = False
+        elif code == "G91":
+            self.relative = self.relative_e = True
+        elif code == "M82":
+            self.relative_e = False
+        elif code == "M83":
+            self.relative_e = True
+        elif code == "G92":
+            for axis in self.position:
+                if axis in params:
+                    self.position[axis] = params[axis] or 0.
+        elif code in ("M104", "M109", "M140", "M190"):
+            name = "B" if code in ("M140", "M190") else "T"
+            heater = self.heaters[name]
+            self._update_heater(heater, self.busy_until)
+            heater[1] = params.get("S") or 0
+            if code in ("M109", "M190"):
+                target = max(heater[1], self.room_temperature)
+                self.wait(abs(target - heater[0]) / self.heat_rate,
+                          heating = True)
+                heater[0] = target
+                heater[2] = self.busy_until
+        elif code == "M400":
+            self.wait(0)
+        elif code == "M105":
+            return "ok %s @:0\n" % self.temperatures()
+        elif code == "M115":
+            name = "Teacup" if self.flavor == "teacup" else "Marlin"
+            return "FIRMWARE_NAME:%s (virtual printer) PROTOCOL_VERSION:1.0 " \
+                "MACHINE_TYPE:Virtual EXTRUDER_COUNT:1\nok\n" % name
+        elif code == "M503":
+            return self.settings() + "ok\n"
+        elif code in ("M201", "M203", "M205"):
+            limits = {"M201": self.max_acceleration, "M203": self.max_feedrate,
+                      "M205": self.jerk}[code]
+            for axis in limits:
+                if params.get(axis):
+                    limits[axis] = params[axis]
+        elif code == "M204":
+            self.acceleration = params.get("P") or params.get("S") \
+                or self.acceleration
+        return "ok\n"
+
+    # Motion and heating
+
+    def move(self, params):
+        if params.get("F"):
+            self.feedrate = params["F"]
+        deltas = {}
+        for axis in self.position:
+            if params.get(axis) is None:
+                continue
+            relative = self.relative_e if axis == "E" else self.relative
+            target = self.position[axis] + params[axis] if relative \
+                else params[axis]
+            deltas[axis] = target - self.position[axis]
+            self.position[axis] = target
+        distance = math.sqrt(sum(deltas.get(axis, 0) ** 2 for axis in "XYZ"))
+        if not distance:
+            distance = abs(deltas.get("E", 0))
+        if not distance:
+            return
+        speed = self.feedrate / 60.
+        acceleration = self.acceleration
+        for axis, delta in deltas.items():
+            if delta:
+                ratio = distance / abs(delta)
+                speed = min(speed, self.max_feedrate[axis] * ratio)
+                acceleration = min(acceleration,
+                                   self.max_acceleration[axis] * ratio)
+        # Trapezoid from and to a stop, or triangle for short moves
+        if distance * acceleration >= speed ** 2:
+            duration = distance / speed + speed / acceleration
+        else:
+            duration = 2 * math.sqrt(distance / acceleration)
+        self.motion_time += duration
+        if self.speed:
+            self.motion_end = max(self.motion_end, self.busy_until) \
+                + duration / self.speed
+            self.planner.append(self.motion_end)
+
+    def wait(self, duration, heating = False):
+        """Waits for the planned moves to end, then for duration"""
+        if not heating:
+            self.motion_time += duration
+        start = max(self.busy_until, self.motion_end)
+        if self.speed:
+            start += duration / self.speed
+        self.busy_until = start
+        self.planner.clear()
+
+    def _update_heater(self, heater, now):
+        temperature, target, since = heater
+        # Heaters which are off cool down to the room temperature
+        target = max(target, self.room_temperature)
+        if self.speed:
+            step = self.heat_rate * self.speed * max(0, now - since)
+        else:
+            step = abs(target - temperature)
+        if temperature < target:
+            heater[0] = min(target, temperature + step)
+        else:
+            heater[0] = max(target, temperature - step)
+        heater[2] = now
+
+    def temperatures(self):
+        parts = []
+        for name in ("T", "B"):
+            heater = self.heaters[name]
+            self._update_heater(heater, self.busy_until)
+            parts.append("%s:%.1f /%.1f" % (name, heater[0], heater[1]))
+        return " ".join(parts)
+
+    def settings(self):
+        def values(limits):
+            return " ".join("%s%.2f" % (axis, limits[axis]) for axis in "XYZE")
+        return "echo:  M201 %s\necho:  M203 %s\necho:  M204 P%.2f R%.2f T%.2f\n" \
+            "echo:  M205 %s\n" % (values(self.max_acceleration),
+                                  values(self.max_feedrate), self.acceleration,
+                                  self.acceleration, self.acceleration,
+                                  values(self.jerk))
+
+def option_parser():
+    parser = optparse.OptionParser()
+    parser.add_option("--tcp", type = "int", default = None,
+                      help = "listen on a TCP port instead of a pseudo "
+                             "terminal (0 for any free port)")
+    parser.add_option("-b", "--baud", type = "int", default = 250000)
+    parser.add_option("-l", "--latency", type = "float", default = 1,
+                      help = "one way USB latency (ms)")
+    parser.add_option("-t", "--line-time", type = "float", default = 0.2,
+                      help = "time to process a line in the firmware (ms)")
+    parser.add_option("-r", "--buffer", type = "int", default = 127,
+                      help = "firmware receive buffer size (bytes)")
+    parser.add_option("-p", "--planner", type = "int", default = 16,
+                      help = "number of moves planned ahead")
+    parser.add_option("-e", "--errors", type = "int", default = 0,
+                      help = "corrupt one line every ERRORS lines")
+    parser.add_option("--error-rate", type = "float", default = 0,
+                      help = "probability for a line to be corrupted")
+    parser.add_option("--seed", type = "int", default = None,
+                      help = "seed of the random line corruptions")
+    parser.add_option("--flavor", type = "choice", default = "marlin",
+                      choices = ["marlin", "teacup"],
+                      help = "firmware protocol flavor")
+    parser.add_option("-s", "--speed", type = "float", default = 0,
+                      help = "speed factor of the simulated motion and "
+                             "heating, 0 to make them instantaneous")
+    return parser
+
+def from_options(options):
+    return VirtualPrinter(baud = options.baud, latency = options.latency,
+                          line_time = options.line_time,
+                          buffer_size = options.buffer,
+                          planner_size = options.planner,
+                          flavor = options.flavor,
+                          error_every = options.errors,
+                          error_rate = options.error_rate,
+                          seed = options.seed, speed = options.speed)
+
+def main():
+    options, args = option_parser().parse_args()
+    printer = from_options(options)
+    if options.tcp is not None:
+        print printer.listen_tcp(options.tcp)
+    else:
+        print printer.open_pty()
+    sys.stdout.flush()
+    try:
+        printer.run()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
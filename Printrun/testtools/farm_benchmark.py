@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmark of printrun.farm against loopback printers (see
+# printcore_loopback_benchmark.py). A farm of the given number of printers
+# prints the given number of copies of a synthetic file, parsed once. The
+# farm telemetry is shown while printing, then the aggregate lines/s and
+# the memory used per printer are reported, the latter being compared to
+# the memory used per threaded printcore connection.
+#
+# Usage: python testtools/farm_benchmark.py [nlines] [nprinters] [copies] [delay]
+
+import os
+import sys
+import time
+from threading import Thread
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printcore_loopback_benchmark import start_loopback
+
+def rss():
+    """Returns the resident memory of this process in bytes (Linux only)"""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+def stop_children(children):
+    for child in children:
+        child.kill()
+        child.wait()
+
+def printcore_memory(nprinters):
+    """Returns the memory used per threaded printcore connection"""
+    from printrun.printcore import printcore
+    children = []
+    printers = []
+    try:
+        before = rss()
+        for i in range(nprinters):
+            child, port = start_loopback()
+            children.append(child)
+            printers.append(printcore(port, 115200))
+        for p in printers:
+            while not p.online:
+                time.sleep(0.01)
+        return (rss() - before) / nprinters
+    finally:
+        for p in printers:
+            p.disconnect()
+        stop_children(children)
+
+def main():
+    from printrun import gcoder
+    from printrun.farm import Farm, Job
+    import synthetic_gcode
+    nlines = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    nprinters = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    copies = int(sys.argv[3]) if len(sys.argv) > 3 else 2 * nprinters
+    delay = float(sys.argv[4]) if len(sys.argv) > 4 else 0
+    job = Job("synthetic", gcoder.GCode(list(synthetic_gcode.slic3r_like(nlines))))
+    farm = Farm()
+    farm.pause_between_prints = False
+    children = []
+    loop_thread = Thread(target = farm.run)
+    loop_thread.start()
+    try:
+        before = rss()
+        for i in range(nprinters):
+            child, port = start_loopback(delay)
+            children.append(child)
+            farm.add_printer("printer%d" % i, port, 115200)
+        while len(farm.printers) < nprinters \
+                or farm.telemetry()["offline"]:
+            time.sleep(0.01)
+        farm_memory = (rss() - before) / nprinters
+        start = time.time()
+        farm.queue(job, copies)
+        while job.printed < copies:
+            time.sleep(1)
+            telemetry = farm.telemetry()
+            print "%d printing, %d queued, %d done, %d lines/s" \
+                % (telemetry["printing"], telemetry["queue_depth"],
+                   job.printed, telemetry["lines_per_second"])
+        elapsed = time.time() - start
+    finally:
+        farm.stop()
+        loop_thread.join()
+        stop_children(children)
+    print "%d printers, %d copies of %d lines in %.2fs: %d lines/s" \
+        % (nprinters, copies, len(job.gcode), elapsed,
+           copies * len(job.gcode) / elapsed)
+    print "memory per printer: %d kB for the farm, %d kB for printcore" \
+        % (farm_memory / 1024, printcore_memory(nprinters) / 1024)
+
+if __name__ == '__main__':
+    main()
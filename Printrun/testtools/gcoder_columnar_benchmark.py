@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compares parse time and memory usage of the gcoder storage backends:
+# PyLine objects, gcoder_line.GLine objects (if the extension is built), the
+# NumPy columnar store and the memory-mapped lazy GCode (whose parse time is
+# the load time, lines being parsed on access). Each backend is measured in its own process so
+# that peak resident memory figures don't pollute each other.
+#
+# Usage: python testtools/gcoder_columnar_benchmark.py [file.gcode|nlines]
+
+import os
+import sys
+import time
+import resource
+import subprocess
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+BACKENDS = ["pyline", "gline", "columnar", "mapped"]
+
+def maxrss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def measure(backend, filename):
+    from printrun import gcoder
+    if backend == "pyline":
+        gcoder.Line = gcoder.PyLine
+        cls = gcoder.GCode
+    elif backend == "gline":
+        try:
+            from printrun import gcoder_line
+        except ImportError:
+            print "%s skipped (gcoder_line extension not built)" % backend
+            return
+        gcoder.Line = gcoder_line.GLine
+        cls = gcoder.GCode
+    elif backend == "columnar":
+        from printrun.gcoder_columnar import ColumnarGCode
+        cls = ColumnarGCode
+    else:
+        cls = gcoder.MappedGCode
+    rss_before = maxrss_kb()
+    start = time.time()
+    if backend == "mapped":
+        gcode = cls(filename)
+    else:
+        gcode = cls(open(filename, "rU"))
+    parse_time = time.time() - start
+    rss_after = maxrss_kb()
+    print "%-9s %8d lines  parse %6.2fs  peak RSS +%7.1f MB  %6.1f bytes/line" \
+        % (backend, len(gcode), parse_time, (rss_after - rss_before) / 1024.,
+           1024. * (rss_after - rss_before) / max(1, len(gcode)))
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == "--backend":
+        measure(sys.argv[2], sys.argv[3])
+        return
+    arg = sys.argv[1] if len(sys.argv) > 1 else "1000000"
+    tmp = None
+    if os.path.exists(arg):
+        filename = arg
+    else:
+        import synthetic_gcode
+        fd, tmp = tempfile.mkstemp(suffix = ".gcode")
+        os.close(fd)
+        synthetic_gcode.write_file(tmp, synthetic_gcode.slic3r_like(int(arg)))
+        filename = tmp
+    try:
+        for backend in BACKENDS:
+            subprocess.call([sys.executable, os.path.abspath(__file__),
+                             "--backend", backend, filename])
+    finally:
+        if tmp:
+            os.unlink(tmp)
+
+if __name__ == '__main__':
+    main()
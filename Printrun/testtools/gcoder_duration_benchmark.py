@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Times the duration estimators on a G-code file or on synthetic Slic3r-like
+# output: the simple per-move estimator and the gcoder_kinematics planner.
+# Load times are given too, as the moves used by the planner are recorded
+# while loading.
+#
+# Usage: python testtools/gcoder_duration_benchmark.py [file.gcode|nlines]
+#            [planner_buffer]
+
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+import synthetic_gcode
+
+def main():
+    arg = sys.argv[1] if len(sys.argv) > 1 else "1000000"
+    planner_buffer = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    if os.path.exists(arg):
+        data = open(arg, "rU").readlines()
+    else:
+        data = list(synthetic_gcode.slic3r_like(int(arg)))
+
+    kinematics = gcoder.gcoder_kinematics
+    gcoder.gcoder_kinematics = None
+    start = time.time()
+    gcode = gcoder.GCode(data)
+    loaded = time.time()
+    total = gcode._estimate_layers_duration(gcode.all_layers)
+    end = time.time()
+    print "simple    %8.0fs: load %.2fs, estimate %.2fs" \
+        % (total, loaded - start, end - loaded)
+
+    gcoder.gcoder_kinematics = kinematics
+    start = time.time()
+    gcode = gcoder.GCode(data)
+    gcode.kinematic_profile = kinematics.KinematicProfile(
+        planner_buffer = planner_buffer)
+    loaded = time.time()
+    total = gcode._estimate_kinematic_duration()
+    end = time.time()
+    print "kinematic %8.0fs: load %.2fs, estimate %.2fs (%d moves)" \
+        % (total, loaded - start, end - loaded, len(gcode._moves))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Regression benchmark for layer detection on spiral vase mode G-code, where
+# every move changes Z. Files of n and 2n lines are loaded with GCode and
+# MappedGCode: as layer detection is meant to be linear, doubling the size
+# of the file should roughly double the load time. A ratio well above 2
+# means something went quadratic.
+#
+# Usage: python testtools/gcoder_layers_benchmark.py [nlines] [runs]
+
+import os
+import sys
+import time
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+import synthetic_gcode
+
+def best_time(load, runs):
+    best = None
+    for i in range(runs):
+        start = time.time()
+        gcode = load()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return gcode, best
+
+def main():
+    nlines = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    for adaptive in (False, True):
+        timings = {}
+        for count in (nlines, 2 * nlines):
+            data = list(synthetic_gcode.spiral_vase(count, adaptive = adaptive))
+            fd, path = tempfile.mkstemp(suffix = ".gcode")
+            os.close(fd)
+            synthetic_gcode.write_file(path, data)
+            try:
+                loaders = [("GCode", lambda: gcoder.GCode(data)),
+                           ("MappedGCode", lambda: gcoder.MappedGCode(path))]
+                for name, load in loaders:
+                    gcode, elapsed = best_time(load, runs)
+                    timings[name, count] = elapsed
+                    print "%-8s %-11s %7d lines %6d layers in %6.2fs: %d lines/s" \
+                        % ("adaptive" if adaptive else "vase", name, len(gcode),
+                           len(gcode.all_layers), elapsed, len(gcode) / elapsed)
+            finally:
+                os.unlink(path)
+        for name in ("GCode", "MappedGCode"):
+            print "%-8s %-11s time ratio for 2x lines: %.2f" \
+                % ("adaptive" if adaptive else "vase", name,
+                   timings[name, 2 * nlines] / timings[name, nlines])
+
+if __name__ == '__main__':
+    main()
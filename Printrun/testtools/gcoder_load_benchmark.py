@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Measures gcoder.GCode load throughput (lines/s) on a G-code file or on
+# synthetic Slic3r-like output, with both line implementations, optionally
+# tokenizing the lines in a pool of processes.
+#
+# Usage: python testtools/gcoder_load_benchmark.py [file.gcode|nlines] [runs]
+#            [processes]
+
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+import synthetic_gcode
+
+def bench(data, runs, processes = None):
+    best = None
+    for i in range(runs):
+        start = time.time()
+        gcode = gcoder.GCode(data, processes = processes)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(gcode), best
+
+def main():
+    arg = sys.argv[1] if len(sys.argv) > 1 else "500000"
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    processes = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    if os.path.exists(arg):
+        data = open(arg, "rU").readlines()
+    else:
+        data = list(synthetic_gcode.slic3r_like(int(arg)))
+    implementations = [("PyLine", gcoder.PyLine)]
+    try:
+        from printrun import gcoder_line
+        implementations.append(("GLine", gcoder_line.GLine))
+    except ImportError:
+        print "GLine skipped (gcoder_line extension not built)"
+    for name, line_class in implementations:
+        gcoder.Line = line_class
+        count, best = bench(data, runs, processes)
+        print "%-7s %d lines in %.2fs (best of %d): %d lines/s" \
+            % (name, count, best, runs, count / best)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Regression check of the layers found by MappedGCode, which only parses the
+# lines which may change Z, against the ones found by GCode: their number,
+# their Z and the Z keys of layers must be the same, and each layer must get
+# a duration. Spiral vase files (with fixed and adaptive layer heights),
+# where every move changes Z, are checked along with testfiles/quick-test.gcode.
+# Run it with the gcoder_line extension built (python setup.py build_ext
+# --inplace), as it parses the coordinates in single precision floats.
+#
+# Usage: python testtools/gcoder_mapped_layers_check.py [nlines]
+
+import os
+import sys
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+import synthetic_gcode
+
+def compare(name, path):
+    gcode = gcoder.GCode(open(path, "rU"))
+    mapped = gcoder.MappedGCode(path)
+    zs = [layer.z for layer in gcode.all_layers[:gcode.append_layer_id]]
+    mapped_zs = [layer.z for layer in mapped.all_layers[:mapped.append_layer_id]]
+    errors = []
+    if len(zs) != len(mapped_zs):
+        errors.append("%d layers instead of %d" % (len(mapped_zs), len(zs)))
+    differing = [(z, mapped_z) for z, mapped_z in zip(zs, mapped_zs)
+                 if z != mapped_z]
+    if differing:
+        errors.append("%d layers at another Z, e.g. %r instead of %r"
+                      % (len(differing), differing[0][1], differing[0][0]))
+    if sorted(gcode.layers.keys()) != sorted(mapped.layers.keys()):
+        errors.append("other Z keys in layers")
+    missing = sum(1 for layer in mapped.all_layers[:mapped.append_layer_id]
+                  if layer.duration is None)
+    if missing:
+        errors.append("%d layers without a duration" % missing)
+    print "%-16s %6d lines %5d layers: %s" \
+        % (name, len(gcode), len(zs), "; ".join(errors) if errors else "ok")
+    return not errors
+
+def main():
+    nlines = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    if gcoder.Line is gcoder.PyLine:
+        print "Warning: the gcoder_line extension is not built"
+    ok = True
+    for adaptive in (False, True):
+        fd, path = tempfile.mkstemp(suffix = ".gcode")
+        os.close(fd)
+        synthetic_gcode.write_file(path, synthetic_gcode.spiral_vase(nlines, adaptive = adaptive))
+        try:
+            ok &= compare("adaptive vase" if adaptive else "vase", path)
+        finally:
+            os.unlink(path)
+    testfile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                            "testfiles", "quick-test.gcode")
+    ok &= compare("quick-test.gcode", testfile)
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()
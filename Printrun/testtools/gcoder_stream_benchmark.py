@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compares the ways of loading a file to print with printcore: gcoder.GCode,
+# gcoder.MappedGCode and gcoder.GCodeStream. For each of them, the time until
+# the first line can be sent, the time to walk through all the lines the way
+# printcore does and the peak memory of the process are reported. Each
+# class is measured in a process of its own, on a G-code file or on
+# synthetic Slic3r-like output.
+#
+# Usage: python testtools/gcoder_stream_benchmark.py [file.gcode|nlines]
+
+import os
+import sys
+import time
+import resource
+import tempfile
+import subprocess
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+import synthetic_gcode
+
+classes = ("GCode", "MappedGCode", "GCodeStream")
+
+def load(name, filename):
+    if name == "GCode":
+        return gcoder.GCode(open(filename, "rU"))
+    return getattr(gcoder, name)(filename)
+
+def measure(name, filename):
+    """Prints the first line time, walk time, line count and peak memory"""
+    start = time.time()
+    gcode = load(name, filename)
+    gcode.layer_line(0)
+    first = time.time() - start
+    i = 0
+    while gcode.layer_line(i) is not None:
+        i += 1
+    walk = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # kB
+    print first, walk, i, peak
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == "--measure":
+        measure(sys.argv[2], sys.argv[3])
+        return
+    arg = sys.argv[1] if len(sys.argv) > 1 else "500000"
+    temporary = None
+    if os.path.exists(arg):
+        filename = arg
+    else:
+        fd, temporary = tempfile.mkstemp(suffix = ".gcode")
+        with os.fdopen(fd, "w") as f:
+            for line in synthetic_gcode.slic3r_like(int(arg)):
+                f.write(line + "\n")
+        filename = temporary
+    try:
+        print "%s: %.1f MB" % (arg, os.path.getsize(filename) / 1048576.)
+        for name in classes:
+            output = subprocess.check_output([sys.executable, __file__,
+                                              "--measure", name, filename])
+            first, walk, count, peak = output.split()
+            print "%-12s first line after %7.3fs, %s lines walked in %6.2fs, %6.1f MB peak" \
+                % (name, float(first), count, float(walk), int(peak) / 1024.)
+    finally:
+        if temporary is not None:
+            os.remove(temporary)
+
+if __name__ == '__main__':
+    main()
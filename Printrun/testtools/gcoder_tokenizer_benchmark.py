@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compares the throughput (lines/s) of the pure Python G-code tokenizer and
+# of the compiled one from the gcoder_line extension, both on their own and
+# as part of a full gcoder.GCode load.
+#
+# Usage: python testtools/gcoder_tokenizer_benchmark.py [file.gcode|nlines]
+#            [runs]
+
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+import synthetic_gcode
+
+def best_time(func, runs):
+    best = None
+    for i in range(runs):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main():
+    arg = sys.argv[1] if len(sys.argv) > 1 else "500000"
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    if os.path.exists(arg):
+        data = open(arg, "rU").readlines()
+    else:
+        data = list(synthetic_gcode.slic3r_like(int(arg)))
+    compiled = gcoder.compiled_tokenize_chunk
+    tokenizers = [("python", gcoder._tokenize_chunk)]
+    if compiled is not None:
+        tokenizers.append(("compiled", compiled))
+    else:
+        print "compiled tokenizer skipped (gcoder_line extension not built)"
+    chunks = list(gcoder.raw_chunks(data, gcoder.GCode.chunk_size))
+    for name, tokenize in tokenizers:
+        def run():
+            for chunk in chunks:
+                tokenize(chunk)
+        best = best_time(run, runs)
+        print "tokenize %-8s %d lines in %.2fs (best of %d): %d lines/s" \
+            % (name, len(data), best, runs, len(data) / best)
+    for name, tokenize in tokenizers:
+        gcoder.compiled_tokenize_chunk = tokenize if name == "compiled" else None
+        best = best_time(lambda: gcoder.GCode(data), runs)
+        print "GCode    %-8s %d lines in %.2fs (best of %d): %d lines/s" \
+            % (name, len(data), best, runs, len(data) / best)
+    gcoder.compiled_tokenize_chunk = compiled
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Streaming benchmark for printcore against loopback printers. Each printer
+# is a child process answering "ok" to every line it reads on a pseudo
+# terminal, so that printcore talks to it like to a serial printer, waiting
+# for an "ok" before sending the next line. The given number of printers
+# print the same file at the same time; the lines/s of each printer and the
+# CPU time used by this process (i.e. by printcore, the loopback printers
+# being separate processes) per printer are reported. Giving a delay makes
+# the loopback printers wait that many milliseconds before answering each
+# line, like a firmware busy planning moves would. The loopback printers also
+# time how long printcore takes to send a line after getting an "ok", the
+# median of which is reported as the turnaround. With --events, the printers
+# are driven by eventcore instances sharing a single event loop thread
+# instead of by printcore threads.
+#
+# Usage: python testtools/printcore_loopback_benchmark.py [--events] [nlines] [nprinters] [delay]
+#        python testtools/printcore_loopback_benchmark.py --loopback [delay]
+#
+# The second form runs a single loopback printer and prints the name of its
+# pseudo terminal.
+
+import os
+import sys
+import pty
+import tty
+import time
+import signal
+import subprocess
+from threading import Event, Thread
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+def loopback(delay = 0):
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    print os.ttyname(slave)
+    sys.stdout.flush()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    pending = ""
+    answered = None
+    turnarounds = []
+    try:
+        while True:
+            data = os.read(master, 65536)
+            if not data:
+                break
+            if answered is not None:
+                turnarounds.append(time.time() - answered)
+                answered = None
+            pending += data
+            lines = pending.split("\n")
+            pending = lines.pop()
+            if lines:
+                if delay:
+                    time.sleep(delay / 1000. * len(lines))
+                os.write(master, "ok\n" * len(lines))
+                answered = time.time()
+    finally:
+        turnarounds.sort()
+        sys.stderr.write("%f" % (turnarounds[len(turnarounds) / 2]
+                                 if turnarounds else 0))
+
+def start_loopback(delay = 0):
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                              "--loopback", str(delay)],
+                             stdout = subprocess.PIPE,
+                             stderr = subprocess.PIPE)
+    return child, child.stdout.readline().strip()
+
+def main(args):
+    from printrun import gcoder
+    from printrun.printcore import printcore
+    import synthetic_gcode
+    loop = None
+    if args and args[0] == "--events":
+        from printrun.eventcore import eventcore, EventLoop
+        loop = EventLoop()
+        loop_thread = Thread(target = loop.run)
+        args = args[1:]
+    nlines = int(args[0]) if len(args) > 0 else 20000
+    nprinters = int(args[1]) if len(args) > 1 else 1
+    delay = float(args[2]) if len(args) > 2 else 0
+    gcode = gcoder.GCode(list(synthetic_gcode.slic3r_like(nlines)))
+    children = []
+    printers = []
+    try:
+        for i in range(nprinters):
+            child, port = start_loopback(delay)
+            children.append(child)
+            if loop is not None:
+                p = eventcore(port, 115200, loop = loop)
+            else:
+                p = printcore(port, 115200)
+            p.done = Event()
+            p.endcb = p.done.set
+            printers.append(p)
+        if loop is not None:
+            loop_thread.start()
+        for p in printers:
+            while not p.online:
+                time.sleep(0.01)
+        cpu_start = sum(os.times()[:2])
+        start = time.time()
+        for p in printers:
+            if loop is not None:
+                # eventcore is to be used from the loop thread
+                loop.add_callback(p.startprint, gcode)
+            else:
+                p.startprint(gcode)
+        for p in printers:
+            p.done.wait(3600)
+            p.elapsed = time.time() - start
+        cpu = sum(os.times()[:2]) - cpu_start
+        elapsed = time.time() - start
+    finally:
+        for p in printers:
+            if loop is not None:
+                loop.add_callback(p.disconnect)
+            else:
+                p.disconnect()
+        if loop is not None:
+            loop.stop()
+            if loop_thread.is_alive():
+                loop_thread.join()
+        for child in children:
+            child.terminate()
+            child.turnaround = float(child.communicate()[1].split()[-1])
+    for i, (p, child) in enumerate(zip(printers, children)):
+        print "printer %d: %d lines in %.2fs: %d lines/s, %.1f us turnaround" \
+            % (i, len(gcode), p.elapsed, len(gcode) / p.elapsed,
+               1e6 * child.turnaround)
+    print "%d printer(s): %.2fs wall, %.2fs CPU, %.2fs CPU per printer, " \
+        "%.1f us CPU per line" % (nprinters, elapsed, cpu, cpu / nprinters,
+                                  1e6 * cpu / (nprinters * len(gcode)))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "--loopback":
+        loopback(float(sys.argv[2]) if len(sys.argv) > 2 else 0)
+    else:
+        main(sys.argv[1:])
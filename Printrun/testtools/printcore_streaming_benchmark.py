@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmark of printcore's character counting mode (rx_buffer_size) against
+# the default ping-pong mode, where an "ok" is awaited after every line.
+#
+# The printer is a child process running printrun.virtualprinter behind a
+# pseudo terminal: bytes reach the firmware at the given baud rate after a
+# USB latency, land in a receive buffer of the given size and are processed
+# one line at a time, each line taking a fixed time to plan. Bytes received
+# while the buffer is full are lost, which shows up as overflows and
+# resends. Every --errors lines, a line is treated as corrupted to exercise
+# the resend handling. Use it with --mode counting: in ping-pong mode,
+# printcore takes both the resend request and the "ok" following it as
+# clear to send, which with such error rates ends up in endless resend
+# loops. With --speed, moves take their simulated time, and the simulated
+# motion time is compared with the duration estimated by gcoder.
+#
+# The file is checked to have been executed entirely and in order.
+#
+# Usage: python testtools/printcore_streaming_benchmark.py [options]
+
+import os
+import sys
+import time
+import signal
+import subprocess
+from threading import Event
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import virtualprinter
+
+def firmware(options):
+    printer = virtualprinter.from_options(options)
+    print printer.open_pty()
+    sys.stdout.flush()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        printer.run()
+    finally:
+        sys.stderr.write("%d %d %d %d %s %f"
+                         % (printer.received, printer.overflows,
+                            printer.resends, len(printer.executed),
+                            virtualprinter.digest(printer.executed),
+                            printer.motion_time))
+
+def main():
+    parser = virtualprinter.option_parser()
+    parser.add_option("-n", "--lines", type = "int", default = 5000,
+                      help = "number of G-code lines to print")
+    parser.add_option("-m", "--mode", type = "choice", default = "both",
+                      choices = ["both", "ping-pong", "counting"],
+                      help = "send modes to benchmark")
+    parser.add_option("--firmware", action = "store_true",
+                      help = "run the simulated firmware, printing the name "
+                             "of its pseudo terminal")
+    options, args = parser.parse_args()
+    if options.firmware:
+        return firmware(options)
+
+    from printrun import gcoder
+    from printrun.printcore import printcore
+    import synthetic_gcode
+    gcode = gcoder.GCode(list(synthetic_gcode.slic3r_like(options.lines)))
+    expected = [line.raw.split(";")[0] for line in gcode]
+    expected = [line for line in expected if line]
+    if options.speed:
+        gcode.estimate_duration()
+    print "%d baud, %.1fms latency, %.1fms per line, %d bytes buffer" \
+        % (options.baud, options.latency, options.line_time, options.buffer)
+    sizes = {"both": (0, options.buffer), "ping-pong": (0,),
+             "counting": (options.buffer,)}[options.mode]
+    for rx_buffer_size in sizes:
+        child = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                  "--firmware"] + sys.argv[1:],
+                                 stdout = subprocess.PIPE,
+                                 stderr = subprocess.PIPE)
+        port = child.stdout.readline().strip()
+        p = printcore(port, 115200)
+        try:
+            while not p.online:
+                time.sleep(0.01)
+            p.rx_buffer_size = rx_buffer_size
+            done = Event()
+            p.endcb = done.set
+            start = time.time()
+            p.startprint(gcode)
+            done.wait(3600)
+            elapsed = time.time() - start
+        finally:
+            p.disconnect()
+            child.terminate()
+        output, errors = child.communicate()
+        received, overflows, resends, executed, executed_digest, \
+            motion_time = errors.split()[-6:]
+        print "%-14s %d lines in %6.2fs: %5d lines/s, %s lines sent, " \
+            "%s overflows, %s resends (%d lines resent), %s" \
+            % ("ping-pong" if not rx_buffer_size
+               else "char counting", len(expected), elapsed,
+               len(expected) / elapsed, received, overflows, resends,
+               p.resent_lines,
+               "all executed in order"
+               if executed_digest == virtualprinter.digest(expected)
+               else "EXECUTED %s LINES OUT OF ORDER" % executed)
+        if options.speed:
+            estimate = gcode.duration.total_seconds()
+            print "%-14s simulated motion time %.1fs, estimated %.1fs (%+.1f%%)" \
+                % ("", float(motion_time), estimate,
+                   100 * (estimate / float(motion_time) - 1))
+
+if __name__ == '__main__':
+    main()
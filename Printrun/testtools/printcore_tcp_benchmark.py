@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Streaming benchmark for printcore against a TCP printer, with each of the
+# given write latency budgets (ms, see printcore.tcp_write_latency; 0 writes
+# each line on its own). The printer is a child process listening on a local
+# TCP port and answering "ok" to every line it reads, like a network printer
+# with a large buffer. For each budget, the lines/s, the CPU time used by
+# this process (i.e. by printcore) per line, the number of sends done by
+# printcore and of reads done by the printer are reported. With --events,
+# an eventcore is benchmarked too, writing the lines sent by each pump of
+# its loop at once.
+#
+# Usage: python testtools/printcore_tcp_benchmark.py [--events] [nlines] [latency...]
+#        python testtools/printcore_tcp_benchmark.py --standin
+#
+# The second form runs a single stand-in printer and prints its port.
+
+import os
+import sys
+import time
+import socket
+import signal
+import subprocess
+from threading import Event, Thread
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+def standin():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    print server.getsockname()[1]
+    sys.stdout.flush()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    client = server.accept()[0]
+    client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    pending = ""
+    lines = reads = 0
+    last = 0
+    try:
+        while True:
+            data = client.recv(65536)
+            if not data:
+                break
+            last = time.time()
+            reads += 1
+            pending += data
+            count = pending.count("\n")
+            if count:
+                pending = pending[pending.rindex("\n") + 1:]
+                lines += count
+                client.sendall("ok\n" * count)
+    except socket.error:
+        # Reset by the host closing with answers left unread
+        pass
+    finally:
+        sys.stderr.write("%d %d %f" % (lines, reads, last))
+
+def start_standin():
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                              "--standin"],
+                             stdout = subprocess.PIPE,
+                             stderr = subprocess.PIPE)
+    return child, "127.0.0.1:%s" % child.stdout.readline().strip()
+
+def bench(gcode, latency, events = False):
+    """Prints gcode and returns (elapsed, cpu, sends, printer lines, printer
+    reads), elapsed being the time until the printer read the last line"""
+    from printrun.printcore import printcore
+    child, port = start_standin()
+    loop = None
+    try:
+        if events:
+            from printrun.eventcore import eventcore, EventLoop
+            loop = EventLoop()
+            p = eventcore(loop = loop)
+            loop.add_callback(p.connect, port, 115200)
+            loop_thread = Thread(target = loop.run)
+            loop_thread.start()
+        else:
+            p = printcore()
+            p.tcp_write_latency = latency
+            p.connect(port, 115200)
+        done = Event()
+        p.endcb = done.set
+        while not p.online:
+            time.sleep(0.01)
+        cpu_start = sum(os.times()[:2])
+        start = time.time()
+        if loop is not None:
+            loop.add_callback(p.startprint, gcode)
+        else:
+            p.startprint(gcode)
+        done.wait(3600)
+        cpu = sum(os.times()[:2]) - cpu_start
+        sends = p._tcp_writer.sends if p._tcp_writer is not None else None
+    finally:
+        if loop is not None:
+            loop.add_callback(p.disconnect)
+            loop.stop()
+            loop_thread.join()
+        else:
+            p.disconnect()
+    # The printer exits once it read everything
+    out, err = child.communicate()
+    lines, reads, last = err.split()[-3:]
+    return float(last) - start, cpu, sends, int(lines), int(reads)
+
+def main(args):
+    from printrun import gcoder
+    import synthetic_gcode
+    events = bool(args) and args[0] == "--events"
+    if events:
+        args = args[1:]
+    nlines = int(args[0]) if len(args) > 0 else 50000
+    latencies = [float(arg) for arg in args[1:]] or [0, 0.5, 2, 5]
+    gcode = gcoder.GCode(list(synthetic_gcode.slic3r_like(nlines)))
+    runs = [("latency %gms" % latency, latency / 1000., False)
+            for latency in latencies]
+    if events:
+        runs.append(("eventcore", 0, True))
+    for name, latency, use_events in runs:
+        elapsed, cpu, sends, lines, reads = bench(gcode, latency, use_events)
+        print "%-15s %6d lines in %6.2fs: %6d lines/s, %5.1f us CPU/line, %s sends, %d printer reads" \
+            % (name, lines, elapsed, lines / elapsed, 1e6 * cpu / lines,
+               sends if sends is not None else "-", reads)
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ["--standin"]:
+        standin()
+    else:
+        main(sys.argv[1:])
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmark of printcore printing while being polled for telemetry. The
+# printer is a loopback printer (see printcore_loopback_benchmark.py)
+# answering each line after delay ms. While it prints, pollers threads send
+# M105 (and one of them M114) every interval ms, like the status checker,
+# graph and server of several interfaces would. The print is done with the
+# commands sent ahead of the print in a plain FIFO queue, as they were
+# before printcore_scheduler, then with the scheduler's default telemetry
+# share and coalescing. The print lines/s, the telemetry queries sent and
+# the share of the lines they took are reported.
+#
+# Usage: python testtools/printcore_telemetry_benchmark.py [nlines] [pollers] [interval] [delay]
+
+import os
+import sys
+import time
+from threading import Event, Thread
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+def poll(p, command, interval, done):
+    while not done.is_set():
+        p.send_now(command)
+        time.sleep(interval / 1000.)
+
+def bench(gcode, pollers, interval, delay, fifo):
+    from printrun.printcore import printcore
+    from printrun.printcore_scheduler import TELEMETRY
+    from printcore_loopback_benchmark import start_loopback
+    child, port = start_loopback(delay)
+    p = printcore(port, 115200)
+    try:
+        if fifo:
+            p.priqueue.shares[TELEMETRY] = None
+            p.priqueue.coalesce = False
+        done = Event()
+        p.endcb = done.set
+        while not p.online:
+            time.sleep(0.01)
+        threads = [Thread(target = poll,
+                          args = (p, "M114" if i == 0 else "M105",
+                                  interval, done))
+                   for i in range(pollers)]
+        start = time.time()
+        p.startprint(gcode)
+        for thread in threads:
+            thread.start()
+        done.wait(3600)
+        elapsed = time.time() - start
+        for thread in threads:
+            thread.join()
+        summary = p.priqueue.summary()
+        telemetry = summary["queued"]["telemetry"] - summary["waiting"]
+    finally:
+        p.disconnect()
+        child.terminate()
+        child.communicate()
+    return elapsed, telemetry, summary["coalesced"]
+
+def main(args):
+    from printrun import gcoder
+    import synthetic_gcode
+    nlines = int(args[0]) if len(args) > 0 else 5000
+    pollers = int(args[1]) if len(args) > 1 else 3
+    interval = float(args[2]) if len(args) > 2 else 5
+    delay = float(args[3]) if len(args) > 3 else 1
+    gcode = gcoder.GCode(list(synthetic_gcode.slic3r_like(nlines)))
+    lines = len(gcode)
+    for name, fifo in (("fifo", True), ("scheduler", False)):
+        elapsed, telemetry, coalesced = bench(gcode, pollers, interval,
+                                              delay, fifo)
+        print "%-10s %6d lines in %6.2fs: %6d lines/s, %5d queries sent (%4.1f%% of the lines), %5d coalesced" \
+            % (name, lines, elapsed, lines / elapsed, telemetry,
+               100. * telemetry / (lines + telemetry), coalesced)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,141 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Deterministic synthetic G-code used by the benchmarks in testtools"""
+
+import math
+import random
+
+def slic3r_like(target_lines = 1000000, layer_height = 0.2, seed = 42):
+    """Yields lines looking like Slic3r output until target_lines lines have
+    been generated: a start block, then layers made of perimeters, infill
+    zig-zags, retractions, travels and periodic G92 E0 resets."""
+    rnd = random.Random(seed)
+    header = ["; generated by Slic3r 0.9.9 on 2013-10-19 at 12:00:00",
+              "; layer_height = %.2f" % layer_height,
+              "G21 ; set units to millimeters",
+              "M107",
+              "M104 S200 ; set temperature",
+              "G28 ; home all axes",
+              "M109 S200 ; wait for temperature to be reached",
+              "G90 ; use absolute coordinates",
+              "G92 E0",
+              "M82 ; use absolute distances for extrusion",
+              "G1 F1800.000 E-1.00000",
+              "G92 E0"]
+    count = 0
+    for line in header:
+        yield line
+        count += 1
+    e = 0.0
+    z = 0.0
+    layer = 0
+    while count < target_lines:
+        layer += 1
+        z += layer_height
+        yield "G1 Z%.3f F7800.000" % z
+        count += 1
+        if layer == 2:
+            yield "M106 S255"
+            count += 1
+        cx = 100 + rnd.uniform(-1, 1)
+        cy = 100 + rnd.uniform(-1, 1)
+        for radius in (20.0, 19.6, 19.2):
+            segments = 90
+            yield "G1 X%.3f Y%.3f F7800.000" % (cx + radius, cy)
+            yield "G1 F1800.000 E%.5f" % (e + 1.0)
+            e += 1.0
+            count += 2
+            for s in range(1, segments + 1):
+                angle = 2 * math.pi * s / segments
+                x = cx + radius * math.cos(angle)
+                y = cy + radius * math.sin(angle)
+                e += 0.04
+                yield "G1 X%.3f Y%.3f E%.5f" % (x, y, e)
+                count += 1
+            yield "G1 F1800.000 E%.5f" % (e - 1.0)
+            e -= 1.0
+            count += 1
+        y = cy - 18
+        direction = 1
+        yield "G1 X%.3f Y%.3f F7800.000 ; move to first infill point" % (cx - 18, y)
+        count += 1
+        while y < cy + 18:
+            x = cx + 18 * direction
+            e += 0.9
+            yield "G1 X%.3f Y%.3f E%.5f F2400.000" % (x, y, e)
+            y += 0.5
+            e += 0.02
+            yield "G1 X%.3f Y%.3f E%.5f" % (x, y, e)
+            direction = -direction
+            count += 2
+        yield "G92 E0"
+        e = 0.0
+        count += 1
+    yield "M107"
+    yield "M104 S0 ; turn off temperature"
+    yield "G28 X0  ; home X axis"
+    yield "M84     ; disable motors"
+
+def spiral_vase(target_lines = 100000, layer_height = 0.2, segments = 60,
+                adaptive = False, seed = 42):
+    """Yields lines looking like spiral vase mode output: after a solid first
+    layer, the nozzle keeps rising along the perimeter, so that every move
+    changes Z. With adaptive set, the height of each turn varies between
+    half and one and a half layer_height."""
+    rnd = random.Random(seed)
+    header = ["; generated by Slic3r 0.9.9 on 2013-10-19 at 12:00:00",
+              "; spiral_vase = 1",
+              "G21 ; set units to millimeters",
+              "G28 ; home all axes",
+              "G90 ; use absolute coordinates",
+              "M82 ; use absolute distances for extrusion",
+              "G92 E0",
+              "G1 Z%.3f F7800.000" % layer_height]
+    count = 0
+    for line in header:
+        yield line
+        count += 1
+    e = 0.0
+    z = layer_height
+    radius = 20.0
+    # Solid first layer
+    for s in range(segments + 1):
+        angle = 2 * math.pi * s / segments
+        e += 0.05
+        yield "G1 X%.3f Y%.3f E%.5f F1800.000" % (100 + radius * math.cos(angle),
+                                                 100 + radius * math.sin(angle), e)
+        count += 1
+    while count < target_lines:
+        if adaptive:
+            turn_height = layer_height * rnd.uniform(0.5, 1.5)
+        else:
+            turn_height = layer_height
+        for s in range(1, segments + 1):
+            angle = 2 * math.pi * s / segments
+            z += turn_height / segments
+            e += 0.04
+            r = radius + 2 * math.sin(z / 5)
+            yield "G1 X%.3f Y%.3f Z%.4f E%.5f" % (100 + r * math.cos(angle),
+                                                 100 + r * math.sin(angle), z, e)
+            count += 1
+    yield "M104 S0 ; turn off temperature"
+    yield "G28 X0  ; home X axis"
+    yield "M84     ; disable motors"
+
+def write_file(path, lines):
+    with open(path, "w") as f:
+        for line in lines:
+            f.write(line + "\n")